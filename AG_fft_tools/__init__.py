@@ -16,9 +16,13 @@ warnings.warn("agpy.AG_fft_tools is deprecated."
 
 from correlate2d import correlate2d
 from psds import PSD2
-from smooth_tools import smooth
+from smooth_tools import smooth,smooth_planes
 from convolve_nd import convolvend
 from convolve_nd import convolvend as convolve
+from convolve_nd import PreparedConvolver
+from convolve_direct import convolve_direct
+from convolve_chunked import convolve_chunked
+from convolve_axes import convolve_axes
 import fast_ffts
 from upsample import dftups,upsample_image
-from shift import shift
+from shift import shift,shift1d,shift_stack
@@ -0,0 +1,209 @@
+"""
+Batched convolution of an N-D array (e.g. a cube) with a lower-dimensional
+kernel along chosen axes.  All of the planes (or spectra) are transformed
+together with one multi-axis FFT instead of one convolution per plane.
+"""
+import numpy as np
+import warnings
+
+from fast_ffts import get_ffts
+from convolve_nd import padded_shape
+
+# default maximum number of elements in a padded block of slices; blocks
+# that fit in the CPU cache transform fastest
+block_elements = 2**16
+
+def convolve_axes(cube, kernel, axes=None, boundary='fill', fill_value=0,
+        interpolate_nan=False, ignore_edge_zeros=False, min_wt=0.0,
+        normalize_kernel=False, fft_pad='fast', psf_pad=False, downsample=None,
+        nthreads=1, use_numpy_fft=False, fft_backend=None, dtype=None,
+        quiet=False, block_size=None):
+    """
+    Convolve every slice of `cube` along `axes` with `kernel`, all at once.
+    For example, convolve_axes(cube, kernel2d, axes=(1,2)) smooths every
+    plane of a (nv,ny,nx) cube and convolve_axes(cube, kernel1d, axes=(0,))
+    smooths every spectrum.  Each slice gets the same result
+    convolvend(slice, kernel, ...) would give.
+
+    Parameters
+    ----------
+    cube: `numpy.ndarray`
+        Real array to be convolved.  Masked arrays are converted to NaNs.
+    kernel: `numpy.ndarray`
+        Kernel with one dimension per entry in `axes`; kernel axis i is
+        applied along cube axis axes[i].  Will be normalized if
+        *normalize_kernel* is set.  Assumed to be centered.
+    axes: tuple
+        Axes of `cube` to convolve along.  Defaults to the last kernel.ndim
+        axes.
+
+    Options
+    -------
+    boundary, fill_value, interpolate_nan, ignore_edge_zeros, min_wt,
+    normalize_kernel, fft_pad, psf_pad, nthreads, use_numpy_fft, fft_backend,
+    dtype, quiet:
+        See `convolvend`.  NaNs are interpolated separately in each slice.
+        Note that fft_pad defaults to 'fast' here.
+    downsample: int or tuple
+        Keep only every downsample'th pixel along each of `axes` (e.g. to
+        resample a spectrally smoothed cube)
+    block_size: int
+        Number of slices to transform together.  The default keeps each
+        padded block under `block_elements` elements, which bounds the
+        memory used and is usually faster than one huge transform.
+
+    Returns
+    -------
+    The convolved cube, with the same shape as `cube` unless downsampled
+    """
+    if np.ma.isMaskedArray(cube):
+        cube = np.ma.filled(cube.astype(np.result_type(cube.dtype,
+            np.float32)), np.nan)
+    cube = np.asarray(cube)
+    kernel = np.asarray(kernel)
+    if np.iscomplexobj(cube) or np.iscomplexobj(kernel):
+        raise ValueError("convolve_axes only works on real arrays")
+
+    if axes is None:
+        axes = tuple(range(cube.ndim-kernel.ndim, cube.ndim))
+    axes = tuple(ax % cube.ndim for ax in axes)
+    if len(axes) != kernel.ndim:
+        raise ValueError("kernel must have one dimension per convolved axis")
+    if len(set(axes)) != len(axes):
+        raise ValueError("axes must be unique")
+    nk = kernel.ndim
+
+    if dtype is not None:
+        realtype = np.dtype(dtype)
+    else:
+        realtype = np.dtype(np.float64)
+    complextype = np.result_type(realtype, np.complex64)
+
+    # move the convolution axes to the end so that the kernel broadcasts
+    # over the others
+    fftaxes = tuple(range(cube.ndim-nk, cube.ndim))
+    cube = np.moveaxis(cube, axes, fftaxes)
+    arrayshape = cube.shape[-nk:]
+    batchshape = cube.shape[:-nk]
+
+    nanmaskkernel = np.isnan(kernel)
+    kernel = np.array(kernel, dtype=realtype)
+    kernel[nanmaskkernel] = 0
+    nanmaskcube = np.isnan(cube)
+    if ((nanmaskcube.any() or nanmaskkernel.any()) and not interpolate_nan
+            and not quiet):
+        warnings.warn("NOT ignoring nan values even though they are present" +
+                " (they are treated as 0)")
+
+    if normalize_kernel is True:
+        kernel = kernel / kernel.sum()
+        kernel_is_normalized = True
+    elif normalize_kernel:
+        kernel = kernel / normalize_kernel(kernel)
+        kernel_is_normalized = True
+    else:
+        kernel_is_normalized = np.abs(kernel.sum() - 1) < 1e-8
+        if (interpolate_nan or ignore_edge_zeros) and not kernel_is_normalized:
+            warnings.warn("Kernel is not normalized, therefore ignore_edge_zeros"+
+                "and interpolate_nan will be ignored.")
+
+    if boundary in ('fill', None):
+        psf_pad = True
+    elif boundary == 'wrap':
+        psf_pad = False
+        fft_pad = False
+        fill_value = 0
+    else:
+        raise NotImplementedError("The '%s' option is not implemented " % boundary +
+                "for fft-based convolution")
+
+    newshape = padded_shape(arrayshape, kernel.shape, fft_pad=fft_pad,
+            psf_pad=psf_pad)
+    arrayslices = []
+    kernslices = []
+    for newdimsize, arraydimsize, kerndimsize in zip(newshape, arrayshape, kernel.shape):
+        center = newdimsize - (newdimsize+1)//2
+        arrayslices += [slice(center - arraydimsize//2,
+            center + (arraydimsize+1)//2)]
+        kernslices += [slice(center - kerndimsize//2,
+            center + (kerndimsize+1)//2)]
+    arrayslices = (Ellipsis,) + tuple(arrayslices)
+    kernslices = tuple(kernslices)
+
+    fftn, ifftn = get_ffts(nthreads=nthreads, use_numpy_fft=use_numpy_fft,
+            backend=fft_backend, real=True)
+
+    bigkernel = np.zeros(newshape, dtype=realtype)
+    bigkernel[kernslices] = kernel
+    kernfft = fftn(np.fft.ifftshift(bigkernel)).astype(complextype, copy=False)
+    del bigkernel
+
+    weighted = (interpolate_nan or ignore_edge_zeros) and kernel_is_normalized
+    if weighted:
+        def weights(nanmask):
+            # convolve the weights the same way as the data; nanmask is
+            # False or has a leading batch axis
+            wtshape = np.shape(nanmask)[:-nk] + newshape
+            if ignore_edge_zeros:
+                bigwt = np.zeros(wtshape, dtype=realtype)
+            else:
+                bigwt = np.ones(wtshape, dtype=realtype)
+            bigwt[arrayslices] = 1.0-nanmask*interpolate_nan
+            wtaxes = tuple(range(len(wtshape)-nk, len(wtshape)))
+            wtfft = fftn(bigwt, axes=wtaxes).astype(complextype, copy=False)
+            del bigwt
+            wtfft *= kernfft
+            wtfft /= kernel.sum()
+            wt = ifftn(wtfft, s=newshape, axes=wtaxes)[arrayslices]
+            # roundoff can make these slightly negative
+            wt[wt<0] = 0
+            return wt
+        # if a slice has no NaNs, its weights are the same as every other
+        # such slice, so they are only computed once
+        commonwt = weights(False)
+
+    # flatten the other axes into one batch axis and go through it in blocks
+    nbatch = int(np.prod(batchshape))
+    cube = cube.reshape((nbatch,) + arrayshape)
+    nanmaskcube = nanmaskcube.reshape((nbatch,) + arrayshape)
+    result = np.empty((nbatch,) + arrayshape, dtype=realtype)
+    blockaxes = tuple(range(1, nk+1))
+    if block_size is None:
+        block_size = max(block_elements // int(np.prod(newshape)), 1)
+
+    for start in xrange(0, nbatch, block_size):
+        block = slice(start, min(start+block_size, nbatch))
+        nanmask = nanmaskcube[block]
+
+        bigcube = np.empty((nanmask.shape[0],) + newshape, dtype=realtype)
+        bigcube[...] = fill_value
+        bigcube[arrayslices] = cube[block]
+        bigcube[arrayslices][nanmask] = 0
+        fftmult = fftn(bigcube, axes=blockaxes).astype(complextype, copy=False)
+        del bigcube
+        fftmult *= kernfft
+        rblock = ifftn(fftmult, s=newshape, axes=blockaxes)[arrayslices]
+        del fftmult
+
+        if weighted:
+            if interpolate_nan and nanmask.any():
+                wt = weights(nanmask)
+            else:
+                wt = np.broadcast_to(commonwt, rblock.shape)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rblock /= wt
+            rblock[wt < min_wt] = np.nan
+            if min_wt == 0.0:
+                rblock[wt == 0.0] = 0.0
+
+        result[block] = rblock
+
+    result = result.reshape(batchshape + arrayshape)
+
+    if downsample is not None:
+        if np.isscalar(downsample):
+            downsample = (downsample,)*nk
+        result = result[(Ellipsis,) + tuple(slice(None,None,int(ds))
+            for ds in downsample)]
+
+    return np.moveaxis(result, fftaxes, axes)
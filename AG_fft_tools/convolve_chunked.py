@@ -0,0 +1,157 @@
+"""
+Tiled (overlap-save) convolution for arrays too large to FFT in one piece,
+e.g. `numpy.memmap` arrays or memory-mapped FITS images.  Each output tile is
+computed from the matching input tile plus a halo as wide as the kernel, so
+the result is the same as convolvend(..., boundary='fill') on the whole
+array, including the NaN interpolation and edge weighting, while only a few
+tiles are ever in memory.
+"""
+import numpy as np
+import itertools
+try:
+    import astropy.io.fits as fits
+    fitsOK = True
+except ImportError:
+    fitsOK = False
+
+from convolve_nd import PreparedConvolver
+from convolve_direct import convolve_direct, convolution_method
+
+def _open_array(array, ext=0):
+    """
+    Return a (memory-mapped, if possible) array given an array, a FITS HDU,
+    or the filename of a FITS or .npy file
+    """
+    if isinstance(array, basestring):
+        if array.endswith('.npy'):
+            return np.load(array, mmap_mode='r')
+        if not fitsOK:
+            raise ImportError("astropy.io.fits is required to read %s" % array)
+        return fits.open(array, memmap=True)[ext].data
+    elif hasattr(array, 'data') and hasattr(array, 'header'):
+        # a FITS HDU
+        return array.data
+    else:
+        return array
+
+def convolve_chunked(array, kernel, output=None, tile_shape=2048,
+        interpolate_nan=False, ignore_edge_zeros=False, min_wt=0.0,
+        normalize_kernel=False, fill_value=0, quiet=False, method='fft',
+        fft_pad='fast', ext=0, dtype=None, **kwargs):
+    """
+    Convolve an ndarray (or memmap, or FITS file) with an nd-kernel one tile
+    at a time, writing the result tile by tile into `output`.  Returns
+    `output`.  Equivalent to convolvend(array, kernel, boundary='fill', ...)
+    but with peak memory set by the tile size rather than the array size.
+
+    Parameters
+    ----------
+    array: `numpy.ndarray`, `numpy.memmap`, FITS HDU, or str
+        Array to be convolved with *kernel*.  A string is taken as the name
+        of a .npy file or a FITS file (extension `ext`), which is
+        memory-mapped.
+    kernel: `numpy.ndarray`
+        See `convolvend`.  Should be much smaller than `tile_shape`, since
+        each tile is padded by the kernel size.
+    output: None, str, or array
+        Where to write the result.  None makes an in-memory array; a string
+        is the filename of a .npy file that will be created and
+        memory-mapped; otherwise it must be an array (e.g. a memmap) with the
+        same shape as `array`.
+
+    Options
+    -------
+    tile_shape: int or tuple
+        Shape of the output tiles (int = the same along every axis).  Each
+        tile is read with a halo of the kernel size around it.
+    method: 'fft', 'direct', or 'auto'
+        Convolve each tile with FFTs, in real space (convolve_direct), or
+        whichever convolution_method estimates is fastest
+    fft_pad: see `convolvend`.  Defaults to 'fast' since tiles at the edges
+        have arbitrary sizes
+    dtype: output dtype if `output` is created here (default: the input's
+        float type, or float64)
+    interpolate_nan, ignore_edge_zeros, min_wt, normalize_kernel,
+    fill_value, quiet: see `convolvend`
+    kwargs are passed to PreparedConvolver (e.g. nthreads, fft_backend)
+
+    Example
+    -------
+    Smooth a 20k x 20k float32 image on disk into a .npy file::
+
+        arr = np.memmap('big.dat', dtype='float32', mode='r', shape=(20000,20000))
+        smoothed = convolve_chunked(arr, kernel, output='smoothed.npy',
+                                    interpolate_nan=True)
+    """
+    array = _open_array(array, ext=ext)
+    kernel = np.asarray(kernel)
+    if array.ndim != kernel.ndim:
+        raise Exception('array and kernel have differing number of'
+                        'dimensions')
+    if kwargs.get('boundary','fill') not in ('fill', None):
+        raise ValueError("convolve_chunked only supports boundary='fill'")
+    kwargs.pop('boundary', None)
+
+    if np.isscalar(tile_shape):
+        tile_shape = (int(tile_shape),) * array.ndim
+    tile_shape = tuple(min(t,n) for t,n in zip(tile_shape, array.shape))
+
+    if dtype is None:
+        dtype = np.result_type(array.dtype, np.float32) if array.dtype.kind == 'f' else 'float64'
+    if output is None:
+        output = np.empty(array.shape, dtype=dtype)
+    elif isinstance(output, basestring):
+        output = np.lib.format.open_memmap(output, mode='w+', dtype=dtype,
+                shape=array.shape)
+    elif output.shape != array.shape:
+        raise ValueError("output must have the same shape as array")
+
+    # output pixel i depends on input pixels i-(n-1-n//2) through i+n//2
+    # (the kernel is centered on n//2, as in convolvend)
+    halo_lo = [n - 1 - n//2 for n in kernel.shape]
+    halo_hi = [n//2 for n in kernel.shape]
+
+    # tiles in the interior all have the same shape, so they share a
+    # PreparedConvolver (and its kernel FFT)
+    convolvers = {}
+
+    ranges = [range(0, n, t) for n,t in zip(array.shape, tile_shape)]
+    for corner in itertools.product(*ranges):
+        outslices = tuple(slice(c, min(c+t, n))
+                for c,t,n in zip(corner, tile_shape, array.shape))
+        inslices = tuple(slice(max(s.start-lo, 0), min(s.stop+hi, n))
+                for s,lo,hi,n in zip(outslices, halo_lo, halo_hi, array.shape))
+        # position of the output tile within the input tile
+        cropslices = tuple(slice(o.start-i.start, o.stop-i.start)
+                for o,i in zip(outslices, inslices))
+
+        tile = np.array(array[inslices])
+
+        if method == 'fft' or (method == 'auto' and convolution_method(
+                tile.shape, kernel, interpolate_nan=interpolate_nan,
+                ignore_edge_zeros=ignore_edge_zeros,
+                has_nans=np.isnan(tile).any(), fft_pad=fft_pad) == 'fft'):
+            if tile.shape not in convolvers:
+                convolvers[tile.shape] = PreparedConvolver(kernel, tile.shape,
+                        boundary='fill', fill_value=fill_value,
+                        fft_pad=fft_pad, normalize_kernel=normalize_kernel,
+                        **kwargs)
+            result = convolvers[tile.shape](tile,
+                    interpolate_nan=interpolate_nan,
+                    ignore_edge_zeros=ignore_edge_zeros, min_wt=min_wt,
+                    quiet=quiet)
+        elif method in ('direct', 'auto'):
+            result = convolve_direct(tile, kernel, fill_value=fill_value,
+                    interpolate_nan=interpolate_nan,
+                    ignore_edge_zeros=ignore_edge_zeros, min_wt=min_wt,
+                    normalize_kernel=normalize_kernel, quiet=quiet)
+        else:
+            raise ValueError("method must be 'fft', 'direct', or 'auto'")
+
+        output[outslices] = result[cropslices]
+        del tile, result
+
+    if hasattr(output, 'flush'):
+        output.flush()
+
+    return output
@@ -0,0 +1,248 @@
+"""
+Direct (real-space) convolution with the same NaN and edge handling as
+convolvend with boundary='fill'.  For small kernels this is much cheaper than
+padding and FFTing the whole image, and separable kernels (gaussians and
+boxcars) can be applied as a sequence of 1D convolutions.
+`convolution_method` estimates which approach is fastest.
+"""
+import numpy as np
+import warnings
+try:
+    import scipy.ndimage
+    has_ndimage = True
+except ImportError:
+    has_ndimage = False
+
+from convolve_nd import padded_shape
+
+# Rough relative costs used by convolution_method: fft_cost is per element
+# per log2(size) of a real FFT, direct_cost is per multiply-add in
+# scipy.ndimage, and pass_cost is the per-pixel overhead of each 1D pass of
+# a separable convolution.  These were measured on a typical desktop (numpy
+# FFTs); only their ratios matter.
+fft_cost = 2.0
+direct_cost = 1.0
+pass_cost = 8.0
+
+# scipy.ndimage builds a table of one offset per nonzero kernel element for
+# every distinct position of the kernel relative to the array edges, i.e.
+# ~count_nonzero(kernel)*prod(min(kernel.shape, array.shape)) offsets.
+# Image-sized kernels (e.g. smooth's default nwidths='max') would need
+# gigabytes, so N-D direct convolutions needing more offsets than this are
+# refused.
+max_direct_offsets = 2**27
+
+def direct_offsets(arrayshape, kernel):
+    """
+    Number of offsets scipy.ndimage needs for a direct N-D convolution of an
+    array of shape `arrayshape` with `kernel` (see max_direct_offsets)
+    """
+    kernel = np.asarray(kernel)
+    edges = np.prod([min(k,a) for k,a in zip(kernel.shape, arrayshape)])
+    return np.count_nonzero(kernel) * float(edges)
+
+def separable_factors(kernel, rtol=1e-10):
+    """
+    If `kernel` is an outer product of 1D kernels (as gaussian and boxcar
+    kernels are), return the list of 1D factors, one per axis, whose outer
+    product is the kernel.  Otherwise return None.
+    """
+    kernel = np.asarray(kernel)
+    if kernel.ndim == 1:
+        return [kernel]
+    if np.iscomplexobj(kernel) or kernel.ndim == 0 or np.isnan(kernel).any():
+        return None
+
+    # take the 1D cuts through the peak; the peak value appears in all of
+    # them, so divide it out of all but the first
+    peak = np.unravel_index(np.argmax(np.abs(kernel)), kernel.shape)
+    peakval = kernel[peak]
+    if peakval == 0:
+        return None
+    factors = []
+    for axis in range(kernel.ndim):
+        index = list(peak)
+        index[axis] = slice(None)
+        factors.append(np.array(kernel[tuple(index)], dtype='float'))
+    for factor in factors[1:]:
+        factor /= peakval
+
+    rebuilt = factors[0]
+    for factor in factors[1:]:
+        rebuilt = np.multiply.outer(rebuilt, factor)
+    if np.allclose(rebuilt, kernel, rtol=rtol, atol=rtol*np.abs(peakval)):
+        return factors
+    else:
+        return None
+
+def _convolve(array, kernel, factors=None, cval=0.0):
+    """
+    Linear convolution of `array` with `kernel` with values outside the array
+    set to `cval`.  The kernel is centered on pixel n//2 along each axis, as
+    in convolvend.  If `factors` (from separable_factors) are given, use one
+    1D convolution per axis instead.
+    """
+    # ndimage centers its weights on pixel n//2 of the *correlation* kernel,
+    # so flip the kernel and, for even sizes, shift the origin by one to
+    # match convolvend's ifftshift convention
+    if factors is None:
+        origin = [-1 if n % 2 == 0 else 0 for n in kernel.shape]
+        flipped = kernel[(slice(None,None,-1),)*kernel.ndim]
+        return scipy.ndimage.correlate(array, flipped, mode='constant',
+                cval=cval, origin=origin)
+
+    result = array
+    for axis, weights in enumerate(factors):
+        result = scipy.ndimage.correlate1d(result, weights[::-1], axis=axis,
+                mode='constant', cval=cval,
+                origin=-1 if weights.size % 2 == 0 else 0)
+        # outside the array, each pass multiplies the constant by the sum of
+        # that factor
+        cval = cval * weights.sum()
+    return result
+
+def convolve_direct(array, kernel, separable=None, fill_value=0,
+        interpolate_nan=False, ignore_edge_zeros=False, min_wt=0.0,
+        normalize_kernel=False, quiet=False):
+    """
+    Convolve an ndarray with an nd-kernel in real space.  Gives the same
+    result as convolvend(array, kernel, boundary='fill', ...), including the
+    NaN interpolation and edge weighting, without any FFTs.  Requires
+    scipy.ndimage.
+
+    Parameters
+    ----------
+    array: `numpy.ndarray`
+          Array to be convolved with *kernel*
+    kernel: `numpy.ndarray`
+          Will be normalized if *normalize_kernel* is set.  Assumed to be
+          centered on pixel n//2 along each axis
+
+    Options
+    -------
+    separable: None, bool, or list
+        If None, check whether the kernel is separable and, if so, convolve
+        with one 1D kernel per axis.  If False, always do the full N-D
+        convolution.  Can also be the list of 1D factors from
+        `separable_factors`.
+    fill_value, interpolate_nan, ignore_edge_zeros, min_wt, normalize_kernel:
+        See `convolvend`
+
+    Examples
+    --------
+    >>> convolve_direct([1,0,3],[1,1,1])
+    array([ 1.,  4.,  3.])
+
+    >>> convolve_direct([1,np.nan,3],[1,1,1], interpolate_nan=True, normalize_kernel=True, ignore_edge_zeros=True)
+    array([ 1.,  2.,  3.])
+    """
+    if not has_ndimage:
+        raise ImportError("convolve_direct requires scipy.ndimage")
+
+    if np.ma.isMaskedArray(array):
+        array = np.ma.filled(array.astype('float'), np.nan)
+    array = np.asarray(array, dtype='float')
+    kernel = np.array(kernel, dtype='float')
+    if array.ndim != kernel.ndim:
+        raise Exception('array and kernel have differing number of'
+                        'dimensions')
+
+    nanmaskarray = np.isnan(array)
+    nanmaskkernel = np.isnan(kernel)
+    kernel[nanmaskkernel] = 0
+    if ((nanmaskarray.any() or nanmaskkernel.any()) and not interpolate_nan
+            and not quiet):
+        warnings.warn("NOT ignoring nan values even though they are present" +
+                " (they are treated as 0)")
+
+    if normalize_kernel is True:
+        kernel = kernel / kernel.sum()
+        kernel_is_normalized = True
+    elif normalize_kernel:
+        kernel = kernel / normalize_kernel(kernel)
+        kernel_is_normalized = True
+    else:
+        kernel_is_normalized = np.abs(kernel.sum() - 1) < 1e-8
+        if (interpolate_nan or ignore_edge_zeros) and not kernel_is_normalized:
+            warnings.warn("Kernel is not normalized, therefore ignore_edge_zeros"+
+                "and interpolate_nan will be ignored.")
+
+    if separable is None or separable is True:
+        factors = separable_factors(kernel)
+        if separable and factors is None:
+            raise ValueError("The kernel is not separable")
+    elif separable is False:
+        factors = None
+    else:
+        factors = separable
+
+    if factors is None and direct_offsets(array.shape, kernel) > max_direct_offsets:
+        raise ValueError("The %s kernel is too large for a direct convolution "
+                "of a %s array (it would need %g offsets, more than "
+                "max_direct_offsets=%g); use an FFT convolution or a smaller "
+                "kernel" % (kernel.shape, array.shape,
+                    direct_offsets(array.shape, kernel), max_direct_offsets))
+
+    data = np.where(nanmaskarray, 0, array)
+    result = _convolve(data, kernel, factors, cval=fill_value)
+
+    if (interpolate_nan or ignore_edge_zeros) and kernel_is_normalized:
+        # weights are 1 for good data, 0 for ignored NaNs, and (outside the
+        # array) 0 if ignoring the edge zeros, 1 otherwise
+        weights = 1.0-nanmaskarray*interpolate_nan
+        wt = _convolve(weights, kernel, factors,
+                cval=0.0 if ignore_edge_zeros else 1.0) / kernel.sum()
+        # roundoff can make these slightly negative
+        wt[wt<0] = 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result /= wt
+        result[wt < min_wt] = np.nan
+        if min_wt == 0.0:
+            result[wt == 0.0] = 0.0
+
+    return result
+
+def convolution_method(arrayshape, kernel, interpolate_nan=False,
+        ignore_edge_zeros=False, has_nans=True, fft_pad=True,
+        separable=None):
+    """
+    Estimate whether convolving an array of shape `arrayshape` with `kernel`
+    (boundary='fill') is cheapest with separable 1D passes, a direct N-D
+    convolution, or FFTs.  Returns 'separable', 'direct', or 'fft'.
+
+    The FFT estimate assumes the kernel FFT is reused (as it is with
+    `PreparedConvolver`), so it counts a forward and an inverse transform,
+    plus two more for the weights if NaNs are being interpolated.  The
+    direct estimates count one pass for the data and one for the weights.
+
+    separable - the kernel's 1D factors, if already known (False if the
+        kernel is known not to be separable)
+
+    'direct' is never chosen for kernels too large for convolve_direct (see
+    max_direct_offsets).
+    """
+    kernel = np.asarray(kernel)
+    if not has_ndimage or np.iscomplexobj(kernel):
+        return 'fft'
+
+    npix = float(np.prod(arrayshape))
+    weighted = interpolate_nan or ignore_edge_zeros
+    npasses = 2 if weighted else 1
+
+    costs = {}
+    padshape = padded_shape(arrayshape, kernel.shape, fft_pad=fft_pad,
+            psf_pad=True)
+    fftsize = float(np.prod(padshape))
+    ntransforms = 4 if (interpolate_nan and has_nans) else 2
+    costs['fft'] = fft_cost * ntransforms * fftsize * np.log2(max(fftsize,2))
+
+    if direct_offsets(arrayshape, kernel) <= max_direct_offsets:
+        costs['direct'] = direct_cost * npasses * npix * kernel.size
+
+    if separable is None:
+        separable = separable_factors(kernel)
+    if separable:
+        costs['separable'] = npasses * npix * (direct_cost*sum(kernel.shape)
+                + pass_cost*kernel.ndim)
+
+    return min(costs, key=costs.get)
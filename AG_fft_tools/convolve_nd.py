@@ -4,44 +4,19 @@ ND fft convolution with NaN masking:
 """
 import numpy as np
 import warnings
+import threading
 #from guppy import hpy
 #heapy = hpy()
 
-try:
-    import fftw3
-    has_fftw = True
-
-    def fftwn(array, nthreads=1):
-        array = array.astype('complex').copy()
-        outarray = array.copy()
-        fft_forward = fftw3.Plan(array, outarray, direction='forward',
-                flags=['estimate'], nthreads=nthreads)
-        fft_forward.execute()
-        return outarray
-
-    def ifftwn(array, nthreads=1):
-        array = array.astype('complex').copy()
-        outarray = array.copy()
-        fft_backward = fftw3.Plan(array, outarray, direction='backward',
-                flags=['estimate'], nthreads=nthreads)
-        fft_backward.execute()
-        return outarray / np.size(array)
-except ImportError:
-    fftn = np.fft.fftn
-    ifftn = np.fft.ifftn
-    has_fftw = False
-# I performed some fft speed tests and found that scipy is slower than numpy
-# http://code.google.com/p/agpy/source/browse/trunk/tests/test_ffts.py However,
-# the speed varied on machines - YMMV.  If someone finds that scipy's fft is
-# faster, we should add that as an option here... not sure how exactly
+from fast_ffts import get_ffts, next_fast_len, run_in_threads, split_threads
 
 
 def convolvend(array, kernel, boundary='fill', fill_value=0,
         crop=True, return_fft=False, fftshift=True, fft_pad=True,
         psf_pad=False, interpolate_nan=False, quiet=False,
         ignore_edge_zeros=False, min_wt=0.0, normalize_kernel=False,
-        use_numpy_fft=not has_fftw, nthreads=1, complextype=np.complex128,
-        use_rfft=False):
+        use_numpy_fft=False, nthreads=1, complextype=np.complex128,
+        use_rfft=None, fft_backend=None, dtype=None):
     """
     Convolve an ndarray with an nd-kernel.  Returns a convolved image with shape =
     array.shape.  Assumes image & kernel are centered.
@@ -85,8 +60,11 @@ def convolvend(array, kernel, boundary='fill', fill_value=0,
 
     Advanced options
     ----------------
-    fft_pad: bool
-        Default on.  Zero-pad image to the nearest 2^n
+    fft_pad: bool or str
+        Default on.  Zero-pad image to the nearest 2^n.  'fast' instead pads
+        each axis to the next 5-smooth length (2^a 3^b 5^c), which is nearly
+        as fast to transform and uses far less memory for awkward sizes.
+        See `padded_shape`.
     psf_pad: bool
         Default off.  Zero-pad image to be at least the sum of the image sizes
         (in order to avoid edge-wrapping when smoothing)
@@ -102,11 +80,29 @@ def convolvend(array, kernel, boundary='fill', fill_value=0,
     fftshift: bool
         If return_fft on, will shift & crop image to appropriate dimensions
     nthreads: int
-        if fftw3 is installed, can specify the number of threads to allow FFTs
-        to use.  Probably only helpful for large arrays
+        Total number of threads to use.  The independent transforms (the
+        array, the kernel, and the weights if `interpolate_nan` or
+        `ignore_edge_zeros` is set) run concurrently, and any remaining
+        threads are given to each transform if the FFT backend is
+        multithreaded (fftw3, pyfftw, scipy).  Probably only helpful for
+        large arrays
     use_numpy_fft: bool
-        Force the code to use the numpy FFTs instead of FFTW even if FFTW is
-        installed
+        Force the code to use the numpy FFTs instead of the default backend
+    fft_backend: str
+        Name of the FFT backend to use ('numpy', 'scipy', 'pyfftw', 'fftw3',
+        or 'auto').  Defaults to the process-wide setting; see
+        `fast_ffts.set_backend`
+    use_rfft: bool or None
+        Use real-to-complex FFTs, which need half the memory and time of
+        complex FFTs.  The default (None) uses them whenever the array and
+        kernel are both real and `return_fft` is not set.
+    dtype: `numpy.dtype`
+        Working precision of the FFTs, e.g. np.float32 to halve the memory
+        use again.  Default is float64 (complex128 spectra).  numpy's FFTs
+        always compute in double precision; use the scipy or pyfftw backends
+        to get the full benefit of single precision.
+    complextype: `numpy.dtype`
+        Type of the complex arrays if `dtype` is not specified
 
     Returns
     -------
@@ -147,217 +143,395 @@ def convolvend(array, kernel, boundary='fill', fill_value=0,
 
     #print "Memory usage: ",heapy.heap().size/1024.**3
 
+    convolver = PreparedConvolver(kernel, np.shape(array), boundary=boundary,
+            fill_value=fill_value, fft_pad=fft_pad, psf_pad=psf_pad,
+            normalize_kernel=normalize_kernel, use_numpy_fft=use_numpy_fft,
+            nthreads=nthreads, complextype=complextype, use_rfft=use_rfft,
+            fft_backend=fft_backend, dtype=dtype)
 
-    # Checking copied from convolve.py - however, since FFTs have real &
-    # complex components, we change the types.  Only the real part will be
-    # returned!
-    # Check that the arguments are lists or Numpy arrays
-    array = np.asarray(array, dtype=np.complex)
-    kernel = np.asarray(kernel, dtype=np.complex)
-
-    # Check that the number of dimensions is compatible
-    if array.ndim != kernel.ndim:
-        raise Exception('array and kernel have differing number of'
-                        'dimensions')
-
-    # store the dtype for conversion back later
-    array_dtype = array.dtype
-    # turn the arrays into 'complex' arrays
-    if array.dtype.kind != 'c':
-        array = array.astype(np.complex)
-    if kernel.dtype.kind != 'c':
-        kernel = kernel.astype(np.complex)
-
-    # mask catching - masks must be turned into NaNs for use later
-    if np.ma.is_masked(array):
-        mask = array.mask
-        array = np.array(array)
-        array[mask] = np.nan
-    if np.ma.is_masked(kernel):
-        mask = kernel.mask
-        kernel = np.array(kernel)
-        kernel[mask] = np.nan
-
-    # replace fftn if has_fftw so that nthreads can be passed
-    global fftn, ifftn
-    if use_rfft:
-        fftn = np.fft.rfftn
-        ifftn = np.fft.irfftn
-    elif has_fftw and not use_numpy_fft:
-        def fftn(*args, **kwargs):
-            return fftwn(*args, nthreads=nthreads, **kwargs)
-
-        def ifftn(*args, **kwargs):
-            return ifftwn(*args, nthreads=nthreads, **kwargs)
-    elif use_numpy_fft:
-        fftn = np.fft.fftn
-        ifftn = np.fft.ifftn
-
-
-    # NAN catching
-    nanmaskarray = np.isnan(array)
-    array[nanmaskarray] = 0
-    nanmaskkernel = np.isnan(kernel)
-    kernel[nanmaskkernel] = 0
-    if ((nanmaskarray.sum() > 0 or nanmaskkernel.sum() > 0) and not interpolate_nan
-            and not quiet):
-        warnings.warn("NOT ignoring nan values even though they are present" +
-                " (they are treated as 0)")
-
-    if normalize_kernel is True:
-        kernel = kernel / kernel.sum()
-        kernel_is_normalized = True
-    elif normalize_kernel:
-        # try this.  If a function is not passed, the code will just crash... I
-        # think type checking would be better but PEPs say otherwise...
-        kernel = kernel / normalize_kernel(kernel)
-        kernel_is_normalized = True
-    else:
-        if np.abs(kernel.sum() - 1) < 1e-8:
-            kernel_is_normalized = True
-        else:
-            kernel_is_normalized = False
-            if (interpolate_nan or ignore_edge_zeros):
-                WARNING = ("Kernel is not normalized, therefore ignore_edge_zeros"+
-                    "and interpolate_nan will be ignored.")
-                log.warn(WARNING)
-
-    if boundary is None:
-        WARNING = ("The convolvend version of boundary=None is equivalent" +
-                " to the convolve boundary='fill'.  There is no FFT " +
-                " equivalent to convolve's zero-if-kernel-leaves-boundary" )
-        warnings.warn(WARNING)
-        psf_pad = True
-    elif boundary == 'fill':
-        # create a boundary region at least as large as the kernel
-        psf_pad = True
-    elif boundary == 'wrap':
-        psf_pad = False
-        fft_pad = False
-        fill_value = 0 # force zero; it should not be used
-    elif boundary == 'extend':
-        raise NotImplementedError("The 'extend' option is not implemented " +
-                "for fft-based convolution")
-
-    arrayshape = array.shape
-    kernshape = kernel.shape
-    if array.ndim != kernel.ndim:
-        raise ValueError("Image and kernel must " +
-            "have same number of dimensions")
-    # find ideal size (power of 2) for fft.
-    # Can add shapes because they are tuples
-    if fft_pad:
-        if psf_pad:
-            # add the dimensions and then take the max (bigger)
-            fsize = 2**np.ceil(np.log2(
-                np.max(np.array(arrayshape) + np.array(kernshape))))
-        else:
-            # add the shape lists (max of a list of length 4) (smaller)
-            # also makes the shapes square
-            fsize = 2**np.ceil(np.log2(np.max(arrayshape+kernshape)))
-        newshape = np.array([fsize for ii in range(array.ndim)])
-    else:
-        if psf_pad:
-            # just add the biggest dimensions
-            newshape = np.array(arrayshape)+np.array(kernshape)
-            # ERROR: this situation leads to crash if kernshape[i] = arrayshape[i]-1 for all i
-        else:
-            newshape = np.array([np.max([imsh, kernsh])
-                for imsh, kernsh in zip(arrayshape, kernshape)])
-
-
-    # separate each dimension by the padding size...  this is to determine the
-    # appropriate slice size to get back to the input dimensions
-    arrayslices = []
-    kernslices = []
-    for ii, (newdimsize, arraydimsize, kerndimsize) in enumerate(zip(newshape, arrayshape, kernshape)):
-        center = newdimsize - (newdimsize+1)//2
-        arrayslices += [slice(center - arraydimsize//2,
-            center + (arraydimsize+1)//2)]
-        kernslices += [slice(center - kerndimsize//2,
-            center + (kerndimsize+1)//2)]
+    return convolver(array, interpolate_nan=interpolate_nan,
+            ignore_edge_zeros=ignore_edge_zeros, min_wt=min_wt, crop=crop,
+            return_fft=return_fft, fftshift=fftshift, quiet=quiet)
 
-    #print "Memory usage (line 269): ",heapy.heap().size/1024.**3
 
+class PreparedConvolver(object):
+    """
+    An FFT convolution with a fixed kernel, array shape, and boundary mode.
 
-    # if no padding is requested, save memory by not copying things
-    if tuple(newshape) == arrayshape:
-        bigarray = array
-    else:
-        bigarray = np.ones(newshape, dtype=complextype) * fill_value
-        bigarray[arrayslices] = array
-
-    if tuple(newshape) == kernshape:
-        bigkernel = kernel
-    else:
-        bigkernel = np.zeros(newshape, dtype=complextype)
-        bigkernel[kernslices] = kernel
-    # need to shift the kernel so that, e.g., [0,0,1,0] -> [1,0,0,0] = unity
-    kernfft = fftn(np.fft.ifftshift(bigkernel))
-
+    The padding layout and the FFT of the padded kernel are computed once
+    and kept, so convolving any number of arrays of shape `arrayshape` costs
+    one forward and one inverse FFT each (plus two more for the weights if
+    `interpolate_nan` is set and the array has NaNs).  `convolvend` is
+    equivalent to building one of these and calling it once.
 
-    # for memory conservation's sake, do this all on one line
-    # it is kept in comments in its multi-line form for clarity
-    # arrayfft = fftn(bigarray)
-    # fftmult = arrayfft*kernfft
-    fftmult = fftn(bigarray)*kernfft
+    The keyword arguments have the same meaning as in `convolvend`;
+    `interpolate_nan`, `ignore_edge_zeros`, `min_wt`, `crop`, `return_fft`
+    and `fftshift` can vary from call to call.
 
-    #print "Memory usage (line 294): ",heapy.heap().size/1024.**3
+    Examples
+    --------
+    >>> conv = PreparedConvolver([1,1,1], (3,), normalize_kernel=True)
+    >>> conv([1,np.nan,3], interpolate_nan=True, ignore_edge_zeros=True)
+    array([ 1.,  2.,  3.])
+    >>> conv([2,np.nan,6], interpolate_nan=True, ignore_edge_zeros=True)
+    array([ 2.,  4.,  6.])
+    """
 
-    if (interpolate_nan or ignore_edge_zeros) and kernel_is_normalized:
+    def __init__(self, kernel, arrayshape, boundary='fill', fill_value=0,
+            fft_pad=True, psf_pad=False, normalize_kernel=False,
+            use_numpy_fft=False, nthreads=1, complextype=np.complex128,
+            use_rfft=None, fft_backend=None, dtype=None):
+
+        if np.ma.isMaskedArray(kernel):
+            kernel = np.ma.filled(kernel.astype(np.result_type(kernel.dtype,
+                np.float32)), np.nan)
+        kernel = np.asarray(kernel)
+        arrayshape = tuple(arrayshape)
+
+        # Check that the number of dimensions is compatible
+        if len(arrayshape) != kernel.ndim:
+            raise Exception('array and kernel have differing number of'
+                            'dimensions')
+
+        if use_rfft and np.iscomplexobj(kernel):
+            raise ValueError("use_rfft requires a real kernel")
+
+        # working precision: float64/complex128 unless told otherwise.  Real
+        # inputs stay real and use the real-to-complex transforms (half the
+        # memory & work); complex inputs use complex FFTs.  Only the real
+        # part will be returned!
+        if dtype is not None:
+            realtype = np.dtype(dtype)
+            if realtype.kind == 'c':
+                realtype = np.dtype(realtype.char.lower())
+            complextype = np.result_type(realtype, np.complex64)
+        else:
+            realtype = np.dtype(np.float64)
+        self.realtype = realtype
+        self.complextype = np.dtype(complextype)
+
+        # NAN catching.  The kernel is (usually) small, so copy it rather
+        # than modifying the input
+        nanmaskkernel = np.isnan(kernel)
+        self.kernel_has_nans = nanmaskkernel.any()
+        kernel = np.array(kernel, dtype=self.complextype
+                if np.iscomplexobj(kernel) else realtype)
+        kernel[nanmaskkernel] = 0
+
+        if normalize_kernel is True:
+            kernel = kernel / kernel.sum()
+            kernel_is_normalized = True
+        elif normalize_kernel:
+            # try this.  If a function is not passed, the code will just crash... I
+            # think type checking would be better but PEPs say otherwise...
+            kernel = kernel / normalize_kernel(kernel)
+            kernel_is_normalized = True
+        else:
+            if np.abs(kernel.sum() - 1) < 1e-8:
+                kernel_is_normalized = True
+            else:
+                kernel_is_normalized = False
+        self.kernel = kernel
+        self.kernel_is_normalized = kernel_is_normalized
+
+        if boundary is None:
+            WARNING = ("The convolvend version of boundary=None is equivalent" +
+                    " to the convolve boundary='fill'.  There is no FFT " +
+                    " equivalent to convolve's zero-if-kernel-leaves-boundary" )
+            warnings.warn(WARNING)
+            psf_pad = True
+        elif boundary == 'fill':
+            # create a boundary region at least as large as the kernel
+            psf_pad = True
+        elif boundary == 'wrap':
+            psf_pad = False
+            fft_pad = False
+            fill_value = 0 # force zero; it should not be used
+        elif boundary == 'extend':
+            raise NotImplementedError("The 'extend' option is not implemented " +
+                    "for fft-based convolution")
+        self.fill_value = fill_value
+
+        kernshape = kernel.shape
+        self.arrayshape = arrayshape
+        newshape = padded_shape(arrayshape, kernshape, fft_pad=fft_pad,
+                psf_pad=psf_pad)
+        self.newshape = newshape
+
+        # separate each dimension by the padding size...  this is to determine the
+        # appropriate slice size to get back to the input dimensions
+        arrayslices = []
+        kernslices = []
+        for ii, (newdimsize, arraydimsize, kerndimsize) in enumerate(zip(newshape, arrayshape, kernshape)):
+            center = newdimsize - (newdimsize+1)//2
+            arrayslices += [slice(center - arraydimsize//2,
+                center + (arraydimsize+1)//2)]
+            kernslices += [slice(center - kerndimsize//2,
+                center + (kerndimsize+1)//2)]
+        self.arrayslices = tuple(arrayslices)
+        self.kernslices = tuple(kernslices)
+
+        self.use_rfft = use_rfft
+        self.nthreads = nthreads
+        self._fft_kwargs = dict(use_numpy_fft=use_numpy_fft, backend=fft_backend)
+        # FFTs of the padded kernel, and weight maps that do not depend on
+        # the data, keyed by whether they are real-to-complex.  The lock
+        # keeps concurrent calls from computing the same kernel FFT twice.
+        self._kernel_ffts = {}
+        self._weight_maps = {}
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the kernel and the kernel FFTs and weight maps cached
+        so far
+        """
+        with self._lock:
+            arrays = ([self.kernel] + list(self._kernel_ffts.values()) +
+                    list(self._weight_maps.values()))
+        return sum(np.asarray(arr).nbytes for arr in arrays)
+
+    def _ffts(self, real, nthreads=None):
+        """
+        fftn, ifftn for the real or complex path; the inverse is always
+        called with the padded shape
+        """
+        if nthreads is None:
+            nthreads = self.nthreads
+        fftn, ifftn = get_ffts(real=real, nthreads=nthreads, **self._fft_kwargs)
+        if real:
+            newshape = self.newshape
+            # the inverse real FFT needs to be told the output shape
+            def inverse(fftarr):
+                return ifftn(fftarr, s=newshape)
+            return fftn, inverse
+        else:
+            return fftn, ifftn
+
+    def kernel_fft(self, real=True, nthreads=None):
+        """
+        The (cached) FFT of the padded, shifted kernel
+        """
+        with self._lock:
+            return self._kernel_fft(real, nthreads)
+
+    def _kernel_fft(self, real, nthreads):
+        if real not in self._kernel_ffts:
+            fftn, ifftn = self._ffts(real, nthreads)
+            worktype = self.realtype if real else self.complextype
+            if self.newshape == self.kernel.shape:
+                bigkernel = self.kernel.astype(worktype)
+            else:
+                bigkernel = np.zeros(self.newshape, dtype=worktype)
+                bigkernel[self.kernslices] = self.kernel
+            # need to shift the kernel so that, e.g., [0,0,1,0] -> [1,0,0,0] = unity
+            self._kernel_ffts[real] = fftn(np.fft.ifftshift(bigkernel)).astype(
+                    self.complextype, copy=False)
+        return self._kernel_ffts[real]
+
+    def _weights(self, nanmaskarray, interpolate_nan, ignore_edge_zeros, real,
+            nthreads=None):
+        """
+        The smoothed weight map, i.e. the fraction of the kernel that fell on
+        non-ignored pixels at each point.  If there are no NaNs to
+        interpolate over, it only depends on the shape, so it is cached.
+        """
+        has_nans = interpolate_nan and nanmaskarray.any()
+        key = (real, bool(ignore_edge_zeros))
+        if not has_nans and key in self._weight_maps:
+            return self._weight_maps[key]
+
+        fftn, ifftn = self._ffts(real, nthreads)
+        # the weight map is real-valued, so it uses the same (real or complex)
+        # transforms as the data
         if ignore_edge_zeros:
-            bigimwt = np.zeros(newshape, dtype=complextype)
+            bigimwt = np.zeros(self.newshape, dtype=self.realtype)
         else:
-            bigimwt = np.ones(newshape, dtype=complextype)
-        bigimwt[arrayslices] = 1.0-nanmaskarray*interpolate_nan
-        wtfft = fftn(bigimwt)
+            bigimwt = np.ones(self.newshape, dtype=self.realtype)
+        bigimwt[self.arrayslices] = 1.0-nanmaskarray*interpolate_nan
+        wtfft = fftn(bigimwt).astype(self.complextype, copy=False)
         # I think this one HAS to be normalized (i.e., the weights can't be
         # computed with a non-normalized kernel)
-        wtfftmult = wtfft*kernfft/kernel.sum()
-        wtsm = ifftn(wtfftmult)
+        wtfft *= self.kernel_fft(real, nthreads)
+        wtfft /= self.kernel.sum()
+        wtsm = ifftn(wtfft)
+        del wtfft
         # need to re-zero weights outside of the image (if it is padded, we
         # still don't weight those regions)
-        bigimwt[arrayslices] = wtsm.real[arrayslices]
+        bigimwt[self.arrayslices] = wtsm.real[self.arrayslices]
+        del wtsm
         # curiously, at the floating-point limit, can get slightly negative numbers
         # they break the min_wt=0 "flag" and must therefore be removed
         bigimwt[bigimwt<0] = 0
-    else:
-        bigimwt = 1
-
-
-    if np.isnan(fftmult).any():
-        # this check should be unnecessary; call it an insanity check
-        raise ValueError("Encountered NaNs in convolve.  This is disallowed.")
-
-    # restore nans in original image (they were modified inplace earlier)
-    # We don't have to worry about masked arrays - if input was masked, it was
-    # copied
-    array[nanmaskarray] = np.nan
-    kernel[nanmaskkernel] = np.nan
 
-    if return_fft:
-        if fftshift: # default on
-            if crop:
-                return np.fft.fftshift(fftmult)[arrayslices]
+        if not has_nans:
+            self._weight_maps[key] = bigimwt
+        return bigimwt
+
+    def __call__(self, array, interpolate_nan=False, ignore_edge_zeros=False,
+            min_wt=0.0, crop=True, return_fft=False, fftshift=True,
+            quiet=False):
+        """
+        Convolve `array` (which must have shape `arrayshape`) with the kernel.
+        See `convolvend` for the meaning of the keywords.
+        """
+        if np.ma.isMaskedArray(array):
+            array = np.ma.filled(array.astype(np.result_type(array.dtype,
+                np.float32)), np.nan)
+        array = np.asarray(array)
+        if array.shape != self.arrayshape:
+            raise ValueError("Array shape %s does not match the prepared shape "
+                    "%s" % (array.shape, self.arrayshape))
+
+        is_complex = np.iscomplexobj(array) or np.iscomplexobj(self.kernel)
+        real = self.use_rfft
+        if real is None:
+            real = not (is_complex or return_fft)
+        elif real and is_complex:
+            raise ValueError("use_rfft requires real array and kernel")
+        elif real and return_fft:
+            raise ValueError("return_fft returns the full complex FFT, so it "
+                    "cannot be used with use_rfft")
+        worktype = self.realtype if real else self.complextype
+
+        # NAN catching
+        nanmaskarray = np.isnan(array)
+        if ((self.kernel_has_nans or nanmaskarray.any()) and not interpolate_nan
+                and not quiet):
+            warnings.warn("NOT ignoring nan values even though they are present" +
+                    " (they are treated as 0)")
+        if (interpolate_nan or ignore_edge_zeros) and not self.kernel_is_normalized:
+            WARNING = ("Kernel is not normalized, therefore ignore_edge_zeros"+
+                "and interpolate_nan will be ignored.")
+            warnings.warn(WARNING)
+
+        #print "Memory usage (line 269): ",heapy.heap().size/1024.**3
+
+        weighted = ((interpolate_nan or ignore_edge_zeros) and
+                self.kernel_is_normalized and not return_fft)
+
+        # The array, kernel, and weight transforms are independent, so the
+        # ones that aren't cached run at the same time, splitting nthreads
+        # between them
+        need_kernel = real not in self._kernel_ffts
+        need_weights = weighted and ((interpolate_nan and nanmaskarray.any())
+                or (real, bool(ignore_edge_zeros)) not in self._weight_maps)
+        concurrent, fft_threads = split_threads(self.nthreads,
+                1 + need_kernel + need_weights)
+        fftn, ifftn = self._ffts(real, fft_threads)
+
+        def convolve_array():
+            # The padded array is always a new array, so the NaNs can be
+            # zeroed without touching the input
+            bigarray = np.empty(self.newshape, dtype=worktype)
+            bigarray[...] = self.fill_value
+            bigarray[self.arrayslices] = array
+            bigarray[self.arrayslices][nanmaskarray] = 0
+
+            # for memory conservation's sake, do this all on one line
+            # it is kept in comments in its multi-line form for clarity
+            # arrayfft = fftn(bigarray)
+            # fftmult = arrayfft*kernfft
+            fftmult = fftn(bigarray).astype(self.complextype, copy=False)
+            del bigarray
+            fftmult *= self.kernel_fft(real, fft_threads)
+
+            if np.isnan(fftmult).any():
+                # this check should be unnecessary; call it an insanity check
+                raise ValueError("Encountered NaNs in convolve.  This is disallowed.")
+
+            if return_fft:
+                return fftmult
+            return ifftn(fftmult)
+
+        tasks = [convolve_array]
+        if weighted:
+            tasks.append(lambda: self._weights(nanmaskarray, interpolate_nan,
+                ignore_edge_zeros, real, fft_threads))
+        if need_kernel:
+            tasks.append(lambda: self.kernel_fft(real, fft_threads))
+        results = run_in_threads(tasks, concurrent)
+
+        if return_fft:
+            fftmult = results[0]
+            if fftshift: # default on
+                if crop:
+                    return np.fft.fftshift(fftmult)[self.arrayslices]
+                else:
+                    return np.fft.fftshift(fftmult)
             else:
-                return np.fft.fftshift(fftmult)
-        else:
-            return fftmult
+                return fftmult
 
-    if interpolate_nan or ignore_edge_zeros:
-        rifft = (ifftn(fftmult)) / bigimwt
-        if not np.isscalar(bigimwt):
+        rifft = results[0]
+        if weighted:
+            bigimwt = results[1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rifft /= bigimwt
             rifft[bigimwt < min_wt] = np.nan
             if min_wt == 0.0:
                 rifft[bigimwt == 0.0] = 0.0
-    else:
-        rifft = (ifftn(fftmult))
 
-    if crop:
-        result = rifft[arrayslices].real
-        return result
+        if crop:
+            result = rifft[self.arrayslices].real
+            return result
+        else:
+            return rifft.real
+
+
+def padded_shape(arrayshape, kernshape, fft_pad=True, psf_pad=False):
+    """
+    Determine the shape of the array that will be FFT'd when convolving an
+    array of shape `arrayshape` with a kernel of shape `kernshape`
+
+    Parameters
+    ----------
+    fft_pad: bool or str
+        * True or 'pow2' : pad every axis to the same 2^n
+        * 'fast' : pad each axis to the next 5-smooth length (2^a 3^b 5^c),
+          which is nearly as fast to FFT and can be much smaller
+        * False (or None, or any other false value) : no padding beyond
+          what psf_pad requires
+    psf_pad: bool
+        Pad to at least the sum of the array and kernel sizes to avoid
+        edge-wrapping
+
+    Returns
+    -------
+    A tuple of ints
+    """
+    arrayshape = tuple(arrayshape)
+    kernshape = tuple(kernshape)
+    if not fft_pad:
+        fft_pad = False
+    elif fft_pad not in (True, 'pow2', 'fast'):
+        raise ValueError("fft_pad must be True, False, 'pow2', or 'fast'")
+    # Can add shapes because they are tuples
+    if fft_pad == 'fast':
+        if psf_pad:
+            minshape = np.array(arrayshape) + np.array(kernshape)
+        else:
+            minshape = np.maximum(arrayshape, kernshape)
+        newshape = [next_fast_len(n) for n in minshape]
+    # find ideal size (power of 2) for fft.
+    elif fft_pad:
+        if psf_pad:
+            # add the dimensions and then take the max (bigger)
+            fsize = 2**np.ceil(np.log2(
+                np.max(np.array(arrayshape) + np.array(kernshape))))
+        else:
+            # add the shape lists (max of a list of length 4) (smaller)
+            # also makes the shapes square
+            fsize = 2**np.ceil(np.log2(np.max(arrayshape+kernshape)))
+        newshape = [fsize for ii in range(len(arrayshape))]
     else:
-        return rifft.real
+        if psf_pad:
+            # just add the biggest dimensions
+            newshape = np.array(arrayshape)+np.array(kernshape)
+            # ERROR: this situation leads to crash if kernshape[i] = arrayshape[i]-1 for all i
+        else:
+            newshape = np.maximum(arrayshape, kernshape)
+    return tuple(int(n) for n in newshape)
 
 
 import pytest
@@ -12,7 +12,10 @@ def correlate2d(im1,im2, boundary='wrap', **kwargs):
         spectral density
     fftshift - if true, return the shifted psd so that the DC component is in
         the center of the image
-    pad - Default on.  Zero-pad image to the nearest 2^n
+    fft_pad - Default on.  Zero-pad image to the nearest 2^n, or to the
+        nearest 5-smooth length along each axis if fft_pad='fast'.  Ignored
+        with boundary='wrap' (the default): periodic boundaries are never
+        padded
     crop - Default on.  Return an image of the size of the largest input image.
         If the images are asymmetric in opposite directions, will return the largest 
         image in both directions.
@@ -21,6 +24,8 @@ def correlate2d(im1,im2, boundary='wrap', **kwargs):
             * 'fill' : set values outside the array boundary to fill_value
                        (default)
             * 'wrap' : periodic boundary
+    nthreads, fft_backend - passed to convolvend to choose the FFT backend
+        (see fast_ffts.set_backend)
 
     WARNING: Normalization may be arbitrary if you use the PSD
     """
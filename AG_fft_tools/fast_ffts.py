@@ -1,50 +1,417 @@
+"""
+FFT backends
+------------
+`get_ffts` returns a forward and an inverse FFT from one of several
+"backends".  The backend can be chosen per call, process-wide with
+`set_backend`, or with the AGPY_FFT_BACKEND environment variable.  The
+default, 'auto', uses the first available backend in `backend_preference`.
+
+    numpy  - numpy.fft; always available, single-threaded
+    scipy  - scipy.fft (scipy >= 1.4), multi-threaded with workers=nthreads
+    pyfftw - pyfftw.builders, with the built FFTW objects cached by shape
+    fftw3  - the old PyFFTW3 binding, with plans cached by shape
+
+Any backend can be replaced, and new ones added, with `register_backend`.
+
+`run_in_threads` runs independent transforms (e.g. the data and weight
+transforms in convolvend) at the same time; the backends release the GIL
+while transforming.
+"""
 import numpy as np
 import warnings
+import threading
+import sys
+import os
+from collections import OrderedDict
 
 try:
     import fftw3
     has_fftw = True
-
-    def fftwn(array, nthreads=1):
-        array = array.astype('complex').copy()
-        outarray = array.copy()
-        fft_forward = fftw3.Plan(array, outarray, direction='forward',
-                flags=['estimate'], nthreads=nthreads)
-        fft_forward.execute()
-        return outarray
-
-    def ifftwn(array, nthreads=1):
-        array = array.astype('complex').copy()
-        outarray = array.copy()
-        fft_backward = fftw3.Plan(array, outarray, direction='backward',
-                flags=['estimate'], nthreads=nthreads)
-        fft_backward.execute()
-        return outarray / np.size(array)
 except ImportError:
-    fftn = np.fft.fftn
-    ifftn = np.fft.ifftn
     has_fftw = False
+
+try:
+    import pyfftw
+    import pyfftw.builders
+    has_pyfftw = True
+except ImportError:
+    has_pyfftw = False
+
+try:
+    import scipy.fft
+    has_scipy_fft = True
+except ImportError:
+    has_scipy_fft = False
 # I performed some fft speed tests and found that scipy is slower than numpy
 # http://code.google.com/p/agpy/source/browse/trunk/tests/test_ffts.py However,
-# the speed varied on machines - YMMV.  If someone finds that scipy's fft is
-# faster, we should add that as an option here... not sure how exactly
+# the speed varied on machines - YMMV.  The modern scipy.fft is multithreaded
+# and generally faster, so it is preferred over numpy if it exists.
+
+# FFTW plans are expensive to create but cheap to execute, so we keep them
+# around.  Each plan owns its own input & output arrays; a transform copies
+# the data into the input array, executes, and copies the output back out.
+# Keys are (shape, input dtype, direction, nthreads, planner_effort).  Since
+# every plan holds two arrays of its shape, only the plan_cache_size most
+# recently used plans (and as many pyfftw objects) are kept.
+plan_cache_size = 16
+_plan_cache = OrderedDict()
+_plan_cache_lock = threading.Lock()
 
-def get_ffts(nthreads=1, use_numpy_fft=not has_fftw):
+def _cached(cache, key, make):
     """
-    Returns fftn,ifftn using either numpy's fft or fftw
+    Return cache[key], calling make() to create it if necessary, and drop
+    the least recently used entries beyond plan_cache_size.  Must be called
+    with _plan_cache_lock held.
     """
-    if has_fftw and not use_numpy_fft:
-        def fftn(*args, **kwargs):
-            return fftwn(*args, nthreads=nthreads, **kwargs)
-
-        def ifftn(*args, **kwargs):
-            return ifftwn(*args, nthreads=nthreads, **kwargs)
-    elif use_numpy_fft:
-        fftn = np.fft.fftn
-        ifftn = np.fft.ifftn
+    if key in cache:
+        # move to the most-recently-used end
+        value = cache.pop(key)
     else:
-        # yes, this is redundant, but I feel like there could be a third option...
-        fftn = np.fft.fftn
-        ifftn = np.fft.ifftn
+        value = make()
+    cache[key] = value
+    while len(cache) > max(plan_cache_size, 1):
+        cache.popitem(last=False)
+    return value
+
+# 'estimate' is fast to plan; 'measure' (or 'patient', 'exhaustive') takes
+# longer to plan but gives faster transforms.  Measured plans are only worth
+# it if the same shape is transformed many times or wisdom is saved to disk.
+default_planner_effort = os.environ.get('AGPY_FFTW_PLANNER', 'estimate')
+
+# FFTW "wisdom" is loaded from here on import and written with save_wisdom()
+wisdom_file = os.environ.get('AGPY_FFTW_WISDOM',
+                             os.path.join(os.path.expanduser('~'),
+                                          '.agpy_fftw_wisdom'))
+
+def _get_plan(shape, dtype, direction, nthreads=1, planner_effort=None):
+    """
+    Return a cached (plan, inarray, outarray, lock) tuple for a given shape,
+    input dtype, direction, and number of threads, creating it if necessary.
+    (The PyFFTW3 binding only does double precision, so the plan's arrays are
+    always complex128; other inputs are converted as they are copied in.)
+    """
+    if planner_effort is None:
+        planner_effort = default_planner_effort
+    key = (tuple(shape), np.dtype(dtype).str, direction, nthreads,
+           planner_effort)
+    def make():
+        # planning with anything but 'estimate' overwrites the arrays,
+        # so the arrays must be created before the plan
+        inarray = np.zeros(shape, dtype='complex')
+        outarray = np.zeros(shape, dtype='complex')
+        plan = fftw3.Plan(inarray, outarray, direction=direction,
+                flags=[planner_effort], nthreads=nthreads)
+        return (plan, inarray, outarray, threading.Lock())
+    with _plan_cache_lock:
+        return _cached(_plan_cache, key, make)
+
+def clear_plan_cache():
+    """
+    Forget all cached FFTW plans and pyfftw objects (and free their arrays)
+    """
+    with _plan_cache_lock:
+        _plan_cache.clear()
+        _builder_cache.clear()
+
+def load_wisdom(filename=None):
+    """
+    Import FFTW wisdom from *filename* (default: `wisdom_file`).  Returns True
+    if wisdom was loaded.
+    """
+    if filename is None:
+        filename = wisdom_file
+    if not has_fftw or not os.path.exists(filename):
+        return False
+    try:
+        fftw3.import_wisdom_from_file(filename)
+    except Exception as ex:
+        warnings.warn("Could not load FFTW wisdom from %s: %s" % (filename, ex))
+        return False
+    return True
+
+def save_wisdom(filename=None):
+    """
+    Export the accumulated FFTW wisdom to *filename* (default: `wisdom_file`)
+    so that measured plans can be re-created quickly in later sessions
+    """
+    if filename is None:
+        filename = wisdom_file
+    if not has_fftw:
+        raise ImportError("fftw3 is not installed; there is no wisdom to save")
+    fftw3.export_wisdom_to_file(filename)
+
+if has_fftw:
+    load_wisdom()
+
+    def fftwn(array, nthreads=1, planner_effort=None):
+        array = np.asarray(array)
+        plan, inarray, outarray, lock = _get_plan(array.shape, array.dtype,
+                'forward', nthreads=nthreads, planner_effort=planner_effort)
+        with lock:
+            inarray[...] = array
+            plan.execute()
+            return outarray.copy()
+
+    def ifftwn(array, nthreads=1, planner_effort=None):
+        array = np.asarray(array)
+        plan, inarray, outarray, lock = _get_plan(array.shape, array.dtype,
+                'backward', nthreads=nthreads, planner_effort=planner_effort)
+        with lock:
+            inarray[...] = array
+            plan.execute()
+            return outarray / outarray.size
+else:
+    fftn = np.fft.fftn
+    ifftn = np.fft.ifftn
+
+def next_fast_len(target):
+    """
+    Return the smallest 5-smooth number (2**a * 3**b * 5**c) that is >= target.
+    FFTs of these sizes are nearly as fast as powers of 2 but can be much
+    smaller: e.g., a 4100-pixel axis pads to 4320 instead of 8192.
+    (the same as scipy.fftpack.next_fast_len)
+    """
+    target = int(target)
+    if target <= 6:
+        return max(target, 1)
+    if not (target & (target-1)):
+        # already a power of 2
+        return target
+
+    best = 2**((target-1).bit_length())
+    p5 = 1
+    while p5 < target:
+        p35 = p5
+        while p35 < target:
+            # smallest power of 2 such that p2*p35 >= target
+            quotient = -(-target // p35)
+            p2 = 2**((quotient-1).bit_length())
+            candidate = p2 * p35
+            if candidate == target:
+                return candidate
+            elif candidate < best:
+                best = candidate
+            p35 *= 3
+            if p35 == target:
+                return p35
+        if p35 < best:
+            best = p35
+        p5 *= 5
+        if p5 == target:
+            return p5
+    if p5 < best:
+        best = p5
+    return best
+
+def run_in_threads(tasks, concurrent=None):
+    """
+    Call each of `tasks` (functions of no arguments) in threads, at most
+    `concurrent` of them (default: all of them) at a time, and return the
+    list of their results.  The calling thread is one of the workers.  If
+    any task raises an exception, no more tasks are started, and the
+    exception is re-raised here once the running ones have finished.
+
+    Short-lived threads are used rather than a pool so that this is safe to
+    call from code that is itself running in a pool.
+    """
+    results = [None] * len(tasks)
+    errors = []
+    if concurrent is None:
+        concurrent = len(tasks)
+    nworkers = max(min(int(concurrent), len(tasks)), 1)
+    remaining = iter(range(len(tasks)))
+    lock = threading.Lock()
 
-    return fftn,ifftn
+    def work():
+        while not errors:
+            with lock:
+                ii = next(remaining, None)
+            if ii is None:
+                return
+            try:
+                results[ii] = tasks[ii]()
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=work) for ii in range(1, nworkers)]
+    for thread in threads:
+        thread.start()
+    work()
+    for thread in threads:
+        thread.join()
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+    return results
+
+def split_threads(nthreads, ntasks):
+    """
+    Divide `nthreads` between `ntasks` concurrent transforms.  Returns
+    (number of tasks to run at once, threads to give each transform's
+    backend); running the tasks with run_in_threads(tasks, concurrent) then
+    uses at most nthreads threads in total.
+    """
+    nthreads = max(int(nthreads), 1)
+    concurrent = max(min(ntasks, nthreads), 1)
+    return concurrent, max(nthreads // concurrent, 1)
+
+def _fftw3_backend(nthreads=1, planner_effort=None):
+    """
+    The PyFFTW3 binding can only do full complex transforms, so the real
+    transforms (and transforms over a subset of axes) use numpy
+    """
+    def fftn(array, s=None, axes=None):
+        if s is not None or axes is not None:
+            return np.fft.fftn(array, s=s, axes=axes)
+        return fftwn(array, nthreads=nthreads, planner_effort=planner_effort)
+
+    def ifftn(array, s=None, axes=None):
+        if s is not None or axes is not None:
+            return np.fft.ifftn(array, s=s, axes=axes)
+        return ifftwn(array, nthreads=nthreads, planner_effort=planner_effort)
+
+    return dict(fftn=fftn, ifftn=ifftn, rfftn=np.fft.rfftn,
+            irfftn=np.fft.irfftn)
+
+# pyfftw's builders return an FFTW object that owns its arrays; like the
+# fftw3 plans, these are cached (up to plan_cache_size of them) and reused
+_builder_cache = OrderedDict()
+
+def _pyfftw_backend(nthreads=1, planner_effort=None):
+    if planner_effort is None:
+        planner_effort = default_planner_effort
+    flag = 'FFTW_' + planner_effort.upper()
+
+    def wrap(kind):
+        builder = getattr(pyfftw.builders, kind)
+
+        def transform(array, s=None, axes=None):
+            array = np.asarray(array)
+            key = (kind, array.shape, array.dtype.str,
+                   None if s is None else tuple(s),
+                   None if axes is None else tuple(axes),
+                   nthreads, flag)
+            def make():
+                obj = builder(np.empty_like(array), s=s, axes=axes,
+                        threads=nthreads, planner_effort=flag)
+                return (obj, threading.Lock())
+            with _plan_cache_lock:
+                obj, lock = _cached(_builder_cache, key, make)
+            with lock:
+                # the output array belongs to the FFTW object
+                return obj(array).copy()
+        transform.__name__ = kind
+        return transform
+
+    return dict((kind, wrap(kind))
+            for kind in ('fftn', 'ifftn', 'rfftn', 'irfftn'))
+
+def _scipy_backend(nthreads=1, planner_effort=None):
+    def wrap(func):
+        def transform(array, s=None, axes=None):
+            return func(array, s=s, axes=axes, workers=nthreads)
+        transform.__name__ = func.__name__
+        return transform
+    return dict(fftn=wrap(scipy.fft.fftn), ifftn=wrap(scipy.fft.ifftn),
+            rfftn=wrap(scipy.fft.rfftn), irfftn=wrap(scipy.fft.irfftn))
+
+def _numpy_backend(nthreads=1, planner_effort=None):
+    return dict(fftn=np.fft.fftn, ifftn=np.fft.ifftn, rfftn=np.fft.rfftn,
+            irfftn=np.fft.irfftn)
+
+# name -> (factory, available).  factory(nthreads, planner_effort) must
+# return a dict with 'fftn', 'ifftn', 'rfftn' and 'irfftn' functions that
+# follow numpy's (array, s=None, axes=None) calling convention
+_backends = {}
+backend_preference = ['fftw3', 'pyfftw', 'scipy', 'numpy']
+
+def register_backend(name, factory, available=True, preference=None):
+    """
+    Add (or replace) an FFT backend
+
+    name - the name used to select the backend
+    factory - function(nthreads, planner_effort) returning a dict of 'fftn',
+        'ifftn', 'rfftn' and 'irfftn' functions with numpy's calling signature
+    available - whether the backend can be used (e.g., its module imported)
+    preference - position in `backend_preference` used for 'auto' selection.
+        By default, a new backend is tried just before numpy.
+    """
+    _backends[name] = (factory, available)
+    if name not in backend_preference:
+        if preference is None:
+            preference = len(backend_preference)-1
+        backend_preference.insert(preference, name)
+
+register_backend('fftw3', _fftw3_backend, available=has_fftw)
+register_backend('pyfftw', _pyfftw_backend, available=has_pyfftw)
+register_backend('scipy', _scipy_backend, available=has_scipy_fft)
+register_backend('numpy', _numpy_backend, available=True)
+
+_backend = os.environ.get('AGPY_FFT_BACKEND', 'auto')
+
+def available_backends():
+    """
+    List the names of the usable backends, in order of preference
+    """
+    return [name for name in backend_preference
+            if name in _backends and _backends[name][1]]
+
+def _resolve_backend(backend=None):
+    """
+    Turn a backend name (or None, meaning the process-wide default, or
+    'auto') into the name of an available backend
+    """
+    if backend is None:
+        backend = _backend
+    if backend == 'auto':
+        return available_backends()[0]
+    if backend not in _backends:
+        raise ValueError("Unknown FFT backend %s.  Options are %s" %
+                (backend, ", ".join(['auto'] + list(_backends))))
+    if not _backends[backend][1]:
+        fallback = available_backends()[0]
+        warnings.warn("FFT backend %s is not available; using %s instead" %
+                (backend, fallback))
+        return fallback
+    return backend
+
+def set_backend(backend):
+    """
+    Set the process-wide FFT backend used by `get_ffts` (and therefore by
+    convolvend, smooth, correlate2d, PSD2, shift, and upsample_image).  Use
+    'auto' to pick the fastest available backend.
+    """
+    global _backend
+    if backend != 'auto' and backend not in _backends:
+        raise ValueError("Unknown FFT backend %s.  Options are %s" %
+                (backend, ", ".join(['auto'] + list(_backends))))
+    _backend = backend
+
+def get_backend():
+    """
+    Return the name of the backend `get_ffts` will use by default
+    """
+    return _resolve_backend()
+
+def get_ffts(nthreads=1, use_numpy_fft=False, planner_effort=None,
+        backend=None, real=False):
+    """
+    Returns fftn,ifftn using the selected FFT backend
+
+    nthreads - number of threads to allow the FFTs to use (ignored by numpy)
+    use_numpy_fft - force the numpy backend regardless of `backend`
+    planner_effort - FFTW planner flag ('estimate', 'measure', 'patient' or
+        'exhaustive').  Defaults to `default_planner_effort`.
+    backend - name of the backend; defaults to the process-wide setting (see
+        `set_backend`)
+    real - return rfftn,irfftn instead
+    """
+    if use_numpy_fft:
+        backend = 'numpy'
+    factory = _backends[_resolve_backend(backend)][0]
+    transforms = factory(nthreads=nthreads, planner_effort=planner_effort)
+
+    if real:
+        return transforms['rfftn'],transforms['irfftn']
+    else:
+        return transforms['fftn'],transforms['ifftn']
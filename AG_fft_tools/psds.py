@@ -9,7 +9,8 @@ try:
 except ImportError:
     pyplotOK = False
 from correlate2d import correlate2d
-from AG_image_tools.radialprofile import azimuthalAverageBins,radialAverageBins
+from fast_ffts import get_ffts
+from AG_image_tools.radialprofile import azimuthalAverage,azimuthalAverageBins,radialAverageBins
 
 def hanning2d(M, N):
     """
@@ -30,20 +31,129 @@ def power_spectrum(*args,**kwargs):
     kwargs['oned']=True
     return PSD2(*args,**kwargs)
 
+# PSD2 transforms cubes in blocks of planes with at most this many elements,
+# which bounds the memory used for the complex FFTs
+block_elements = 2**20
+
+def _segment_starts(size, segment_size, overlap):
+    """ Start indices of segments of segment_size along an axis of size """
+    step = max(int(segment_size*(1-overlap)), 1)
+    return range(0, size-segment_size+1, step)
+
+def _psd_block(block, block2, fftn, rfftn, real=False, imag=False):
+    """
+    The (fftshifted) PSD of each plane of `block` (or its cross-PSD with
+    `block2`): fft(conj(block)) * fft(ifftshift(block2[::-1,::-1])), the
+    same as correlate2d(plane, plane2, return_fft=True)
+    """
+    axes = (-2,-1)
+    if block2 is None and not (real or imag) and not numpy.iscomplexobj(block):
+        # the kernel FFT differs from fft(block) only by a phase, so the PSD
+        # is just |fft(block)|**2.  For real data, half of it comes from a
+        # real FFT, and the other half from its symmetry P(-k) = P(k)
+        ny,nx = block.shape[-2:]
+        half = rfftn(block, axes=axes)
+        half = half.real**2 + half.imag**2
+        psd = numpy.empty(block.shape)
+        psd[...,:nx//2+1] = half
+        flipy = (-numpy.arange(ny)) % ny
+        psd[...,nx//2+1:] = half[...,flipy,1:(nx+1)//2][...,::-1]
+        return numpy.fft.fftshift(psd, axes=axes)
+
+    fft1 = fftn(numpy.conjugate(block), axes=axes)
+    if block2 is None:
+        block2 = block
+    fft1 *= fftn(numpy.fft.ifftshift(block2[...,::-1,::-1], axes=axes),
+            axes=axes)
+    if real:
+        psd = fft1.real
+    elif imag:
+        psd = fft1.imag
+    else:
+        psd = numpy.abs(fft1)
+    return numpy.fft.fftshift(psd, axes=axes)
+
+def _cube_psd(cube, cube2=None, real=False, imag=False, hanning=False,
+        average=False, segment_size=None, segment_overlap=0.5,
+        block_size=None, nthreads=1, fft_backend=None):
+    """
+    PSD of each plane of a cube (or their average over planes), computed
+    with batched FFTs over blocks of planes.  With segment_size, each plane's
+    PSD is the average of the (hanning-windowed) PSDs of overlapping
+    segment_size x segment_size segments (Welch's method).
+    """
+    fftn,ifftn = get_ffts(nthreads=nthreads, backend=fft_backend)
+    rfftn,irfftn = get_ffts(nthreads=nthreads, backend=fft_backend, real=True)
+    nplanes = cube.shape[0]
+
+    if segment_size is None:
+        psdshape = cube.shape[1:]
+        corners = [(0,0)]
+    else:
+        if numpy.isscalar(segment_size):
+            segment_size = (segment_size, segment_size)
+        psdshape = tuple(min(s,n) for s,n in zip(segment_size, cube.shape[1:]))
+        corners = [(y0,x0)
+                for y0 in _segment_starts(cube.shape[1], psdshape[0], segment_overlap)
+                for x0 in _segment_starts(cube.shape[2], psdshape[1], segment_overlap)]
+        # Welch's method always tapers the segments
+        hanning = True
+    window = hanning2d(*psdshape) if hanning else None
+
+    if block_size is None:
+        block_size = max(block_elements // (int(numpy.prod(psdshape))*len(corners)), 1)
+
+    if average:
+        psd = numpy.zeros(psdshape)
+    else:
+        psd = numpy.empty((nplanes,)+psdshape)
+
+    def prepare(planes):
+        # stack the segments of each plane; NaNs become zero (but not inf's)
+        segs = numpy.array([planes[:,y0:y0+psdshape[0],x0:x0+psdshape[1]]
+            for y0,x0 in corners], dtype=numpy.result_type(planes.dtype, numpy.float64))
+        segs[segs!=segs] = 0
+        if window is not None:
+            segs *= window
+        return segs.reshape((-1,)+psdshape)
+
+    for start in xrange(0, nplanes, block_size):
+        planes = slice(start, min(start+block_size, nplanes))
+        block = prepare(cube[planes])
+        block2 = None if cube2 is None else prepare(cube2[planes])
+        bpsd = _psd_block(block, block2, fftn, rfftn, real=real, imag=imag)
+        # average over the segments of each plane
+        bpsd = bpsd.reshape((len(corners), -1)+psdshape).mean(axis=0)
+        if average:
+            psd += bpsd.sum(axis=0)
+        else:
+            psd[planes] = bpsd
+
+    if average:
+        psd /= nplanes
+    return psd
+
 def PSD2(image, image2=None, oned=False, 
         fft_pad=False, real=False, imag=False,
         binsize=1.0, radbins=1, azbins=1, radial=False, hanning=False, 
-        wavnum_scale=False, twopi_scale=False, **kwargs):
+        wavnum_scale=False, twopi_scale=False, nthreads=1, fft_backend=None,
+        average=False, segment_size=None, segment_overlap=0.5,
+        block_size=None, **kwargs):
     """
     Two-dimensional Power Spectral Density.
     NAN values are treated as zero.
 
+    image - a 2D image, or a cube of images along the last two axes (e.g. a
+        spectral cube).  A cube gives a cube of PSDs, one per plane (or one
+        1D power spectrum per plane if oned is set), unless average is set.
     image2 - can specify a second image if you want to see the cross-power-spectrum instead of the 
         power spectrum.
     oned - return radial profile of 2D PSD (i.e. mean power as a function of spatial frequency)
            freq,zz = PSD2(image); plot(freq,zz) is a power spectrum
-    fft_pad - Add zeros to the edge of the image before FFTing for a speed
-        boost?  (the edge padding will be removed afterwards)
+    fft_pad - Has no effect.  The PSD is computed with periodic boundaries
+        (correlate2d's boundary='wrap'), which are never zero-padded, since
+        padding would change the frequencies the PSD is sampled at.  Kept
+        for backwards compatibility.
     real - Only compute the real part of the PSD (Default is absolute value)
     imag - Only compute the complex part of the PSD (Default is absolute value)
     hanning - Multiply the image to be PSD'd by a 2D Hanning window before performing the FTs.  
@@ -60,36 +170,63 @@ def PSD2(image, image2=None, oned=False,
     radial - An option to return the *azimuthal* power spectrum (i.e., the spectral power as a function 
         of angle).  Not commonly used.
     radbins - number of radial bins (you can compute the azimuthal power spectrum in different annuli)
-    """
-    
-    # prevent modification of input image (i.e., the next two lines of active code)
-    image = image.copy()
-
-    # remove NANs (but not inf's)
-    image[image!=image] = 0
+    nthreads - number of threads for the FFTs (if the backend supports it)
+    fft_backend - FFT backend name (see fast_ffts.set_backend)
+    average - for a cube, return the PSD averaged over the planes (e.g. the
+        channel-averaged PSD of a spectral cube)
+    segment_size - if set, use Welch's method: split each image into
+        segment_size x segment_size segments overlapping by segment_overlap
+        (a fraction), window each with hanning2d, and average their PSDs.
+        This lowers the noise of the PSD at the cost of frequency
+        resolution; the PSD has the shape of a segment.
+    block_size - number of planes of a cube to FFT at once (default: as
+        many as fit in `block_elements`)
 
-    if hanning:
-        image = hanning2d(*image.shape) * image
+    Cubes, and images with segment_size set, are transformed in batches
+    and the radial bins of their profiles are only computed once (see
+    AG_image_tools.radialprofile.RadialProfile).
+    """
+    image = numpy.asarray(image)
+    if image2 is not None:
+        image2 = numpy.asarray(image2)
 
-    if image2 is None:
-        image2 = image
-    else:
-        image2 = image2.copy()
-        image2[image2!=image2] = 0
+    if (image.ndim == 2 and segment_size is None and image2 is not None and
+            image2.shape != image.shape):
+        # images of different sizes: correlate2d takes care of the padding
+        # remove NANs (but not inf's) without modifying the inputs
+        image = numpy.where(image!=image, 0, image)
+        image2 = numpy.where(image2!=image2, 0, image2)
         if hanning:
+            image = hanning2d(*image.shape) * image
             image2 = hanning2d(*image2.shape) * image2
-
-    if real:
-        psd2 = numpy.real( correlate2d(image,image2,return_fft=True,fft_pad=fft_pad) ) 
-    elif imag:
-        psd2 = numpy.imag( correlate2d(image,image2,return_fft=True,fft_pad=fft_pad) ) 
-    else: # default is absolute value
-        psd2 = numpy.abs( correlate2d(image,image2,return_fft=True,fft_pad=fft_pad) ) 
+        fftkwargs = dict(return_fft=True, fft_pad=fft_pad, nthreads=nthreads,
+                fft_backend=fft_backend)
+        psd2 = correlate2d(image,image2,**fftkwargs)
+        if real:
+            psd2 = numpy.real(psd2)
+        elif imag:
+            psd2 = numpy.imag(psd2)
+        else: # default is absolute value
+            psd2 = numpy.abs(psd2)
+    else:
+        # with boundary='wrap', correlate2d never pads, so fft_pad is unused
+        cube = image.reshape((-1,)+image.shape[-2:])
+        if image2 is not None:
+            if image2.shape != image.shape:
+                raise ValueError("image2 must have the same shape as a cube")
+            image2 = image2.reshape(cube.shape)
+        psd2 = _cube_psd(cube, image2, real=real, imag=imag, hanning=hanning,
+                average=average, segment_size=segment_size,
+                segment_overlap=segment_overlap, block_size=block_size,
+                nthreads=nthreads, fft_backend=fft_backend)
+        if not average:
+            psd2 = psd2.reshape(image.shape[:-2]+psd2.shape[-2:])
     # normalization is approximately (numpy.abs(image).sum()*numpy.abs(image2).sum())
 
     if wavnum_scale:
-        wx = numpy.concatenate([ numpy.arange(image.shape[0]/2,dtype='float') , image.shape[0]/2 - numpy.arange(image.shape[0]/2,dtype='float') -1 ]) / (image.shape[0]/2.)
-        wy = numpy.concatenate([ numpy.arange(image.shape[1]/2,dtype='float') , image.shape[1]/2 - numpy.arange(image.shape[1]/2,dtype='float') -1 ]) / (image.shape[1]/2.)
+        shape = psd2.shape[-2:]
+        wx = numpy.concatenate([ numpy.arange(shape[0]/2,dtype='float') , shape[0]/2 - numpy.arange(shape[0]/2,dtype='float') -1 ]) / (shape[0]/2.)
+        wy = numpy.concatenate([ numpy.arange(shape[1]/2,dtype='float') , shape[1]/2 - numpy.arange(shape[1]/2,dtype='float') -1 ]) / (shape[1]/2.)
         wx/=wx.max()
         wy/=wy.max()
         wavnum = numpy.sqrt( numpy.outer(wx,numpy.ones(wx.shape))**2 + numpy.outer(numpy.ones(wy.shape),wx)**2 )
@@ -115,13 +252,23 @@ def pspec(psd2, return_index=True, wavenumber=False, return_stddev=False, azbins
     """
     Create a Power Spectrum (radial profile of a PSD) from a Power Spectral Density image
 
+    psd2 - the PSD image.  With azbins=1, this can also be a cube of PSDs, in
+        which case one power spectrum is returned per plane (the radial bins
+        are only computed once; see AG_image_tools.radialprofile.RadialProfile)
+    azbins - if >1 (or an array of edges), return one power spectrum per
+        azimuthal sector (see AG_image_tools.azimuthalAverageBins)
     return_index - if true, the first return item will be the indexes
     wavenumber - if one dimensional and return_index set, will return a normalized wavenumber instead
     view - Plot the PSD (in logspace)?
     """
     #freq = 1 + numpy.arange( numpy.floor( numpy.sqrt((image.shape[0]/2)**2+(image.shape[1]/2)**2) ) ) 
 
-    azbins,(freq,zz) = azimuthalAverageBins(psd2,azbins=azbins,interpnan=True, binsize=binsize, **kwargs)
+    if numpy.isscalar(azbins) and azbins == 1:
+        freq,zz = azimuthalAverage(psd2,returnradii=True,interpnan=True, binsize=binsize, **kwargs)
+    else:
+        # one row per azimuthal sector
+        azbins,freq,zz = azimuthalAverageBins(psd2,azbins=azbins,interpnan=True, binsize=binsize, **kwargs)
+        zz = numpy.array(zz)
     if len(zz) == 1: zz=zz[0]
     # the "Frequency" is the spatial frequency f = 1/x for the standard numpy fft, which follows the convention
     # A_k =  \sum_{m=0}^{n-1} a_m \exp\left\{-2\pi i{mk \over n}\right\}
@@ -132,7 +279,7 @@ def pspec(psd2, return_index=True, wavenumber=False, return_stddev=False, azbins
 
     if return_index:
         if wavenumber:
-            fftwavenum = (numpy.fft.fftfreq(zz.size*2)[:zz.size])
+            fftwavenum = (numpy.fft.fftfreq(zz.shape[-1]*2)[:zz.shape[-1]])
             return_vals = list((fftwavenum,zz))
             #return_vals = list((len(freq)/freq,zz))
         else:
@@ -140,11 +287,15 @@ def pspec(psd2, return_index=True, wavenumber=False, return_stddev=False, azbins
     else:
         return_vals = list(zz)
     if return_stddev:
-        azbinsS,(freqstd,zzstd) = azimuthalAverageBins(psd2,azbins=azbins,stddev=True,interpnan=True, binsize=binsize, **kwargs)
+        if numpy.isscalar(azbins) and azbins == 1:
+            freqstd,zzstd = azimuthalAverage(psd2,returnradii=True,stddev=True,interpnan=True, binsize=binsize, **kwargs)
+        else:
+            azbinsS,freqstd,zzstd = azimuthalAverageBins(psd2,azbins=azbins,stddev=True,interpnan=True, binsize=binsize, **kwargs)
+            zzstd = numpy.array(zzstd)
         return_vals.append(zzstd)
     
     if view and pyplotOK:
-        pyplot.loglog(freq,zz)
+        pyplot.loglog(freq,numpy.transpose(zz))
         pyplot.xlabel("Spatial Frequency")
         pyplot.ylabel("Spectral Power")
 
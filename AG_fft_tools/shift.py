@@ -1,24 +1,104 @@
 import fast_ffts
 import numpy as np
+import threading
 
-def shift(data, deltax, deltay, phase=0, nthreads=1, use_numpy_fft=False,
-        return_abs=False, return_real=True):
+# The frequency grids only depend on the length of the axis, so they are
+# computed once per (length, real) and kept
+_frequency_cache = {}
+_frequency_cache_lock = threading.Lock()
+
+def shift_frequencies(n, real=False):
     """
-    FFT-based sub-pixel image shift
-    http://www.mathworks.com/matlabcentral/fileexchange/18401-efficient-subpixel-image-registration-by-cross-correlation/content/html/efficient_subpixel_registration.html
+    The (cached) frequencies, in cycles per pixel, of the FFT of an axis of
+    length n, in the order used by shift: 0..ceil(n/2)-1, then -fix(n/2)..-1.
+    If real, the frequencies of the real FFT, 0..n//2.
+    """
+    key = (n, real)
+    with _frequency_cache_lock:
+        if key not in _frequency_cache:
+            if real:
+                freqs = np.arange(n//2+1, dtype='float') / n
+            else:
+                freqs = np.fft.ifftshift(np.linspace(-np.fix(n/2.),np.ceil(n/2.)-1,n)) / n
+            freqs.flags.writeable = False
+            _frequency_cache[key] = freqs
+        return _frequency_cache[key]
 
-    Will turn NaNs into zeros
+def _phase_ramp(deltas, n, real, halved):
+    """
+    exp(-2 pi i delta f) for each delta (rows) and frequency f (columns),
+    computed as one outer product.  For real data, the Nyquist term of an
+    even axis is replaced by its real part, which is what taking the real
+    part of the complex shift does; otherwise the real inverse FFT would
+    see a non-Hermitian array.
+    """
+    ramp = np.exp(-2j*np.pi*np.multiply.outer(deltas,
+        shift_frequencies(n, halved)))
+    if real and n % 2 == 0:
+        ramp[:,n//2] = ramp[:,n//2].real
+    return ramp
+
+def shift_stack(data, deltax, deltay=None, phase=0, nthreads=1,
+        use_numpy_fft=False, return_abs=False, return_real=True,
+        fft_backend=None):
     """
+    FFT-based sub-pixel shift of a stack of spectra or images, each by its
+    own amount, with one batched FFT.
 
-    fftn,ifftn = fast_ffts.get_ffts(nthreads=nthreads, use_numpy_fft=use_numpy_fft)
+    data - array of shape (nstack, nx) (spectra) or (nstack, ny, nx) (images)
+    deltax, deltay - arrays of nstack shifts (or scalars, to shift every
+        array by the same amount).  Leave deltay=None for spectra.
+    phase - phase offset(s) in radians (scalar or one per array)
+
+    The frequency grids are cached per shape and the phase ramps are
+    computed with an outer product, one per axis.  Real data are shifted
+    with real FFTs unless return_real is False (the result is then the same
+    as np.real of the complex shift).  Gives the same results as shift or
+    shift1d on each array.  NaNs are turned into zeros.
+
+    fft_backend - FFT backend name (see fast_ffts.set_backend)
+    """
+    data = np.asarray(data)
+    ndim = 1 if deltay is None else 2
+    if data.ndim != ndim+1:
+        raise ValueError("data must be a stack of %iD arrays" % ndim)
+    nstack = data.shape[0]
+    axes = tuple(range(1, ndim+1))
 
     if np.any(np.isnan(data)):
         data = np.nan_to_num(data)
-    ny,nx = data.shape
-    Nx = np.fft.ifftshift(np.linspace(-np.fix(nx/2),np.ceil(nx/2)-1,nx))
-    Ny = np.fft.ifftshift(np.linspace(-np.fix(ny/2),np.ceil(ny/2)-1,ny))
-    Nx,Ny = np.meshgrid(Nx,Ny)
-    gg = ifftn( fftn(data)* np.exp(1j*2*np.pi*(-deltax*Nx/nx-deltay*Ny/ny)) * np.exp(-1j*phase) )
+
+    deltax = np.broadcast_to(np.asarray(deltax, dtype='float'), (nstack,))
+    deltas = [deltax] if deltay is None else [
+            np.broadcast_to(np.asarray(deltay, dtype='float'), (nstack,)), deltax]
+
+    real = return_real and not np.iscomplexobj(data) and np.all(np.asarray(phase) == 0)
+    fftn,ifftn = fast_ffts.get_ffts(nthreads=nthreads,
+            use_numpy_fft=use_numpy_fft, backend=fft_backend, real=real)
+
+    gg = fftn(data, axes=axes)
+    # the term at the Nyquist frequency of both (even) axes is its own
+    # conjugate, so its ramp is the real part of the whole 2D ramp, not the
+    # product of the real parts of the 1D ramps
+    corner = real and ndim == 2 and data.shape[1] % 2 == 0 and data.shape[2] % 2 == 0
+    if corner:
+        ny,nx = data.shape[1:]
+        cornerterm = gg[:,ny//2,nx//2] * np.cos(np.pi*(deltas[0]+deltas[1]))
+    # multiply by the ramp of each axis in turn; the last axis is the one
+    # that is halved by the real FFT
+    for ii, delta in enumerate(deltas):
+        ramp = _phase_ramp(delta, data.shape[ii+1], real,
+                real and ii == ndim-1)
+        # put the frequencies on axis ii+1 and the stack on axis 0
+        gg *= ramp.reshape((nstack,) + (1,)*ii + (ramp.shape[1],) + (1,)*(ndim-1-ii))
+    if corner:
+        gg[:,ny//2,nx//2] = cornerterm
+    if np.any(np.asarray(phase) != 0):
+        gg *= np.exp(-1j*np.asarray(phase, dtype='float')).reshape((-1,)+(1,)*ndim)
+
+    if real:
+        return ifftn(gg, s=data.shape[1:], axes=axes)
+    gg = ifftn(gg, axes=axes)
     if return_real:
         return np.real(gg)
     elif return_abs:
@@ -26,25 +106,36 @@ def shift(data, deltax, deltay, phase=0, nthreads=1, use_numpy_fft=False,
     else:
         return gg
 
-def shift1d(data, deltax, phase=0, nthreads=1, use_numpy_fft=False,
-        return_abs=False, return_real=True):
+def shift(data, deltax, deltay, phase=0, nthreads=1, use_numpy_fft=False,
+        return_abs=False, return_real=True, fft_backend=None):
     """
     FFT-based sub-pixel image shift
     http://www.mathworks.com/matlabcentral/fileexchange/18401-efficient-subpixel-image-registration-by-cross-correlation/content/html/efficient_subpixel_registration.html
 
     Will turn NaNs into zeros
+
+    fft_backend - FFT backend name (see fast_ffts.set_backend)
+
+    To shift many images, use shift_stack
     """
+    return shift_stack(np.asarray(data)[np.newaxis], deltax, deltay,
+            phase=phase, nthreads=nthreads, use_numpy_fft=use_numpy_fft,
+            return_abs=return_abs, return_real=return_real,
+            fft_backend=fft_backend)[0]
 
-    fftn,ifftn = fast_ffts.get_ffts(nthreads=nthreads, use_numpy_fft=use_numpy_fft)
+def shift1d(data, deltax, phase=0, nthreads=1, use_numpy_fft=False,
+        return_abs=False, return_real=True, fft_backend=None):
+    """
+    FFT-based sub-pixel image shift
+    http://www.mathworks.com/matlabcentral/fileexchange/18401-efficient-subpixel-image-registration-by-cross-correlation/content/html/efficient_subpixel_registration.html
 
-    if np.any(np.isnan(data)):
-        data = np.nan_to_num(data)
-    nx = data.size
-    Nx = np.fft.ifftshift(np.linspace(-np.fix(nx/2),np.ceil(nx/2)-1,nx))
-    gg = ifftn( fftn(data)* np.exp(1j*2*np.pi*(-deltax*Nx/nx)) * np.exp(-1j*phase) )
-    if return_real:
-        return np.real(gg)
-    elif return_abs:
-        return np.abs(gg)
-    else:
-        return gg
+    Will turn NaNs into zeros
+
+    fft_backend - FFT backend name (see fast_ffts.set_backend)
+
+    To shift many spectra, use shift_stack
+    """
+    return shift_stack(np.ravel(data)[np.newaxis], deltax, phase=phase,
+            nthreads=nthreads, use_numpy_fft=use_numpy_fft,
+            return_abs=return_abs, return_real=return_real,
+            fft_backend=fft_backend)[0]
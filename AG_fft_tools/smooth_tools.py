@@ -1,13 +1,125 @@
 import numpy as np
+import threading
+import warnings
+from collections import OrderedDict
 from AG_image_tools.downsample import downsample as downsample_2d
+from AG_image_tools.downsample import downsample_cube
 from convolve_nd import convolvend as convolve
+from convolve_nd import PreparedConvolver
+from convolve_direct import convolve_direct, convolution_method, separable_factors
+import convolve_direct as _convolve_direct
+from convolve_axes import convolve_axes
 from astropy.convolution import convolve as convolve_cy
 
+# smooth() keeps the most recently used PreparedConvolvers, so repeated calls
+# with the same image shape and kernel parameters skip making, padding, and
+# transforming the kernel.  Each one holds the FFT of the padded kernel (and
+# maybe weight maps), as large as the padded image, so at most
+# convolver_cache_size of them and convolver_cache_bytes in all are kept; the
+# oldest are dropped first.  Use clear_convolver_cache() to free them all.
+convolver_cache_size = 4
+convolver_cache_bytes = 256*1024**2
+_convolver_cache = OrderedDict()
+_convolver_cache_lock = threading.Lock()
+
+# convolvend keywords that can change from call to call of a PreparedConvolver
+_call_keywords = ('interpolate_nan', 'ignore_edge_zeros', 'min_wt', 'crop',
+        'return_fft', 'fftshift', 'quiet')
+# convolvend keywords that convolve_direct can reproduce (the others only
+# affect how the FFTs are done, or require the FFT)
+_direct_keywords = ('interpolate_nan', 'ignore_edge_zeros', 'min_wt', 'quiet',
+        'fill_value', 'boundary', 'fft_pad', 'nthreads', 'use_numpy_fft',
+        'fft_backend', 'dtype', 'use_rfft', 'complextype')
+# smooth keywords that smooth_planes accepts (its own and convolve_axes')
+_plane_keywords = ('kernelwidth', 'kerneltype', 'trapslope', 'silent',
+        'interpolate_nan', 'nwidths', 'min_nwidths', 'return_kernel',
+        'normalize_kernel', 'downsample', 'downsample_factor',
+        'ignore_edge_zeros', 'boundary', 'fill_value', 'min_wt', 'fft_pad',
+        'psf_pad', 'nthreads', 'use_numpy_fft', 'fft_backend', 'dtype',
+        'quiet', 'block_size')
+
+def clear_convolver_cache():
+    """
+    Forget all of the PreparedConvolvers cached by `smooth`
+    """
+    with _convolver_cache_lock:
+        _convolver_cache.clear()
+
+def _trim_convolver_cache():
+    """
+    Drop the least recently used convolvers until at most
+    convolver_cache_size of them, holding at most convolver_cache_bytes,
+    are left
+    """
+    with _convolver_cache_lock:
+        nbytes = sum(conv.nbytes for conv in _convolver_cache.values())
+        while _convolver_cache and (len(_convolver_cache) > convolver_cache_size
+                or nbytes > convolver_cache_bytes):
+            nbytes -= _convolver_cache.popitem(last=False)[1].nbytes
+
+def kernel_shape(image_shape, kernelwidth=3, nwidths='max', min_nwidths=6):
+    """
+    The (even-sized) shape of the kernel `smooth` uses for an image of shape
+    `image_shape`.  See `smooth` for the parameters.
+    """
+    if (kernelwidth*min_nwidths > image_shape[0] or kernelwidth*min_nwidths > image_shape[1]):
+        nwidths = min_nwidths
+    if (nwidths!='max'):# and kernelwidth*nwidths < image.shape[0] and kernelwidth*nwidths < image.shape[1]):
+        dimsize = int(np.ceil(kernelwidth*nwidths))
+        dimsize += dimsize % 2
+        szY,szX = dimsize,dimsize
+    else:
+        szY,szX = image_shape[:2]
+        szY += szY % 2
+        szX += szX % 2
+    return (szY,szX)
+
+def get_convolver(image_shape, kernelwidth=3, kerneltype='gaussian',
+        trapslope=None, psf_pad=True, nwidths='max', min_nwidths=6,
+        normalize_kernel=np.sum, **kwargs):
+    """
+    Return a PreparedConvolver that smooths images of shape `image_shape`
+    with the kernel `smooth` would use.  The most recent convolvers are
+    cached, up to `convolver_cache_size` of them and `convolver_cache_bytes`
+    in all (see clear_convolver_cache).  See `smooth` for the parameters;
+    extra kwargs are passed to PreparedConvolver.
+    """
+    image_shape = tuple(image_shape)
+    key = (image_shape, kernelwidth, kerneltype, trapslope, psf_pad,
+            nwidths, min_nwidths, normalize_kernel,
+            tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        # something unhashable was passed in; don't cache
+        key = None
+
+    with _convolver_cache_lock:
+        if key is not None and key in _convolver_cache:
+            # move to the most-recently-used end
+            convolver = _convolver_cache.pop(key)
+            _convolver_cache[key] = convolver
+            return convolver
+
+    shape = kernel_shape(image_shape, kernelwidth=kernelwidth,
+            nwidths=nwidths, min_nwidths=min_nwidths)
+    kernel = make_kernel(shape, kernelwidth=kernelwidth, kerneltype=kerneltype,
+            normalize_kernel=normalize_kernel, trapslope=trapslope)
+    # No need to normalize - normalization is dealt with in this code
+    convolver = PreparedConvolver(kernel, image_shape, psf_pad=psf_pad,
+            normalize_kernel=False, **kwargs)
+
+    if key is not None and convolver_cache_size > 0:
+        with _convolver_cache_lock:
+            _convolver_cache[key] = convolver
+        _trim_convolver_cache()
+    return convolver
+
 def smooth(image, kernelwidth=3, kerneltype='gaussian', trapslope=None,
         silent=True, psf_pad=True, interpolate_nan=False, nwidths='max',
         min_nwidths=6, return_kernel=False, normalize_kernel=np.sum,
         downsample=False, downsample_factor=None, ignore_edge_zeros=False,
-        use_fft=True,
+        use_fft=True, method='auto',
         **kwargs):
     """
     Returns a smoothed image using a gaussian, boxcar, or tophat kernel
@@ -57,45 +169,99 @@ def smooth(image, kernelwidth=3, kerneltype='gaussian', trapslope=None,
         the kernel area on the edges but will not re-normalize the kernel.
         This parameter may result in 'edge-brightening' effects if you're using
         a normalized kernel
+    method: ['auto']
+        How to do the convolution if use_fft is set:
+            'fft' : FFT convolution (see convolve)
+            'direct' : real-space convolution (see convolve_direct)
+            'separable' : one 1D real-space convolution per axis; only for
+                separable kernels like the gaussian and boxcar
+            'auto' : whichever of these convolution_method estimates is
+                fastest.  Small kernels will use the real-space methods.
+        All give the same results, including interpolate_nan,
+        ignore_edge_zeros, and min_wt.  The real-space methods require
+        scipy.ndimage and boundary='fill'.  'direct' falls back to 'fft'
+        (with a warning) if the kernel is too large for it, as the default
+        image-sized kernels (nwidths='max') usually are.
+    use_fft: [True]
+        If False, use astropy's convolve instead
 
     Note that the kernel is forced to be even sized on each axis to assure no
     offset when smoothing.
     """
 
-    if (kernelwidth*min_nwidths > image.shape[0] or kernelwidth*min_nwidths > image.shape[1]):
-        nwidths = min_nwidths
-    if (nwidths!='max'):# and kernelwidth*nwidths < image.shape[0] and kernelwidth*nwidths < image.shape[1]):
-        dimsize = np.ceil(kernelwidth*nwidths)
-        dimsize += dimsize % 2
-        yy,xx = np.indices([dimsize,dimsize])
-        szY,szX = dimsize,dimsize
-    else:
-        szY,szX = image.shape
-        szY += szY % 2
-        szX += szX % 2
-        yy,xx = np.indices([szY,szX])
-    shape = (szY,szX)
-    if not silent: print "Kernel size set to ",shape
-
-    kernel = make_kernel(shape, kernelwidth=kernelwidth, kerneltype=kerneltype,
-            normalize_kernel=normalize_kernel, trapslope=trapslope)
-
-    if not silent: print "Kernel of type %s normalized with %s has peak %g" % (kerneltype, normalize_kernel, kernel.max())
-
-    bad = (image != image)
-    temp = image.copy() # to preserve NaN values
-    # convolve does this already temp[bad] = 0
-
     # kwargs parsing to avoid duplicate keyword passing
     #if not kwargs.has_key('ignore_edge_zeros'): kwargs['ignore_edge_zeros']=True
     if not kwargs.has_key('interpolate_nan'): kwargs['interpolate_nan']=interpolate_nan
 
+    bad = (image != image)
+
     if use_fft:
-        # No need to normalize - normalization is dealt with in this code
-        temp = convolve(temp,kernel,psf_pad=psf_pad, normalize_kernel=False,
-                ignore_edge_zeros=ignore_edge_zeros, **kwargs)
+        # The kernel, padding, and kernel FFT are reused from previous calls
+        # with the same image shape and kernel parameters
+        prepare_kwargs = dict((k,v) for k,v in kwargs.items()
+                if k not in _call_keywords)
+        call_kwargs = dict((k,v) for k,v in kwargs.items()
+                if k in _call_keywords)
+        convolver = get_convolver(image.shape, kernelwidth=kernelwidth,
+                kerneltype=kerneltype, trapslope=trapslope, psf_pad=psf_pad,
+                nwidths=nwidths, min_nwidths=min_nwidths,
+                normalize_kernel=normalize_kernel, **prepare_kwargs)
+        kernel = convolver.kernel.copy() if return_kernel else convolver.kernel
+        if not silent: print "Kernel size set to ",kernel.shape
+
+        direct_ok = (kwargs.get('boundary','fill') in ('fill',None) and
+                all(k in _direct_keywords for k in kwargs))
+        if method == 'auto':
+            factors = separable_factors(kernel)
+            if direct_ok:
+                method = convolution_method(image.shape, kernel,
+                        interpolate_nan=kwargs['interpolate_nan'],
+                        ignore_edge_zeros=ignore_edge_zeros,
+                        has_nans=bad.any(), fft_pad=kwargs.get('fft_pad',True),
+                        separable=factors if factors is not None else False)
+            else:
+                method = 'fft'
+        elif method in ('direct','separable'):
+            if not direct_ok:
+                raise ValueError("method='%s' requires boundary='fill' and "
+                        "cannot be used with %s" % (method,
+                            [k for k in kwargs if k not in _direct_keywords]))
+            factors = separable_factors(kernel) if method == 'separable' else False
+            if method == 'separable' and factors is None:
+                raise ValueError("The %s kernel is not separable" % kerneltype)
+            if (method == 'direct' and _convolve_direct.direct_offsets(
+                    image.shape, kernel) > _convolve_direct.max_direct_offsets):
+                warnings.warn("The %s kernel is too large for method='direct'; "
+                        "using method='fft' (use a smaller nwidths to smooth "
+                        "in real space)" % (kernel.shape,))
+                method = 'fft'
+        elif method != 'fft':
+            raise ValueError("method must be 'auto', 'fft', 'direct', or 'separable'")
+        if not silent: print "Convolving with method %s" % method
+
+        if method == 'fft':
+            temp = convolver(image, ignore_edge_zeros=ignore_edge_zeros,
+                    **call_kwargs)
+            # the convolver has only now transformed the kernel
+            _trim_convolver_cache()
+        else:
+            temp = convolve_direct(image, kernel,
+                    separable=factors if method == 'separable' else False,
+                    fill_value=kwargs.get('fill_value',0),
+                    ignore_edge_zeros=ignore_edge_zeros,
+                    **dict((k,v) for k,v in call_kwargs.items()
+                        if k in _direct_keywords))
     else:
-        temp = convolve_cy(temp,kernel, **kwargs)
+        shape = kernel_shape(image.shape, kernelwidth=kernelwidth,
+                nwidths=nwidths, min_nwidths=min_nwidths)
+        if not silent: print "Kernel size set to ",shape
+        kernel = make_kernel(shape, kernelwidth=kernelwidth,
+                kerneltype=kerneltype, normalize_kernel=normalize_kernel,
+                trapslope=trapslope)
+        temp = convolve_cy(image,kernel, **kwargs)
+
+    if not silent: print "Kernel of type %s normalized with %s has peak %g" % (kerneltype, normalize_kernel, kernel.max())
+
     if interpolate_nan is False: temp[bad] = image[bad]
 
     if temp.shape != image.shape:
@@ -109,6 +275,55 @@ def smooth(image, kernelwidth=3, kerneltype='gaussian', trapslope=None,
         if return_kernel: return temp,kernel
         else: return temp
 
+def smooth_planes(cube, cubedim=0, kernelwidth=3, kerneltype='gaussian',
+        trapslope=None, silent=True, interpolate_nan=False, nwidths='max',
+        min_nwidths=6, return_kernel=False, normalize_kernel=np.sum,
+        downsample=False, downsample_factor=None, ignore_edge_zeros=False,
+        **kwargs):
+    """
+    Smooth every plane of a 3D cube with the kernel `smooth` would use, with
+    one batched FFT over all of the planes (see `convolve_axes`) instead of
+    one call to `smooth` per plane.  Gives the same result as
+    array([smooth(plane, ...) for plane in cube]).
+
+    Parameters
+    ----------
+    cubedim: int
+        The axis that is *not* smoothed (e.g. the spectral axis)
+    downsample: bool
+        Downsample each plane by downsample_factor (default: kernelwidth)
+        after smoothing, as in `smooth`
+    kwargs are passed to `convolve_axes` (e.g. boundary, fill_value, min_wt,
+    fft_pad, nthreads, fft_backend, dtype).  See `smooth` for the others.
+    """
+    cube = np.asarray(cube)
+    if cube.ndim != 3:
+        raise ValueError("smooth_planes requires a 3D cube")
+    planeaxes = tuple(ax for ax in range(3) if ax != cubedim % 3)
+    planeshape = tuple(cube.shape[ax] for ax in planeaxes)
+
+    shape = kernel_shape(planeshape, kernelwidth=kernelwidth,
+            nwidths=nwidths, min_nwidths=min_nwidths)
+    if not silent: print "Kernel size set to ",shape
+    kernel = make_kernel(shape, kernelwidth=kernelwidth,
+            kerneltype=kerneltype, normalize_kernel=normalize_kernel,
+            trapslope=trapslope)
+
+    bad = (cube != cube)
+    temp = convolve_axes(cube, kernel, axes=planeaxes,
+            interpolate_nan=interpolate_nan,
+            ignore_edge_zeros=ignore_edge_zeros, **kwargs)
+
+    if interpolate_nan is False: temp[bad] = cube[bad]
+
+    if downsample:
+        if downsample_factor is None: downsample_factor = kernelwidth
+        temp = downsample_cube(temp, downsample_factor, ignoredim=cubedim % 3)
+        if return_kernel: kernel = downsample_2d(kernel,downsample_factor)
+
+    if return_kernel: return temp,kernel
+    else: return temp
+
 def make_kernel(kernelshape, kernelwidth=3, kerneltype='gaussian',
         trapslope=None, normalize_kernel=np.sum, force_odd=False):
     """
@@ -1,7 +1,9 @@
 import fast_ffts
 import warnings
 import numpy as np
+import threading
 import shift
+from collections import OrderedDict
 
 def dftups(inp,nor=None,noc=None,usfac=1,roff=0,coff=0):
     """
@@ -30,31 +32,79 @@ def dftups(inp,nor=None,noc=None,usfac=1,roff=0,coff=0):
     It achieves this result by computing the DFT in the output array without
     the need to zeropad. Much faster and memory efficient than the
     zero-padded FFT approach if [nor noc] are much smaller than [nr*usfac nc*usfac]
-    """
-    # this function is translated from matlab, so I'm just going to pretend
-    # it is matlab/pylab
-    from numpy.fft import ifftshift
-    from numpy import pi,newaxis,floor
 
+    The kernels depend only on the input shape, usfac and the output size,
+    so they are cached (see dftups_kernels) and the offsets are applied as
+    phase factors on the input.
+    """
     nr,nc=np.shape(inp);
     # Set defaults
     if noc is None: noc=nc;
     if nor is None: nor=nr;
     # Compute kernels and obtain DFT by matrix products
-    kernc=np.exp((-1j*2*pi/(nc*usfac))*( ifftshift(np.arange(nc) - floor(nc/2)).T[:,newaxis] )*( np.arange(noc) - coff  )[newaxis,:]);
-    kernr=np.exp((-1j*2*pi/(nr*usfac))*( np.arange(nor).T - roff )[:,newaxis]*( ifftshift(np.arange(nr)) - floor(nr/2) )[newaxis,:]);
+    kernr,kernc,freqr,freqc = dftups_kernels((nr,nc), usfac, nor, noc)
     #kernc=exp((-i*2*pi/(nc*usfac))*( ifftshift([0:nc-1]).' - floor(nc/2) )*( [0:noc-1] - coff ));
     #kernr=exp((-i*2*pi/(nr*usfac))*( [0:nor-1].' - roff )*( ifftshift([0:nr-1]) - floor(nr/2)  ));
+    # the -roff and -coff terms of the kernel exponents
+    if roff != 0 or coff != 0:
+        inp = (inp * np.exp((1j*2*np.pi*roff/(nr*usfac))*freqr)[:,np.newaxis]
+                   * np.exp((1j*2*np.pi*coff/(nc*usfac))*freqc)[np.newaxis,:])
     out=np.dot(np.dot(kernr,inp),kernc);
     #return np.roll(np.roll(out,-1,axis=0),-1,axis=1)
     return out 
 
+# most recently used dftups kernels, keyed by (shape, usfac, nor, noc)
+kernel_cache_size = 16
+_kernel_cache = OrderedDict()
+_kernel_cache_lock = threading.Lock()
+
+def dftups_kernels(shape, usfac=1, nor=None, noc=None):
+    """
+    Return the (cached) row and column kernels of dftups for an input of
+    shape `shape` with zero offsets, kernr (nor x nr) and kernc (nc x noc),
+    and the row and column frequencies they are computed from.  The most
+    recent `kernel_cache_size` sets of kernels are kept.
+    """
+    # this function is translated from matlab, so I'm just going to pretend
+    # it is matlab/pylab
+    from numpy.fft import ifftshift
+    from numpy import pi,newaxis,floor
+
+    nr,nc = shape
+    if noc is None: noc=nc;
+    if nor is None: nor=nr;
+    key = (nr, nc, usfac, int(nor), int(noc))
+    with _kernel_cache_lock:
+        if key in _kernel_cache:
+            kernels = _kernel_cache.pop(key)
+            _kernel_cache[key] = kernels
+            return kernels
+
+    freqc = ifftshift(np.arange(nc) - floor(nc/2))
+    freqr = ifftshift(np.arange(nr)) - floor(nr/2)
+    kernc=np.exp((-1j*2*pi/(nc*usfac))*( freqc.T[:,newaxis] )*( np.arange(int(noc)) )[newaxis,:]);
+    kernr=np.exp((-1j*2*pi/(nr*usfac))*( np.arange(int(nor)).T )[:,newaxis]*( freqr )[newaxis,:]);
+    kernels = (kernr, kernc, freqr, freqc)
+    for arr in kernels:
+        arr.flags.writeable = False
+
+    if kernel_cache_size > 0:
+        with _kernel_cache_lock:
+            _kernel_cache[key] = kernels
+            while len(_kernel_cache) > kernel_cache_size:
+                _kernel_cache.popitem(last=False)
+
+    return kernels
+
 def upsample_image(image, upsample_factor=1, output_size=None, nthreads=1, use_numpy_fft=False,
-        xshift=0, yshift=0):
+        xshift=0, yshift=0, fft_backend=None):
     """
     Use dftups to upsample an image (but takes an image and returns an image with all reals)
+
+    fft_backend - FFT backend name (see fast_ffts.set_backend)
     """
-    fftn,ifftn = fast_ffts.get_ffts(nthreads=nthreads, use_numpy_fft=use_numpy_fft)
+    fftn,ifftn = fast_ffts.get_ffts(nthreads=nthreads,
+            use_numpy_fft=use_numpy_fft, backend=fft_backend)
 
     imfft = ifftn(image)
 
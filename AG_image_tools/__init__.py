@@ -4,12 +4,12 @@ warnings.warn("agpy.AG_image_tools is deprecated."
               "https://github.com/keflavich/image_tools",
               DeprecationWarning)
 import radialprofile
-from radialprofile import azimuthalAverage,azimuthalAverageBins,radialAverage,radialAverageBins
-from drizzle import drizzle
+from radialprofile import azimuthalAverage,azimuthalAverageBins,radialAverage,radialAverageBins,RadialProfile
+from drizzle import drizzle,DrizzleAccumulator
 import downsample
 from downsample import downsample,downsample_1d,downsample_cube
 #from cross_correlation_shifts import cross_correlation_shifts_FITS,cross_correlation_shifts
 # these have been moved to their own repository: https://github.com/keflavich/image_registration
-#from register_images import register_images,dftregistration
+from register_images import register_images,dftregistration,register_stack
 #from registration_testing import register_noise_test
 #from chi2_shifts import chi2_shift
@@ -12,6 +12,15 @@ def masktozero(arr):
 
     return numpy.array(arr)
 
+def _mapsum(tstomap, values, npix):
+    """
+    Sum `values` into the npix (flattened) map pixels given by tstomap
+    """
+    summed = numpy.bincount(tstomap, values, minlength=npix)
+    if summed.shape[0] > npix:
+        raise ValueError("The timestream maps to pixels outside of the map.")
+    return summed
+
 def drizzle(tstomap,ts,mapshape,weights=1,weightmap=None):
     """
     Drizzle a timestream onto a map.  Returns the map of the weighted average
@@ -28,39 +37,139 @@ def drizzle(tstomap,ts,mapshape,weights=1,weightmap=None):
         includes all points mapped to
 
     You can specify a weightmap to increase efficiency instead of computing it
-    """
-    newmap = numpy.zeros(mapshape)
-    # don't need to mask out when adding zero; simplifies indexing to have no masks
-    ts_to_index = masktozero((ts*weights).ravel())
-
-    if len(tstomap.shape) > 1: # tstomap must be flat
-        tstomap = tstomap.ravel()
 
-    tsmapped = numpy.bincount(tstomap,ts_to_index)
+    To build a map from a timestream that is too big to hold in memory, or
+    to get the weight, hit count and variance maps as well, use
+    DrizzleAccumulator.
+    """
+    npix = mapshape[0]*mapshape[1]
+    tstomap = numpy.asarray(tstomap).ravel()
 
-    # bincount has length = argmax(tstomap), but the x/y index arrays
-    # go all the way to the full map size.  Append zeros to fill
-    maxind = mapshape[0]*mapshape[1]
-    if tsmapped.shape[0] < maxind:
-        tsmapped = numpy.concatenate([tsmapped,
-            numpy.zeros(maxind-tsmapped.shape[0])])
-    xinds,yinds = (a.ravel() for a in numpy.indices(mapshape))
-    newmap[xinds,yinds] = tsmapped
+    # don't need to mask out when adding zero
+    ts_to_index = numpy.ma.filled(ts*weights, 0).ravel()
+    ts_to_index[ts_to_index!=ts_to_index] = 0
+    newmap = _mapsum(tstomap,ts_to_index,npix).reshape(mapshape)
 
     # do the same for weights unless a weightmap is specified
-    if weightmap is None: 
-        wm = numpy.zeros(mapshape)
-        if numpy.isscalar(weights): 
-            weights_to_index = numpy.ones(ts_to_index.shape)*weights
+    if weightmap is None:
+        if numpy.isscalar(weights):
+            wm = _mapsum(tstomap,None,npix).reshape(mapshape) * weights
         else:
-            weights_to_index = masktozero((weights).ravel())
-
-        tsweights = numpy.bincount(tstomap,weights_to_index)
-        if tsweights.shape[0] < maxind:
-            tsweights = numpy.concatenate([tsweights,
-                numpy.zeros(maxind-tsweights.shape[0])])
-        wm[xinds,yinds] = tsweights
+            weights_to_index = numpy.array(numpy.ma.filled(weights, 0), dtype='float').ravel()
+            weights_to_index[weights_to_index!=weights_to_index] = 0
+            wm = _mapsum(tstomap,weights_to_index,npix).reshape(mapshape)
     else:
         wm = weightmap
 
     return newmap/wm
+
+class DrizzleAccumulator(object):
+    """
+    Drizzle a timestream onto a map a piece at a time (e.g. one scan at a
+    time, or slices of a memmap), keeping running maps of the weighted sum,
+    the weights, the squared weights, the weighted sum of squares and the
+    number of hits.  Only these maps are kept, so the timestream never has to
+    be in memory all at once.
+
+    Unlike drizzle, samples that are NaN or masked get no weight (and are not
+    counted as hits).
+
+    Example
+    -------
+    >>> acc = DrizzleAccumulator(mapshape)
+    >>> for scan in range(nscans):
+    ...     acc.add(tstomap[scan], ts[scan], weights[scan])
+    >>> meanmap, variancemap = acc.mean(), acc.variance()
+    """
+
+    def __init__(self, mapshape):
+        self.mapshape = tuple(mapshape)
+        self.npix = int(numpy.prod(self.mapshape))
+        self.clear()
+
+    def clear(self):
+        """ Reset all of the maps to zero """
+        self.sum = numpy.zeros(self.mapshape)
+        self.weight = numpy.zeros(self.mapshape)
+        self.weight2 = numpy.zeros(self.mapshape)
+        self.sumsq = numpy.zeros(self.mapshape)
+        self.hits = numpy.zeros(self.mapshape, dtype='int')
+
+    def add(self, tstomap, ts, weights=1, sign=1):
+        """
+        Add a chunk of timestream to the maps.
+
+        tstomap - mapping from the chunk to the map (flattened pixel
+            indices), same shape as ts
+        ts - chunk of timestream (any shape; masked arrays are OK)
+        weights - scalar or same shape as ts
+        sign - use sign=-1 to remove a chunk that was added before
+        """
+        ts = numpy.ma.filled(numpy.ma.asarray(ts, dtype='float'), numpy.nan)
+        weights = numpy.broadcast_to(numpy.ma.filled(
+            numpy.ma.asarray(weights, dtype='float'), 0), ts.shape).ravel()
+        tstomap = numpy.asarray(tstomap).ravel()
+        ts = ts.ravel()
+        if tstomap.shape != ts.shape:
+            raise ValueError("tstomap and ts must have the same size.")
+
+        good = (ts == ts) & (weights == weights) & (weights != 0)
+        if not good.all():
+            tstomap, ts, weights = tstomap[good], ts[good], weights[good]
+
+        def mapsum(values):
+            return sign*_mapsum(tstomap, values, self.npix).reshape(self.mapshape)
+
+        wts = weights*ts
+        self.sum += mapsum(wts)
+        self.sumsq += mapsum(wts*ts)
+        self.weight += mapsum(weights)
+        self.weight2 += mapsum(weights**2)
+        self.hits += mapsum(None).astype('int')
+        if sign < 0:
+            # subtraction leaves roundoff behind in the pixels that have had
+            # all of their samples removed; make them exactly empty again
+            pixels = numpy.unique(tstomap)
+            emptied = pixels[self.hits.flat[pixels] == 0]
+            for arr in (self.sum, self.sumsq, self.weight, self.weight2):
+                arr.flat[emptied] = 0
+
+    def _perweight(self, arr):
+        """ arr / weight, NaN where there are no hits """
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            result = arr / self.weight
+        result[self.hits == 0] = numpy.nan
+        return result
+
+    def mean(self):
+        """ Weighted mean map (NaN where there are no hits) """
+        return self._perweight(self.sum)
+
+    def meansquare(self):
+        """
+        Weighted mean of the squared timestream in each pixel (NaN where
+        there are no hits)
+        """
+        return self._perweight(self.sumsq)
+
+    def variance(self, unbiased=False):
+        """
+        Weighted variance of the samples in each pixel (NaN where there are
+        no hits).  If unbiased, correct for the number of independent
+        samples, sum(w)^2 / sum(w^2)
+        """
+        variance = self.meansquare() - self.mean()**2
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            if unbiased:
+                variance *= self.weight**2 / (self.weight**2 - self.weight2)
+            # roundoff can make these slightly negative
+            variance[variance < 0] = 0
+        return variance
+
+    def mean_variance(self):
+        """
+        Variance of the weighted mean map estimated from the scatter of the
+        samples: variance * sum(w^2) / sum(w)^2 (unbiased)
+        """
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return self.variance(unbiased=True) * self.weight2 / self.weight**2
@@ -1,4 +1,387 @@
 import numpy as np
+import threading
+from collections import OrderedDict
+
+def _default_center(shape):
+    """ The center of an image of this shape (including fractional pixels) """
+    return np.array([(shape[-1]-1)/2.0, (shape[-2]-1)/2.0])
+
+def _azimuthal_edges(azbins, symmetric=None):
+    """
+    Turn an integer number of azimuthal bin edges into the edges (in degrees)
+    used by azimuthalAverageBins
+    """
+    if isinstance(azbins,np.ndarray):
+        return azbins
+    elif symmetric == 2:
+        return np.linspace(0,90,azbins)
+    elif symmetric == 1:
+        return np.linspace(0,180,azbins)
+    else:
+        return np.linspace(0,359.9999999999999,azbins)
+
+def _group_index(values, edges):
+    """
+    Index of the (lower,upper) range, exclusive at both ends, that each value
+    falls in, or -1.  The ranges must be increasing and not overlap.
+    """
+    lower = edges[:-1]
+    upper = edges[1:]
+    if np.any(upper <= lower) or np.any(lower[1:] < upper[:-1]):
+        raise ValueError("bin edges must be increasing")
+    group = np.searchsorted(lower, values, side='right') - 1
+    ingroup = group >= 0
+    ingroup[ingroup] &= ((values[ingroup] > lower[group[ingroup]]) &
+            (values[ingroup] < upper[group[ingroup]]))
+    group[~ingroup] = -1
+    return group
+
+class _BinnedProfile(object):
+    """
+    Reductions over a fixed assignment of the pixels of an image to
+    (group, bin) pairs.  Subclasses set shape, nbins, ngroups, whichbin (the
+    flattened group*nbins+bin index of each pixel, or -1 for pixels in no
+    bin) and _profileshape.
+
+    The mean, standard deviation, median, and number of pixels in each bin
+    are computed for any number of images in O(npix) with `numpy.bincount`
+    (the median also needs a sort).  Images can have extra leading
+    dimensions (e.g. a cube of shape (nplanes,) + shape); each plane then
+    gets its own profile.
+    """
+
+    def _select(self, image, mask=None):
+        """
+        Flatten image to (nimages, npix), keeping only the pixels that are in
+        a bin (and in the mask); also return the bin index of each kept
+        value offset by nbins*ngroups per image, and the leading shape
+        """
+        image = np.asarray(image)
+        if image.shape[-2:] != self.shape:
+            raise ValueError("Image shape %s does not match the profile shape "
+                    "%s" % (image.shape, self.shape))
+        leadshape = image.shape[:-2]
+        values = image.reshape((-1, self.whichbin.size))
+        whichbin = self.whichbin
+        if mask is not None or not self._allbinned:
+            keep = whichbin >= 0
+            if mask is not None:
+                keep = keep & np.asarray(mask, dtype='bool').ravel()
+            values = values[:, keep]
+            whichbin = whichbin[keep]
+        nprof = self.nbins * self.ngroups
+        if values.shape[0] == 1:
+            index = whichbin[None,:]
+        else:
+            index = whichbin + nprof*np.arange(values.shape[0])[:,None]
+        return values, index, leadshape
+
+    def _bincount(self, index, weights=None):
+        """ Sum weights (or count) in each bin of each image """
+        nprof = self.nbins * self.ngroups
+        nimages = index.shape[0]
+        if weights is not None:
+            weights = weights.ravel()
+        return np.bincount(index.ravel(), weights=weights,
+                minlength=nimages*nprof).reshape((nimages, nprof))
+
+    def _reshape(self, profile, leadshape):
+        return profile.reshape(leadshape + self._profileshape)
+
+    def counts(self, mask=None):
+        """ Number of (unmasked) pixels in each bin """
+        keep = self.whichbin >= 0
+        if mask is not None:
+            keep = keep & np.asarray(mask, dtype='bool').ravel()
+        return np.bincount(self.whichbin[keep],
+                minlength=self.nbins*self.ngroups).reshape(self._profileshape)
+
+    def mean(self, image, weights=None, mask=None):
+        """
+        The (weighted) mean of each bin.  Bins with no data are NaN.
+
+        weights - same shape as image (or broadcastable to it)
+        mask - boolean array of the profile's shape; True for OK pixels
+        """
+        values, index, leadshape = self._select(image, mask)
+        if weights is None:
+            total = self._bincount(index, values)
+            norm = self._bincount(index)
+        else:
+            weights = np.broadcast_to(weights, np.shape(image))
+            weights, _, _ = self._select(weights, mask)
+            total = self._bincount(index, values*weights)
+            norm = self._bincount(index, weights)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self._reshape(total / norm, leadshape)
+
+    def std(self, image, mask=None):
+        """
+        The standard deviation of each bin.  Bins with no data are NaN.
+        """
+        values, index, leadshape = self._select(image, mask)
+        norm = self._bincount(index)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = self._bincount(index, values) / norm
+            # subtract the mean before squaring, to keep the precision
+            resid = values - mean.ravel()[index]
+            var = self._bincount(index, resid**2) / norm
+        return self._reshape(np.sqrt(var), leadshape)
+
+    def median(self, image, mask=None):
+        """
+        The median of each bin.  Bins with no data, or with NaNs, are NaN.
+        """
+        values, index, leadshape = self._select(image, mask)
+        nbinstot = self.nbins * self.ngroups * values.shape[0]
+        values = values.ravel()
+        index = index.ravel()
+        counts = np.bincount(index, minlength=nbinstot)
+        hasnan = np.bincount(index, weights=np.isnan(values),
+                minlength=nbinstot) > 0
+
+        # sort by bin, then by value within each bin
+        order = np.lexsort((values, index))
+        sortedvals = values[order]
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        median = np.empty(nbinstot)
+        median[:] = np.nan
+        ok = (counts > 0) & ~hasnan
+        lo = starts[ok] + (counts[ok]-1)//2
+        hi = starts[ok] + counts[ok]//2
+        median[ok] = (sortedvals[lo] + sortedvals[hi]) / 2.0
+        return self._reshape(median, leadshape)
+
+def _angles(x, y, center, symmetric=None):
+    """ Position angle of each pixel in degrees, optionally folded """
+    theta = np.arctan2(x - center[0], y - center[1])
+    theta[theta < 0] += 2*np.pi
+    theta_deg = theta*180.0/np.pi
+    if symmetric == 2:
+        theta_deg = theta_deg % 90
+    elif symmetric == 1:
+        theta_deg = theta_deg % 180
+    return theta_deg
+
+class RadialProfile(_BinnedProfile):
+    """
+    The bin geometry of an azimuthal average: which radial bin (and,
+    optionally, which angular sector) each pixel of an image of a given
+    shape falls in.  It is computed once; see the mean, std, median, and
+    counts methods.  All of the sectors are computed in the same pass over
+    the pixels.
+
+    shape - The shape of the (last two dimensions of the) images
+    center - The [x,y] pixel coordinates used as the center.  The default is
+        the center of the image (including fractional pixels).
+    binsize - size of the radial bins
+    azbins - None or 1 for a single 360 degree sector, otherwise the
+        sector edges in degrees, or their number, as in azimuthalAverageBins.
+        Pixels exactly on a sector edge are in no sector.
+    symmetric - 1 or 2 to fold the angles modulo 180 or 90 degrees
+
+    Profiles have shape (nbins,), or (nsectors, nbins) if azbins is set.
+
+    Example
+    -------
+    >>> prof = RadialProfile(cube.shape[1:], binsize=1.0)
+    >>> means = prof.mean(cube)    # shape (cube.shape[0], prof.nbins)
+    """
+
+    def __init__(self, shape, center=None, binsize=0.5, azbins=None,
+            symmetric=None):
+        self.shape = tuple(shape[-2:])
+        y, x = np.indices(self.shape)
+
+        if center is None:
+            center = _default_center(self.shape)
+        self.center = center
+        self.binsize = binsize
+
+        r = np.hypot(x - center[0], y - center[1])
+        self.radii = r
+
+        # the 'bins' as initially defined are lower/upper bounds for each bin
+        # so that values will be in [lower,upper)
+        nbins = int(np.round(r.max() / binsize)+1)
+        maxbin = nbins * binsize
+        self.nbins = nbins
+        self.bins = np.linspace(0,maxbin,nbins+1)
+        # but we're probably more interested in the bin centers than their left or right sides...
+        self.bin_centers = (self.bins[1:]+self.bins[:-1])/2.0
+
+        # digitize counts from 1; -1 means "not in any bin"
+        whichbin = np.digitize(r.ravel(), self.bins) - 1
+        whichbin[whichbin >= nbins] = -1
+        # number of pixels per radius, in all sectors
+        self.nr = np.bincount(whichbin[whichbin >= 0], minlength=nbins)
+
+        if azbins is None or (np.isscalar(azbins) and azbins == 1):
+            self.azbins = None
+            self.nsectors = 1
+            self._profileshape = (nbins,)
+        else:
+            azbins = _azimuthal_edges(azbins, symmetric)
+            theta_deg = _angles(x, y, center, symmetric).ravel()
+            # a sector can end at 360 but not wrap around past it
+            edges = np.array(azbins % 360, dtype='float')
+            edges[1:][np.asarray(azbins)[1:] == 360] = 360
+            sector = _group_index(theta_deg, edges)
+            whichbin[sector < 0] = -1
+            insector = whichbin >= 0
+            whichbin[insector] += sector[insector] * nbins
+            self.azbins = azbins
+            self.nsectors = azbins.size - 1
+            self._profileshape = (self.nsectors, nbins)
+
+        self.ngroups = self.nsectors
+        self.whichbin = whichbin
+        self._allbinned = (whichbin >= 0).all()
+
+class AzimuthalProfile(_BinnedProfile):
+    """
+    The bin geometry of a radial average (a profile as a function of angle):
+    which angular bin (and, optionally, which annulus) each pixel of an
+    image of a given shape falls in.  Like `RadialProfile`, but binned in
+    angle.
+
+    shape - The shape of the (last two dimensions of the) images
+    center - The [x,y] pixel coordinates used as the center.  The default is
+        the center of the image (including fractional pixels).
+    binsize - size of the angular bins in degrees
+    radbins - None for all radii, otherwise the annulus edges, as in
+        radialAverageBins.  Pixels exactly on an edge are in no annulus.
+    symmetric - 1 or 2 to fold the angles modulo 180 or 90 degrees
+
+    Profiles have shape (nbins,), or (nannuli, nbins) if radbins is set.
+    """
+
+    def __init__(self, shape, center=None, binsize=1.0, radbins=None,
+            symmetric=None):
+        self.shape = tuple(shape[-2:])
+        y, x = np.indices(self.shape)
+
+        if center is None:
+            center = _default_center(self.shape)
+        self.center = center
+        self.binsize = binsize
+
+        theta_deg = _angles(x, y, center, symmetric).ravel()
+        if symmetric == 2:
+            maxangle = 90
+        elif symmetric == 1:
+            maxangle = 180
+        else:
+            maxangle = 360
+
+        # the 'bins' as initially defined are lower/upper bounds for each bin
+        # so that values will be in [lower,upper)
+        nbins = int(np.round(maxangle / binsize))
+        maxbin = nbins * binsize
+        self.nbins = nbins
+        self.bins = np.linspace(0,maxbin,nbins+1)
+        # but we're probably more interested in the bin centers than their left or right sides...
+        self.bin_centers = (self.bins[1:]+self.bins[:-1])/2.0
+
+        whichbin = np.digitize(theta_deg, self.bins) - 1
+        whichbin[whichbin >= nbins] = -1
+        # number of pixels per azimuth, in all annuli
+        self.naz = np.bincount(whichbin[whichbin >= 0], minlength=nbins)
+
+        if radbins is None:
+            self.radbins = None
+            self.nannuli = 1
+            self._profileshape = (nbins,)
+        else:
+            r = np.hypot(x - center[0], y - center[1]).ravel()
+            annulus = _group_index(r, np.asarray(radbins))
+            whichbin[annulus < 0] = -1
+            inannulus = whichbin >= 0
+            whichbin[inannulus] += annulus[inannulus] * nbins
+            self.radbins = radbins
+            self.nannuli = len(radbins) - 1
+            self._profileshape = (self.nannuli, nbins)
+
+        self.ngroups = self.nannuli
+        self.whichbin = whichbin
+        self._allbinned = (whichbin >= 0).all()
+
+# the profile functions keep the most recently used geometries, so
+# profiles of many images of the same shape (e.g. the planes of a cube, or
+# repeated power spectra) only compute the bins once
+profile_cache_size = 8
+_profile_cache = OrderedDict()
+_profile_cache_lock = threading.Lock()
+
+def _cached_profile(cls, shape, center, binsize, groupbins, symmetric):
+    """
+    Return a (cached) instance of `cls` (RadialProfile or AzimuthalProfile)
+    """
+    shape = tuple(shape[-2:])
+    if center is None:
+        center = _default_center(shape)
+    key = (cls, shape, tuple(float(c) for c in center), binsize,
+            tuple(groupbins) if isinstance(groupbins,np.ndarray) else groupbins,
+            symmetric)
+    with _profile_cache_lock:
+        if key in _profile_cache:
+            profile = _profile_cache.pop(key)
+            _profile_cache[key] = profile
+            return profile
+
+    profile = cls(shape, center, binsize, groupbins, symmetric)
+
+    if profile_cache_size > 0:
+        with _profile_cache_lock:
+            _profile_cache[key] = profile
+            while len(_profile_cache) > profile_cache_size:
+                _profile_cache.popitem(last=False)
+    return profile
+
+def get_radial_profile(shape, center=None, binsize=0.5, azbins=None,
+        symmetric=None):
+    """
+    Return a (cached) `RadialProfile` for images of shape `shape`.  The most
+    recent `profile_cache_size` geometries are kept.
+    """
+    return _cached_profile(RadialProfile, shape, center, binsize, azbins,
+            symmetric)
+
+def get_azimuthal_profile(shape, center=None, binsize=1.0, radbins=None,
+        symmetric=None):
+    """
+    Return a (cached) `AzimuthalProfile` for images of shape `shape`.  The
+    most recent `profile_cache_size` geometries are kept.
+    """
+    return _cached_profile(AzimuthalProfile, shape, center, binsize, radbins,
+            symmetric)
+
+def _interpnan(bin_centers, profile, left=None, right=None):
+    """ interpolate over the NaN bins of each profile (along the last axis) """
+    profile = np.array(profile, dtype='float')
+    for prof in profile.reshape((-1, profile.shape[-1])):
+        good = prof==prof
+        prof[:] = np.interp(bin_centers,bin_centers[good],prof[good],left=left,right=right)
+    return profile
+
+def _profile_output(bins, bin_centers, prof, nr, steps, interpnan, left,
+        right, return_bins, return_n):
+    """
+    Shared return-value logic of azimuthalAverage and radialAverage
+    """
+    if interpnan:
+        prof = _interpnan(bin_centers, prof, left=left, right=right)
+
+    if steps:
+        xarr = np.array(zip(bins[:-1],bins[1:])).ravel() 
+        yarr = np.repeat(prof, 2, axis=-1)
+        return xarr,yarr
+    elif return_bins:
+        return bin_centers,prof
+    elif return_n:
+        return nr,bin_centers,prof
+    else:
+        return prof
 
 def azimuthalAverage(image, center=None, stddev=False, returnradii=False, return_nr=False, 
         binsize=0.5, weights=None, steps=False, interpnan=False, left=None, right=None,
@@ -6,7 +389,8 @@ def azimuthalAverage(image, center=None, stddev=False, returnradii=False, return
     """
     Calculate the azimuthally averaged radial profile.
 
-    image - The 2D image
+    image - The 2D image, or a cube of images (the profile of each plane
+            along the last two axes is computed)
     center - The [x,y] pixel coordinates used as the center. The default is 
              None, which then uses the center of the image (including 
              fractional pixels).
@@ -30,106 +414,75 @@ def azimuthalAverage(image, center=None, stddev=False, returnradii=False, return
     If a bin contains NO DATA, it will have a NAN value because of the
     divide-by-sum-of-weights component.  I think this is a useful way to denote
     lack of data, but users let me know if an alternative is prefered...
-    
-    """
-    # Calculate the indices from the image
-    y, x = np.indices(image.shape)
-
-    if center is None:
-        center = np.array([(x.max()-x.min())/2.0, (y.max()-y.min())/2.0])
 
-    r = np.hypot(x - center[0], y - center[1])
-
-    if weights is None:
-        weights = np.ones(image.shape)
-    elif stddev:
-        raise ValueError("Weighted standard deviation is not defined.")
+    The bin geometry is cached (see `get_radial_profile`), so repeated calls
+    with the same shape, center, and binsize are much faster.
+    """
+    profile = get_radial_profile(np.shape(image), center=center, binsize=binsize)
 
-    if mask is None:
-        mask = np.ones(image.shape,dtype='bool')
-    # obsolete elif len(mask.shape) > 1:
-    # obsolete     mask = mask.ravel()
-
-    # the 'bins' as initially defined are lower/upper bounds for each bin
-    # so that values will be in [lower,upper)  
-    nbins = int(np.round(r.max() / binsize)+1)
-    maxbin = nbins * binsize
-    bins = np.linspace(0,maxbin,nbins+1)
-    # but we're probably more interested in the bin centers than their left or right sides...
-    bin_centers = (bins[1:]+bins[:-1])/2.0
-
-    # how many per bin (i.e., histogram)?
-    # there are never any in bin 0, because the lowest index returned by digitize is 1
-    #nr = np.bincount(whichbin)[1:]
-    nr = np.histogram(r,bins)[0]
-
-    # recall that bins are from 1 to nbins (which is expressed in array terms by arange(nbins)+1 or xrange(1,nbins+1) )
-    # radial_prof.shape = bin_centers.shape
     if stddev:
-        # Find out which radial bin each point in the map belongs to
-        whichbin = np.digitize(r.flat,bins)
-        # This method is still very slow; is there a trick to do this with histograms? 
-        radial_prof = np.array([image.flat[mask.flat*(whichbin==b)].std() for b in xrange(1,nbins+1)])
+        if weights is not None:
+            raise ValueError("Weighted standard deviation is not defined.")
+        radial_prof = profile.std(image, mask=mask)
     else: 
-        radial_prof = np.histogram(r, bins, weights=(image*weights*mask))[0] / np.histogram(r, bins, weights=(mask*weights))[0]
+        radial_prof = profile.mean(image, weights=weights, mask=mask)
 
-    if interpnan:
-        radial_prof = np.interp(bin_centers,bin_centers[radial_prof==radial_prof],radial_prof[radial_prof==radial_prof],left=left,right=right)
-
-    if steps:
-        xarr = np.array(zip(bins[:-1],bins[1:])).ravel() 
-        yarr = np.array(zip(radial_prof,radial_prof)).ravel() 
-        return xarr,yarr
-    elif returnradii: 
-        return bin_centers,radial_prof
-    elif return_nr:
-        return nr,bin_centers,radial_prof
-    else:
-        return radial_prof
+    # nr: how many per bin (i.e., histogram)?
+    return _profile_output(profile.bins, profile.bin_centers, radial_prof,
+            profile.nr, steps, interpnan, left, right, returnradii, return_nr)
 
-def azimuthalAverageBins(image,azbins,symmetric=None, center=None, **kwargs):
+def azimuthalAverageBins(image,azbins,symmetric=None, center=None,
+        stddev=False, binsize=0.5, weights=None, mask=None, steps=False,
+        interpnan=False, left=None, right=None, **kwargs):
     """ Compute the azimuthal average over a limited range of angles 
-    kwargs are passed to azimuthalAverage """
-    y, x = np.indices(image.shape)
-    if center is None:
-        center = np.array([(x.max()-x.min())/2.0, (y.max()-y.min())/2.0])
-    r = np.hypot(x - center[0], y - center[1])
-    theta = np.arctan2(x - center[0], y - center[1])
-    theta[theta < 0] += 2*np.pi
-    theta_deg = theta*180.0/np.pi
 
+    azbins - number of sector edges (azbins-1 sectors covering 360 degrees,
+        or 180 or 90 if symmetric is 1 or 2), or an array of sector edges
+        in degrees
+    symmetric - fold the angles modulo 180 (1) or 90 (2) degrees; only used
+        if azbins is an integer
+
+    Returns azbins, the radii, and a list of the profiles of each sector.
+    All of the sectors are computed in a single pass over the image (see
+    `RadialProfile`).  The other keywords are as in azimuthalAverage.
+    """
     if isinstance(azbins,np.ndarray):
-        pass
+        symmetric = None
     elif isinstance(azbins,int):
-        if symmetric == 2:
-            azbins = np.linspace(0,90,azbins)
-            theta_deg = theta_deg % 90
-        elif symmetric == 1:
-            azbins = np.linspace(0,180,azbins)
-            theta_deg = theta_deg % 180
-        elif azbins == 1:
-            return azbins,azimuthalAverage(image,center=center,returnradii=True,**kwargs)
-        else:
-            azbins = np.linspace(0,359.9999999999999,azbins)
+        if azbins == 1:
+            return azbins,azimuthalAverage(image,center=center,returnradii=True,
+                    stddev=stddev, binsize=binsize, weights=weights,
+                    mask=mask, steps=steps, interpnan=interpnan, left=left,
+                    right=right, **kwargs)
     else:
         raise ValueError("azbins must be an ndarray or an integer")
 
-    azavlist = []
-    for blow,bhigh in zip(azbins[:-1],azbins[1:]):
-        mask = (theta_deg > (blow % 360)) * (theta_deg < (bhigh % 360))
-        rr,zz = azimuthalAverage(image,center=center,mask=mask,returnradii=True,**kwargs)
-        azavlist.append(zz)
+    if stddev and weights is not None:
+        raise ValueError("Weighted standard deviation is not defined.")
+
+    edges = _azimuthal_edges(azbins, symmetric)
+    profile = get_radial_profile(np.shape(image), center=center,
+            binsize=binsize, azbins=edges, symmetric=symmetric)
 
-    return azbins,rr,azavlist
+    if stddev:
+        prof = profile.std(image, mask=mask)
+    else:
+        prof = profile.mean(image, weights=weights, mask=mask)
+    rr,prof = _profile_output(profile.bins, profile.bin_centers, prof,
+            profile.nr, steps, interpnan, left, right, True, False)
+
+    azavlist = [prof[...,ii,:] for ii in range(profile.nsectors)]
+
+    return edges,rr,azavlist
 
 def radialAverage(image, center=None, stddev=False, returnAz=False, return_naz=False, 
         binsize=1.0, weights=None, steps=False, interpnan=False, left=None, right=None,
         mask=None, symmetric=None ):
     """
     Calculate the radially averaged azimuthal profile.
-    (this code has not been optimized; it could be speed boosted by ~20x)
 
-    image - The 2D image
+    image - The 2D image, or a cube of images (the profile of each plane
+            along the last two axes is computed)
     center - The [x,y] pixel coordinates used as the center. The default is 
              None, which then uses the center of the image (including 
              fractional pixels).
@@ -154,102 +507,69 @@ def radialAverage(image, center=None, stddev=False, returnAz=False, return_naz=F
     divide-by-sum-of-weights component.  I think this is a useful way to denote
     lack of data, but users let me know if an alternative is prefered...
     
-    """
-    # Calculate the indices from the image
-    y, x = np.indices(image.shape)
-
-    if center is None:
-        center = np.array([(x.max()-x.min())/2.0, (y.max()-y.min())/2.0])
 
-    r = np.hypot(x - center[0], y - center[1])
-    theta = np.arctan2(x - center[0], y - center[1])
-    theta[theta < 0] += 2*np.pi
-    theta_deg = theta*180.0/np.pi
-    maxangle = 360
-
-    if weights is None:
-        weights = np.ones(image.shape)
-    elif stddev:
-        raise ValueError("Weighted standard deviation is not defined.")
-
-    if mask is None:
-        # mask is only used in a flat context
-        mask = np.ones(image.shape,dtype='bool').ravel()
-    elif len(mask.shape) > 1:
-        mask = mask.ravel()
-
-    # allow for symmetries
-    if symmetric == 2:
-        theta_deg = theta_deg % 90
-        maxangle = 90
-    elif symmetric == 1:
-        theta_deg = theta_deg % 180
-        maxangle = 180
-
-    # the 'bins' as initially defined are lower/upper bounds for each bin
-    # so that values will be in [lower,upper)  
-    nbins = int(np.round(maxangle / binsize))
-    maxbin = nbins * binsize
-    bins = np.linspace(0,maxbin,nbins+1)
-    # but we're probably more interested in the bin centers than their left or right sides...
-    bin_centers = (bins[1:]+bins[:-1])/2.0
-
-    # Find out which azimuthal bin each point in the map belongs to
-    whichbin = np.digitize(theta_deg.flat,bins)
-
-    # how many per bin (i.e., histogram)?
-    # there are never any in bin 0, because the lowest index returned by digitize is 1
-    nr = np.bincount(whichbin)[1:]
+    The bin geometry is cached (see `get_azimuthal_profile`), so repeated
+    calls with the same shape, center, and binsize are much faster.
+    """
+    profile = get_azimuthal_profile(np.shape(image), center=center,
+            binsize=binsize, symmetric=symmetric)
 
-    # recall that bins are from 1 to nbins (which is expressed in array terms by arange(nbins)+1 or xrange(1,nbins+1) )
-    # azimuthal_prof.shape = bin_centers.shape
     if stddev:
-        azimuthal_prof = np.array([image.flat[mask*(whichbin==b)].std() for b in xrange(1,nbins+1)])
+        if weights is not None:
+            raise ValueError("Weighted standard deviation is not defined.")
+        azimuthal_prof = profile.std(image, mask=mask)
     else:
-        azimuthal_prof = np.array([(image*weights).flat[mask*(whichbin==b)].sum() / weights.flat[mask*(whichbin==b)].sum() for b in xrange(1,nbins+1)])
+        azimuthal_prof = profile.mean(image, weights=weights, mask=mask)
 
-    #import pdb; pdb.set_trace()
+    return _profile_output(profile.bins, profile.bin_centers, azimuthal_prof,
+            profile.naz, steps, interpnan, left, right, returnAz, return_naz)
 
-    if interpnan:
-        azimuthal_prof = np.interp(bin_centers,
-            bin_centers[azimuthal_prof==azimuthal_prof],
-            azimuthal_prof[azimuthal_prof==azimuthal_prof],
-            left=left,right=right)
+def radialAverageBins(image,radbins, corners=True, center=None,
+        stddev=False, binsize=1.0, weights=None, mask=None, steps=False,
+        interpnan=False, left=None, right=None, symmetric=None, **kwargs):
+    """ Compute the radial average over a limited range of radii 
 
-    if steps:
-        xarr = np.array(zip(bins[:-1],bins[1:])).ravel() 
-        yarr = np.array(zip(azimuthal_prof,azimuthal_prof)).ravel() 
-        return xarr,yarr
-    elif returnAz: 
-        return bin_centers,azimuthal_prof
-    elif return_naz:
-        return nr,bin_centers,azimuthal_prof
-    else:
-        return azimuthal_prof
+    radbins - number of annulus edges (spanning to the farthest corner, or
+        to the farthest edge if corners=False), or an array of edges
 
-def radialAverageBins(image,radbins, corners=True, center=None, **kwargs):
-    """ Compute the radial average over a limited range of radii """
-    y, x = np.indices(image.shape)
+    Returns radbins, the azimuths, and a list of the profiles of each
+    annulus.  All of the annuli are computed in a single pass over the image
+    (see `AzimuthalProfile`).  The other keywords are as in radialAverage.
+    """
+    shape = np.shape(image)[-2:]
     if center is None:
-        center = np.array([(x.max()-x.min())/2.0, (y.max()-y.min())/2.0])
-    r = np.hypot(x - center[0], y - center[1])
+        center = _default_center(shape)
 
     if isinstance(radbins,np.ndarray):
         pass
     elif isinstance(radbins,int):
         if radbins == 1:
-            return radbins,radialAverage(image,center=center,returnAz=True,**kwargs)
-        elif corners:
+            return radbins,radialAverage(image,center=center,returnAz=True,
+                    stddev=stddev, binsize=binsize, weights=weights,
+                    mask=mask, steps=steps, interpnan=interpnan, left=left,
+                    right=right, symmetric=symmetric, **kwargs)
+        y, x = np.indices(shape)
+        if corners:
+            r = np.hypot(x - center[0], y - center[1])
             radbins = np.linspace(0,r.max(),radbins)
         else:
             radbins = np.linspace(0,np.max(np.abs(np.array([x-center[0],y-center[1]]))),radbins)
     else:
         raise ValueError("radbins must be an ndarray or an integer")
 
-    radavlist = []
-    for blow,bhigh in zip(radbins[:-1],radbins[1:]):
-        mask = (r<bhigh)*(r>blow)
-        az,zz = radialAverage(image,center=center,mask=mask,returnAz=True,**kwargs)
-        radavlist.append(zz)
+    if stddev and weights is not None:
+        raise ValueError("Weighted standard deviation is not defined.")
+
+    profile = get_azimuthal_profile(shape, center=center, binsize=binsize,
+            radbins=radbins, symmetric=symmetric)
+
+    if stddev:
+        prof = profile.std(image, mask=mask)
+    else:
+        prof = profile.mean(image, weights=weights, mask=mask)
+    az,prof = _profile_output(profile.bins, profile.bin_centers, prof,
+            profile.naz, steps, interpnan, left, right, True, False)
+
+    radavlist = [prof[...,ii,:] for ii in range(profile.nannuli)]
 
     return radbins,az,radavlist
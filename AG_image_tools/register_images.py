@@ -0,0 +1,180 @@
+"""
+Sub-pixel image registration by cross-correlation (Guizar-Sicairos, Thurman
+& Fienup 2008, "Efficient subpixel image registration algorithms").
+
+The integer-pixel peak of the FFT cross-correlation is found first, then
+refined to 1/usfac of a pixel with an upsampled DFT (`dftups`) computed only
+in a 1.5 pixel box around the peak.  This costs about as much as the
+cross-correlation itself, whereas a zero-padded upsampled FFT costs usfac^2
+times as much.
+"""
+import numpy as np
+
+from AG_fft_tools import fast_ffts
+from AG_fft_tools.upsample import dftups
+
+def _peak_shift(loc, n):
+    """ convert the index of a correlation peak into a (signed) shift """
+    return loc - n if loc > n//2 else loc
+
+def dftregistration(buf1ft, buf2ft, usfac=10, return_error=False,
+        maxoff=None, ifftn=np.fft.ifftn):
+    """
+    Register two images given their FFTs (translated from Guizar's
+    dftregistration.m)
+
+    Parameters
+    ----------
+    buf1ft, buf2ft: `numpy.ndarray`
+        FFTs (not shifted) of the reference image and of the image to
+        register
+    usfac: int
+        Upsampling factor; the shift is measured to 1/usfac pixels
+    maxoff: int
+        Only look for the correlation peak within maxoff pixels of zero shift
+    return_error: bool
+        Also return the normalized root-mean-square error between the
+        registered images
+    ifftn: function
+        The inverse FFT to use for the coarse cross-correlation (e.g. from
+        fast_ffts.get_ffts)
+
+    Returns
+    -------
+    xshift, yshift: the shift of image 2 relative to image 1, i.e.
+        AG_fft_tools.shift(im2, -xshift, -yshift) is aligned with im1
+    (error: if return_error)
+    """
+    nr,nc = buf1ft.shape
+    product = buf1ft * np.conj(buf2ft)
+
+    # coarse: the integer-pixel peak of the (circular) cross-correlation
+    CC = ifftn(product)
+    AC = np.abs(CC)
+    if maxoff is not None:
+        rows = np.abs([_peak_shift(r, nr) for r in xrange(nr)]) > maxoff
+        cols = np.abs([_peak_shift(c, nc) for c in xrange(nc)]) > maxoff
+        AC[rows,:] = 0
+        AC[:,cols] = 0
+    rloc,cloc = np.unravel_index(np.argmax(AC), AC.shape)
+    CCmax = CC[rloc,cloc]
+    row_shift = _peak_shift(rloc, nr)
+    col_shift = _peak_shift(cloc, nc)
+
+    # fine: upsampled DFT of the cross-correlation in a 1.5x1.5 pixel box
+    # centered on the coarse peak
+    if usfac > 1:
+        nout = int(np.ceil(usfac*1.5))
+        dftshift = np.fix(nout/2.)
+        CC = np.conj(dftups(np.conj(product), nout, nout, usfac,
+            dftshift-row_shift*usfac, dftshift-col_shift*usfac)) / (nr*nc)
+        rloc,cloc = np.unravel_index(np.argmax(np.abs(CC)), CC.shape)
+        CCmax = CC[rloc,cloc]
+        row_shift = row_shift + (rloc - dftshift)/float(usfac)
+        col_shift = col_shift + (cloc - dftshift)/float(usfac)
+
+    # buf1 is buf2 shifted by (row_shift, col_shift)
+    xshift, yshift = -col_shift, -row_shift
+
+    if return_error:
+        rfzero = np.sum(np.abs(buf1ft)**2) / (nr*nc)
+        rgzero = np.sum(np.abs(buf2ft)**2) / (nr*nc)
+        error = np.sqrt(np.abs(1.0 - np.abs(CCmax)**2/(rfzero*rgzero)))
+        return xshift, yshift, error
+
+    return xshift, yshift
+
+def _prepare(image, zeromean):
+    image = np.nan_to_num(np.asarray(image, dtype='float'))
+    if zeromean:
+        image = image - image.mean()
+    return image
+
+def register_images(im1, im2, usfac=10, return_error=False, maxoff=None,
+        zeromean=True, nthreads=1, use_numpy_fft=False, fft_backend=None):
+    """
+    Measure the sub-pixel shift of im2 relative to im1 (see
+    `dftregistration`).  NaNs are treated as zeros.
+
+    Parameters
+    ----------
+    im1, im2: `numpy.ndarray`
+        Images of the same shape
+    usfac: int
+        Upsampling factor; the shift is measured to 1/usfac pixels
+    maxoff: int
+        Maximum shift (in pixels) to search for
+    zeromean: bool
+        Subtract the mean of each image first
+    nthreads, use_numpy_fft, fft_backend:
+        FFT options (see fast_ffts.get_ffts)
+
+    Returns
+    -------
+    xshift, yshift (and error if return_error): shift(im2, -xshift, -yshift)
+    is aligned with im1
+    """
+    if np.shape(im1) != np.shape(im2):
+        raise ValueError("Images must have the same shape.")
+    fftn,ifftn = fast_ffts.get_ffts(nthreads=nthreads,
+            use_numpy_fft=use_numpy_fft, backend=fft_backend)
+    return dftregistration(fftn(_prepare(im1, zeromean)),
+            fftn(_prepare(im2, zeromean)), usfac=usfac,
+            return_error=return_error, maxoff=maxoff, ifftn=ifftn)
+
+def register_stack(stack, reference=None, usfac=10, return_error=False,
+        maxoff=None, zeromean=True, numcores=1, nthreads=1,
+        use_numpy_fft=False, fft_backend=None):
+    """
+    Measure the sub-pixel shift of every image in a stack relative to a
+    reference image.  The reference is transformed once, and the upsampled
+    DFT kernels are shared by all of the images (they only depend on the
+    image shape and usfac).
+
+    Parameters
+    ----------
+    stack: `numpy.ndarray` or list
+        (nimages, ny, nx) array, or a list of images of the same shape
+    reference: `numpy.ndarray` or int
+        Reference image, or the index of the reference in the stack.
+        Defaults to the first image.
+    numcores: int
+        If not 1, split the stack between numcores processes with
+        `parallel_map` (None = use all available)
+    usfac, return_error, maxoff, zeromean, nthreads, use_numpy_fft,
+    fft_backend:
+        See `register_images`
+
+    Returns
+    -------
+    xshifts, yshifts (and errors if return_error): arrays with one entry per
+    image
+    """
+    if reference is None:
+        reference = 0
+    if np.isscalar(reference):
+        reference = stack[reference]
+    shape = np.shape(reference)
+    if np.ndim(reference) != 2 or np.shape(stack)[1:] != shape:
+        raise ValueError("The images and the reference must have the same shape.")
+
+    fftn,ifftn = fast_ffts.get_ffts(nthreads=nthreads,
+            use_numpy_fft=use_numpy_fft, backend=fft_backend)
+    refft = fftn(_prepare(reference, zeromean))
+
+    def register_one(ii):
+        return dftregistration(refft, fftn(_prepare(stack[ii], zeromean)),
+            usfac=usfac, return_error=True, maxoff=maxoff, ifftn=ifftn)
+
+    if numcores == 1:
+        results = map(register_one, xrange(len(stack)))
+    else:
+        from contributed import parallel_map
+        results = parallel_map(register_one, range(len(stack)),
+                numcores=numcores)
+
+    xshifts, yshifts, errors = [np.array(x) for x in zip(*results)]
+
+    if return_error:
+        return xshifts, yshifts, errors
+    return xshifts, yshifts
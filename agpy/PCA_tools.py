@@ -13,20 +13,45 @@ types of random data.
 import numpy
 
   
-def efuncs(arr, return_others=False):
+def _zero_masked(arr, mask=None):
+    """
+    Return the data of a (masked) array with the masked samples, and those
+    where `mask` is True, set to zero.  The array is only copied if there is
+    something to zero.
+    """
+    data = numpy.ma.getdata(arr)
+    bad = numpy.ma.getmask(arr)
+    if mask is not None:
+        bad = numpy.logical_or(bad, mask)
+    if numpy.any(bad):
+        data = numpy.where(bad, 0, data)
+    return data
+
+def efuncs(arr, return_others=False, mask=None):
     """
     Determine eigenfunctions of an array for use with
     PCA cleaning
+
+    The decomposition is the SVD of the (ntime x nbolos) array itself rather
+    than the eigendecomposition of its covariance matrix, which squares the
+    condition number.  Masked samples, and those where `mask` is True, are
+    treated as zeros.
+
+    Returns efuncarr (= arr . evects), and if return_others, also covmat
+    (= arr.T . arr), evals (in descending order) and evects (one per column)
     """
-    if hasattr(arr,'filled'):
-        arr = arr.filled(0)
-    covmat = numpy.dot(arr.T,arr)
-    evals,evects = numpy.linalg.eigh(covmat)
-    inds = np.argsort(evals)[::-1]
-    evals = evals[inds]
-    evects = evects[:,inds]
-    efuncarr = numpy.dot(arr,evects)
+    arr = _zero_masked(arr, mask)
+    ntime,nbolos = arr.shape
+    # with fewer samples than bolometers, the remaining eigenvectors have
+    # zero eigenvalues and are only found with the full V matrix
+    u,s,vt = numpy.linalg.svd(arr, full_matrices=ntime < nbolos)
+    evects = vt.T
+    evals = numpy.zeros(nbolos, dtype=s.dtype)
+    evals[:s.size] = s**2
+    efuncarr = numpy.zeros([ntime,nbolos], dtype=u.dtype)
+    efuncarr[:,:s.size] = u[:,:s.size]*s
     if return_others:
+        covmat = numpy.dot(evects*evals, evects.T)
         return efuncarr,covmat,evals,evects
     else:
         return efuncarr
@@ -219,12 +244,23 @@ def smooth_waterfall(arr,fwhm=4.0,unsharp=False):
     else:
         return arrconv
 
-def pca_subtract(arr,ncomps):
+def pca_subtract(arr,ncomps,method='dense',chunksize=None,**kwargs):
     """
     Compute the eigenfunctions and values of correlated data, then subtract off
     the *ncomps* most correlated components, transform back to the original
     space, and return that.
+
+    method - 'dense' diagonalizes the full nbolos x nbolos covariance matrix.
+        'randomized' (randomized_pca) or 'incremental' (incremental_pca) only
+        compute the *ncomps* components, and they and the subtraction work on
+        a chunk of samples at a time, so neither the covariance matrix nor
+        the eigenfunction array is ever built.  chunksize and kwargs are
+        passed to them.  'incremental' is only approximate; see
+        incremental_pca.
     """
+    if method != 'dense':
+        evals,evects = _truncated_pca(arr, ncomps, method, chunksize, **kwargs)
+        return project_components(arr, evects, keep=False, chunksize=chunksize)
     if hasattr(arr,'filled'):
         arr = arr.filled(0)
     covmat = numpy.dot(arr.T,arr)
@@ -233,11 +269,14 @@ def pca_subtract(arr,ncomps):
     efuncarr[:,0:ncomps] = 0
     return numpy.inner(efuncarr,evects)
 
-def unpca_subtract(arr,ncomps):
+def unpca_subtract(arr,ncomps,method='dense',chunksize=None,**kwargs):
     """
     Like pca_subtract, except `keep` the *ncomps* most correlated components
     and reject the others
     """
+    if method != 'dense':
+        evals,evects = _truncated_pca(arr, ncomps, method, chunksize, **kwargs)
+        return project_components(arr, evects, keep=True, chunksize=chunksize)
     if hasattr(arr,'filled'):
         arr = arr.filled(0)
     covmat = numpy.dot(arr.T,arr)
@@ -246,6 +285,111 @@ def unpca_subtract(arr,ncomps):
     efuncarr[:,ncomps:] = 0
     return numpy.inner(efuncarr,evects)
 
+def _truncated_pca(arr, ncomps, method, chunksize, **kwargs):
+    methods = {'randomized':randomized_pca, 'incremental':incremental_pca}
+    if method not in methods:
+        raise ValueError("method must be 'dense', 'randomized' or 'incremental'")
+    if chunksize is not None:
+        kwargs['chunksize'] = chunksize
+    return methods[method](arr, ncomps, **kwargs)
+
+def _chunks(arr, chunksize, mask=None):
+    """
+    Iterate over blocks of *chunksize* samples (rows) of arr, with masked
+    samples set to zero
+    """
+    for start in xrange(0, arr.shape[0], chunksize):
+        chunkmask = None if mask is None else mask[start:start+chunksize]
+        yield start, _zero_masked(arr[start:start+chunksize], chunkmask)
+
+def randomized_pca(arr, ncomps, oversample=10, niter=4, chunksize=4096,
+        mask=None, random_state=None):
+    """
+    The *ncomps* most correlated components of a (ntime x nbolos) array by
+    randomized subspace iteration (Halko, Martinsson & Tropp 2011).
+
+    A random block of ncomps+oversample vectors is multiplied by the
+    covariance matrix arr.T . arr niter+1 times, accumulating the product
+    over *chunksize* samples at a time, so each iteration is one pass through
+    the data (which can be a memmap) and only nbolos x (ncomps+oversample)
+    arrays are kept.  Masked samples, and those where `mask` is True, are
+    treated as zeros.
+
+    Returns evals (descending), evects (nbolos x ncomps), as efuncs would for
+    the first ncomps components
+    """
+    ntime,nbolos = arr.shape
+    nvec = min(ncomps+oversample, nbolos)
+    random_state = numpy.random.RandomState(random_state)
+    Q = numpy.linalg.qr(random_state.randn(nbolos,nvec))[0]
+    for ii in xrange(niter+1):
+        Z = numpy.zeros([nbolos,nvec])
+        for start,chunk in _chunks(arr, chunksize, mask):
+            Z += numpy.dot(chunk.T, numpy.dot(chunk,Q))
+        if ii < niter:
+            Q = numpy.linalg.qr(Z)[0]
+    # Rayleigh-Ritz: diagonalize the covariance restricted to the subspace
+    evals,evects = numpy.linalg.eigh(numpy.dot(Q.T,Z))
+    inds = numpy.argsort(evals)[::-1][:ncomps]
+    return evals[inds], numpy.dot(Q,evects[:,inds])
+
+def incremental_pca(arr, ncomps, chunksize=None, mask=None):
+    """
+    The *ncomps* most correlated components of a (ntime x nbolos) array from
+    a single pass through the data (Ross et al. 2008, without the mean
+    update).
+
+    Each chunk of *chunksize* samples is stacked under the current components
+    (scaled by their singular values) and the stack is decomposed with an
+    SVD, keeping the top ncomps.  Only the ncomps x nbolos components and one
+    chunk are in memory at a time.  Masked samples, and those where `mask` is
+    True, are treated as zeros.
+
+    Each update costs ~(chunksize+ncomps)^2 nbolos, so small chunks are
+    fastest; the default is max(32, 2*ncomps).
+
+    The result is an approximation: the variance outside the top ncomps
+    components is dropped at every update, so it is not exactly the dense
+    decomposition.  For example, on a 3000 x 60 array the components differ
+    from the dense ones by ~4e-4, compared to ~2e-9 for randomized_pca.  Use
+    randomized_pca (method='randomized' in pca_subtract) when the components
+    must match the dense ones; this is for when only one pass through the
+    data is possible.
+
+    Returns evals (descending), evects (nbolos x ncomps), as efuncs would
+    (approximately) for the first ncomps components
+    """
+    if chunksize is None:
+        chunksize = max(32, 2*ncomps)
+    sv,vt = None,None
+    for start,chunk in _chunks(arr, chunksize, mask):
+        if vt is not None:
+            chunk = numpy.concatenate([sv[:,numpy.newaxis]*vt, chunk])
+        u,sv,vt = numpy.linalg.svd(chunk, full_matrices=False)
+        sv,vt = sv[:ncomps],vt[:ncomps]
+    return sv**2, vt.T
+
+def project_components(arr, evects, keep=False, chunksize=None, mask=None,
+        out=None):
+    """
+    Remove (or, if keep, keep only) the components evects (nbolos x ncomps,
+    orthonormal columns) from a (ntime x nbolos) array, *chunksize* samples
+    at a time.  Masked samples are treated as zeros.
+
+    out - array to put the result in (can be arr itself, if it is not masked)
+    """
+    if chunksize is None:
+        chunksize = 4096
+    if out is None:
+        out = numpy.empty(arr.shape)
+    for start,chunk in _chunks(arr, chunksize, mask):
+        projected = numpy.dot(numpy.dot(chunk,evects),evects.T)
+        if keep:
+            out[start:start+chunk.shape[0]] = projected
+        else:
+            out[start:start+chunk.shape[0]] = chunk - projected
+    return out
+
 def pymc_linear_fit(data1, data2, data1err=None, data2err=None,
         print_results=False, intercept=True, nsample=5000, burn=1000,
         thin=10, return_MC=False, guess=None, ignore_nans=True,
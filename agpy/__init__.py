@@ -13,7 +13,7 @@ The functions included below are the 'mature' codes from the agpy package.
 from readcol import readcol
 ##from UCHIIfitter import HIIregion
 import gaussfitter
-from gaussfitter import moments,twodgaussian,gaussfit,onedgaussian,onedgaussfit
+from gaussfitter import moments,twodgaussian,gaussfit,onedgaussian,onedgaussfit,batch_gaussfit
 #import kdist
 from kdist import kdist,vector_kdist
 #from plfit import plfit
@@ -29,7 +29,7 @@ from contributed import parallel_map
 from timer import print_timing
 from region_photometry import region_photometry
 from region_photometry_files import region_photometry_files
-from PCA_tools import efuncs,pca_subtract,unpca_subtract,smooth_waterfall
+from PCA_tools import efuncs,pca_subtract,unpca_subtract,smooth_waterfall,randomized_pca,incremental_pca
 import constants
 import blackbody
 
@@ -26,6 +26,8 @@ import pyfits
 import time
 from mad import MAD
 from ratosexagesimal import ratos,dectos
+from gaussfitter import batch_gaussfit,neighbour_gaussfit,iteration_summary
+from numpy.lib.format import open_memmap
 
 def nanmedian(arr):
     """ nanmedian - this version is NOT capable of broadcasting (operating along axes) """
@@ -242,31 +244,29 @@ def collapse_gaussfit(cube,axis=2,negamp=False):
     starttime = time.time()
     print cube.shape
     print "Fitting a total of %i spectra with peak signal above %f" % ((cube.max(axis=0) > mean_std).sum(),mean_std)
-    for i in xrange(cube.shape[1]):
-        t0 = time.time()
-        nspec = (cube[:,i,:].max(axis=0) > mean_std).sum()
-        print "Working on row %d with %d spectra to fit" % (i,nspec) ,
-        for j in xrange(cube.shape[2]):
-            if not negamp and cube[:,i,j].max() > mean_std:
-                pars = return_param(cube[:,i,j],negamp=negamp)
-                width_arr[i,j] = pars[1]
-                chi2_arr[i,j] = sum(( gerr(cube[:,i,j])(pars) )**2) 
-                offset_arr[i,j] = pars[0]
-                amp_arr[i,j] = pars[2]
-            elif negamp and cube[:,i,j].min() < -1*mean_std:
-                pars = return_param(cube[:,i,j],negamp=negamp)
-                width_arr[i,j] = pars[1]
-                chi2_arr[i,j] = sum(( gerr(cube[:,i,j])(pars) )**2) 
-                offset_arr[i,j] = pars[0]
-                amp_arr[i,j] = pars[2]
-            else: 
-                width_arr[i,j] = numpy.nan
-                chi2_arr[i,j] = numpy.nan
-                offset_arr[i,j] = numpy.nan
-                amp_arr[i,j] = numpy.nan
-        dt = time.time()-t0
-        if nspec > 0:
-            print "in %f seconds (average: %f)" % (dt,dt/float(nspec))
+    if negamp:
+        tofit = cube.min(axis=0) < -1*mean_std
+    else:
+        tofit = cube.max(axis=0) > mean_std
+    width_arr[~tofit] = numpy.nan
+    chi2_arr[~tofit] = numpy.nan
+    offset_arr[~tofit] = numpy.nan
+    amp_arr[~tofit] = numpy.nan
+
+    # fit all of the spectra at once, starting from the same guesses as
+    # return_param.  gaussian() has no factor of 2 in the exponent, so the
+    # width is sqrt(2) times the batch_gaussfit width
+    spectra = cube[:,tofit].T
+    peak = spectra.argmin(axis=1) if negamp else spectra.argmax(axis=1)
+    guesses = array([spectra[arange(spectra.shape[0]),peak], peak,
+        zeros(spectra.shape[0])+5/numpy.sqrt(2)]).T
+    pars,errs,chi2 = batch_gaussfit(arange(cube.shape[0]), spectra,
+            vheight=False, params=guesses, limitedmin=[False,False,False],
+            quiet=False)
+    width_arr[tofit] = pars[:,2]*numpy.sqrt(2)
+    chi2_arr[tofit] = chi2
+    offset_arr[tofit] = pars[:,1]
+    amp_arr[tofit] = pars[:,0]
     print "Total time %f seconds" % (time.time()-starttime)
 
     return width_arr,offset_arr,amp_arr,chi2_arr
@@ -314,6 +314,158 @@ def collapse_double_gaussfit(cube,axis=2):
 
     return width_arr1,width_arr2,chi2_arr,offset_arr1,offset_arr2,amp_arr1,amp_arr2
 
+# the state of tiled_gaussfit that its worker processes inherit when they are
+# forked, so that the cube is shared rather than pickled
+_tile_state = {}
+
+def _fit_tile(tilenum):
+    """
+    Fit the spectra of one tile (see tiled_gaussfit) and write the results
+    to the output cube
+    """
+    state = _tile_state
+    ty,tx = divmod(tilenum, state['ntiles'][1])
+    ysl = slice(ty*state['tilesize'], (ty+1)*state['tilesize'])
+    xsl = slice(tx*state['tilesize'], (tx+1)*state['tilesize'])
+    tile = numpy.asarray(state['cube'][:,ysl,xsl], dtype='float')
+    nchan,ny,nx = tile.shape
+    spectra = tile.reshape(nchan,ny*nx).T
+
+    extremum = spectra.min(axis=1) if state['negamp'] else spectra.max(axis=1)
+    tofit = numpy.abs(extremum) > state['cutoff']
+    out = numpy.zeros([state['nplanes'],ny*nx]) + numpy.nan
+    if tofit.any() and state['warmstart']:
+        results = neighbour_gaussfit(state['xax'], tile,
+                tofit=tofit.reshape(ny,nx), order=state['warmstart'],
+                err=state['mean_std'], **state['fitkwargs'])
+        pars,errs,chi2,niter = [r.reshape(r.shape[:-2]+(ny*nx,))[...,tofit].T for r in results[:4]]
+    elif tofit.any():
+        pars,errs,chi2,niter,status = batch_gaussfit(state['xax'], spectra[tofit],
+                err=state['mean_std'], return_status=True, **state['fitkwargs'])
+    if tofit.any():
+        npars = pars.shape[1]
+        out[:npars,tofit] = pars.T
+        out[npars:2*npars,tofit] = errs.T
+        out[2*npars,tofit] = chi2
+        out[2*npars+1,tofit] = niter
+
+    output = open_memmap(state['outfile'], mode='r+')
+    output[:,ysl,xsl] = out.reshape(state['nplanes'],ny,nx)
+    output.flush()
+    del output
+    return tilenum
+
+def tiled_gaussfit(cube, outprefix, axis=0, ngauss=1, tilesize=32,
+        numcores=None, nsigcut=1.0, negamp=False, usemoments=None, xax=None,
+        warmstart=None, clobber=False, verbose=True, **kwargs):
+    """
+    Fit gaussians to every spectrum of a cube with gaussfitter.batch_gaussfit,
+    one spatial tile at a time, in parallel, writing the results to disk as
+    they come in so that an interrupted run can be resumed.
+
+    The results go to a memory-mapped .npy cube, outprefix+'_gausspars.npy',
+    with planes [params, errors, chi2, niter] (params and errors each have
+    npars planes: [height] + [amplitude, shift, width] * ngauss; niter is the
+    number of iterations of each fit).  Spectra whose
+    peak is below nsigcut times the median standard deviation of the spectra
+    are not fit and have NaN parameters.  The finished tiles are recorded in
+    outprefix+'_gausspars_done.npy'; if both files exist, only the unfinished
+    tiles are fit (unless clobber).
+
+    The tiles are fit by numcores worker processes (None = use all
+    available, 1 = fit them in this process).  The workers are forked, so
+    they share the cube instead of getting copies of it; pass a memmap (e.g.
+    from pyfits.open(..., memmap=True)) to avoid reading the whole cube into
+    memory at all.
+
+    cube - a data cube with two spatial and one spectral dimensions
+    axis - the axis of the spectral dimension
+    tilesize - the tiles are tilesize x tilesize spectra
+    usemoments - defaults to True if ngauss is 1 (otherwise, pass params)
+    warmstart - 'spiral' or 'scanline': within each tile, seed the fits from
+        converged neighbours (see gaussfitter.neighbour_gaussfit)
+    kwargs are passed to batch_gaussfit
+
+    returns:
+    params, errors, chi2, niter: (read-only) memory-mapped arrays of shape
+    (npars,ny,nx), (npars,ny,nx), (ny,nx) and (ny,nx)
+    """
+    import os
+    cube = numpy.rollaxis(cube, axis)
+    nchan,ny,nx = cube.shape
+    vheight = kwargs.get('vheight',True)
+    npars = 3*ngauss + (1 if vheight else 0)
+    nplanes = 2*npars+2
+    ntiles = ((ny-1)//tilesize+1, (nx-1)//tilesize+1)
+    if usemoments is None:
+        usemoments = ngauss == 1
+    if xax is None:
+        xax = arange(nchan)
+
+    outfile = '%s_gausspars.npy' % outprefix
+    donefile = '%s_gausspars_done.npy' % outprefix
+    if not clobber and os.path.exists(outfile) and os.path.exists(donefile):
+        output = open_memmap(outfile, mode='r')
+        done = open_memmap(donefile, mode='r+')
+        if output.shape != (nplanes,ny,nx) or done.shape != ntiles:
+            raise ValueError("%s exists but does not match this cube and model; "
+                    "use clobber=True to start over." % outfile)
+        del output
+    else:
+        output = open_memmap(outfile, mode='w+', shape=(nplanes,ny,nx))
+        output[:] = numpy.nan
+        output.flush()
+        del output
+        done = open_memmap(donefile, mode='w+', dtype='bool', shape=ntiles)
+        done.flush()
+
+    # the median spectral standard deviation, computed a few rows at a time
+    std_coll = numpy.concatenate([numpy.asarray(cube[:,ii:ii+tilesize,:]).std(axis=0).ravel()
+        for ii in xrange(0,ny,tilesize)])
+    mean_std = median(std_coll[std_coll > 0])
+
+    _tile_state.clear()
+    _tile_state.update(cube=cube, xax=xax, tilesize=tilesize, ntiles=ntiles,
+            nplanes=nplanes, outfile=outfile, negamp=negamp, warmstart=warmstart,
+            cutoff=mean_std*nsigcut, mean_std=mean_std,
+            fitkwargs=dict(kwargs, ngauss=ngauss, negamp=negamp, usemoments=usemoments))
+
+    todo = list(numpy.flatnonzero(~done.ravel()))
+    starttime = time.time()
+    if verbose:
+        print "Fitting %i of %i tiles of %ix%i spectra" % (len(todo),done.size,tilesize,tilesize)
+
+    if numcores == 1:
+        pool = None
+        finished = (_fit_tile(tilenum) for tilenum in todo)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(numcores)
+        finished = pool.imap_unordered(_fit_tile, todo)
+    try:
+        for count,tilenum in enumerate(finished):
+            # the tile has been flushed to disk by now, so record it
+            done.flat[tilenum] = True
+            done.flush()
+            if verbose and (count+1) % max(1,len(todo)//20) == 0:
+                print "Finished %i of %i tiles in %f seconds" % (count+1,len(todo),time.time()-starttime)
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            # stops the workers if a tile failed or on ctrl-C
+            pool.terminate()
+            pool.join()
+        _tile_state.clear()
+
+    output = open_memmap(outfile, mode='r')
+    if verbose:
+        print "Total time %f seconds" % (time.time()-starttime)
+        fitted = numpy.isfinite(output[2*npars])
+        print iteration_summary(output[2*npars+1][fitted].astype('int'))
+
+    return output[:npars],output[npars:2*npars],output[2*npars],output[2*npars+1]
+
 def wrap_collapse_gauss(filename,outprefix,redo='no'):
     """
 
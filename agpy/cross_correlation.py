@@ -3,8 +3,15 @@ Module to measure spectral cross-correlation...
 """
 import numpy as np
 import lmfit
+from AG_fft_tools.shift import shift1d,shift_stack
+from AG_fft_tools.fast_ffts import next_fast_len, get_ffts
 
 def fit_lag(arr1,arr2,kind='linear'):
+    """
+    Fit the lag of arr1 relative to arr2 (arr1 ~ shift(arr2, lag)) by
+    least-squares with lmfit.  To measure the lags of many spectra at once,
+    use fit_lags.
+    """
 
     if arr1.size != arr2.size:
         raise ValueError("Size mismatch")
@@ -24,11 +31,12 @@ def shift(data, deltax, phase=0):
     """
     FFT-based sub-pixel image shift
     http://www.mathworks.com/matlabcentral/fileexchange/18401-efficient-subpixel-image-registration-by-cross-correlation/content/html/efficient_subpixel_registration.html
+
+    Returns the complex shifted array (see AG_fft_tools.shift.shift1d and,
+    for many spectra at once, shift_stack)
     """
-    nx = data.size
-    Nx = np.fft.ifftshift(np.linspace(-np.fix(nx/2),np.ceil(nx/2)-1,nx))
-    gg = np.fft.ifft( np.fft.fft(data)* np.exp(1j*2*np.pi*(-deltax*Nx/nx)) * np.exp(-1j*phase) )
-    return gg
+    return shift1d(data, deltax, phase=phase, use_numpy_fft=True,
+            return_real=False)
 
 def chi2(arr1,arr2,lag):
     from scipy.interpolate import interp1d
@@ -47,6 +55,180 @@ def chi2(arr1,arr2,lag):
         raise ValueError("Uncaught NAN")
     return (arr1cp-shifted) / ngood**0.5
 
+# default maximum number of elements in a block of padded spectra
+block_elements = 2**20
+
+def _parabola_offset(left, center, right):
+    """
+    Offset of the vertex of the parabola through (-1,left), (0,center),
+    (1,right) from 0 (elementwise).  0 where there is no such maximum, e.g.
+    next to an excluded (-inf) lag.
+    """
+    denom = left - 2*center + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where((denom < 0) & np.isfinite(denom),
+                0.5*(left-right)/denom, 0)
+    return np.clip(offset, -0.5, 0.5)
+
+def fit_lags(spectra, template, axis=-1, refine='parabola', usfac=10,
+        maxlag=None, noise=None, zeromean=False, block_size=None,
+        nthreads=1, use_numpy_fft=False, fft_backend=None):
+    """
+    Measure the lags of many spectra relative to a template (or of many
+    pairs of spectra) at once: lag is the shift such that
+    spectrum ~ amplitude * shift(template, lag), as in fit_lag.
+
+    The integer lag is the peak of the (zero-padded) FFT cross-correlation,
+    computed for a block of spectra at a time, and is refined either by
+    fitting a parabola to the three channels around the peak or by
+    evaluating the cross-correlation on a grid 1/usfac of a channel wide
+    around it with an upsampled DFT (like dftups).
+
+    Parameters
+    ----------
+    spectra: `numpy.ndarray`
+        Spectra along `axis`, e.g. a (nv,ny,nx) cube with axis=0
+    template: `numpy.ndarray`
+        A single spectrum, or an array of spectra that broadcasts against
+        `spectra` (with the spectral axis at `axis`)
+    refine: 'parabola', 'dftups', or None
+        How to measure the sub-channel lag (None: integer lags only)
+    usfac: int
+        Upsampling factor for refine='dftups'
+    maxlag: int
+        Only look for lags up to maxlag channels
+    noise: float or `numpy.ndarray`
+        The noise per channel of the spectra, used for the uncertainties.
+        If not given, it is estimated from the residuals of the shifted,
+        scaled template.
+    zeromean: bool
+        Subtract the mean of each spectrum and template first.  Only useful
+        if the spectra have offset baselines: subtracting the mean biases
+        the lags of baselined spectra towards 0.
+    block_size: int
+        Number of spectra to transform together (default: keep each block
+        under `block_elements` elements)
+    nthreads, use_numpy_fft, fft_backend:
+        FFT options (see fast_ffts.get_ffts); the cross-correlations use the
+        backend's real FFTs
+
+    NaNs are treated as zeros.
+
+    Returns
+    -------
+    lags, errors: arrays with the shape of `spectra` without `axis`.  The
+    errors are the 1-sigma uncertainties of the lags, given the noise and
+    the slope of the template.
+
+    Example
+    -------
+    Velocity-offset map of a cube relative to its mean spectrum::
+
+        lags, errors = fit_lags(cube, cube.mean(axis=2).mean(axis=1), axis=0)
+    """
+    spectra = np.moveaxis(np.asarray(spectra, dtype='float'), axis, -1)
+    template = np.asarray(template, dtype='float')
+    if template.ndim > 1:
+        template = np.moveaxis(template, axis, -1)
+    nchan = spectra.shape[-1]
+    if template.shape[-1] != nchan:
+        raise ValueError("Size mismatch")
+    if refine not in ('parabola', 'dftups', None):
+        raise ValueError("refine must be 'parabola', 'dftups', or None")
+
+    outshape = np.broadcast(spectra[...,0], template[...,0]).shape
+    nspec = int(np.prod(outshape))
+    spectra = np.broadcast_to(spectra, outshape+(nchan,)).reshape(nspec, nchan)
+    if template.ndim > 1:
+        template = np.broadcast_to(template, outshape+(nchan,)).reshape(nspec, nchan)
+    if noise is not None:
+        noise = np.broadcast_to(np.asarray(noise, dtype='float'), outshape).ravel()
+
+    def prepare(arr):
+        arr = np.nan_to_num(arr)
+        if zeromean:
+            arr = arr - arr.mean(axis=-1)[...,np.newaxis]
+        return arr
+
+    rfftn,irfftn = get_ffts(nthreads=nthreads, use_numpy_fft=use_numpy_fft,
+            backend=fft_backend, real=True)
+
+    # pad to at least twice the length so the correlation does not wrap
+    nfft = next_fast_len(2*nchan)
+    if maxlag is None:
+        maxlag = nchan-1
+    lagvals = np.where(np.arange(nfft) <= nfft//2, np.arange(nfft),
+            np.arange(nfft)-nfft)
+    excluded = np.abs(lagvals) > maxlag
+
+    if refine == 'dftups':
+        # c(lag) = Re(sum_f w_f P_f exp(2 pi i f lag / nfft)) / nfft over
+        # the half spectrum P of the real FFT, on a grid of nout points
+        # 1/usfac apart centered on the integer peak
+        nout = int(np.ceil(usfac*1.5))
+        offsets = (np.arange(nout) - nout//2) / float(usfac)
+        freqs = np.arange(nfft//2+1)
+        weights = np.where((freqs == 0) | (2*freqs == nfft), 1., 2.) / nfft
+        kernel = weights[:,np.newaxis] * np.exp(2j*np.pi*np.multiply.outer(freqs, offsets)/nfft)
+
+    if template.ndim == 1:
+        tprep = prepare(template)
+        tfft = np.conj(rfftn(tprep, s=(nfft,)))
+        # sum of the squared slope of the template (for the uncertainties)
+        slope2 = np.sum(np.gradient(tprep)**2)
+
+    if block_size is None:
+        block_size = max(block_elements // nfft, 1)
+
+    lags = np.empty(nspec)
+    errors = np.empty(nspec)
+    for start in xrange(0, nspec, block_size):
+        block = slice(start, min(start+block_size, nspec))
+        sprep = prepare(spectra[block])
+        if template.ndim > 1:
+            tprep = prepare(template[block])
+            tfft = np.conj(rfftn(tprep, s=(nfft,), axes=(-1,)))
+            slope2 = np.sum(np.gradient(tprep, axis=-1)**2, axis=-1)
+        product = rfftn(sprep, s=(nfft,), axes=(-1,)) * tfft
+        xcorr = irfftn(product, s=(nfft,), axes=(-1,))
+        xcorr[:,excluded] = -np.inf
+        peak = np.argmax(xcorr, axis=-1)
+        rows = np.arange(xcorr.shape[0])
+        lag = lagvals[peak].astype('float')
+
+        if refine == 'parabola':
+            lag += _parabola_offset(xcorr[rows,(peak-1) % nfft],
+                    xcorr[rows,peak], xcorr[rows,(peak+1) % nfft])
+        elif refine == 'dftups':
+            phases = np.exp(2j*np.pi*np.multiply.outer(lag, freqs)/nfft)
+            upsampled = np.real(np.dot(product*phases, kernel))
+            lag += offsets[np.argmax(upsampled, axis=-1)]
+        lags[block] = lag
+
+        # uncertainties: sigma_lag = noise / (amplitude * sqrt(sum(t'^2)))
+        if template.ndim == 1:
+            shifted = shift_stack(np.broadcast_to(tprep, sprep.shape), lag,
+                    nthreads=nthreads, use_numpy_fft=use_numpy_fft,
+                    fft_backend=fft_backend)
+        else:
+            shifted = shift_stack(tprep, lag, nthreads=nthreads,
+                    use_numpy_fft=use_numpy_fft, fft_backend=fft_backend)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            amplitude = (sprep*shifted).sum(axis=-1) / (shifted**2).sum(axis=-1)
+            if noise is None:
+                resid = sprep - amplitude[:,np.newaxis]*shifted
+                # don't count the channels that wrapped around
+                chans = np.arange(nchan)
+                inside = ((chans - lag[:,np.newaxis] >= 0) &
+                          (chans - lag[:,np.newaxis] <= nchan-1))
+                sigma = np.sqrt((resid**2*inside).sum(axis=-1) /
+                        np.maximum(inside.sum(axis=-1)-2, 1))
+            else:
+                sigma = noise[block]
+            errors[block] = sigma / np.abs(amplitude) / np.sqrt(slope2)
+
+    return lags.reshape(outshape), errors.reshape(outshape)
+
 
 if __name__ == "__main__":
     print "Running test code"
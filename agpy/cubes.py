@@ -515,23 +515,81 @@ def coords_in_image(fitsfile,lon,lat,system='galactic'):
     else:
         return False
 
+def _spectral_kernel(smooth_factor, smoothtype='gaussian'):
+    """
+    The 1D kernel pyspeckit.smooth.smooth uses, centered on pixel n//2 as
+    convolve_axes expects
+    """
+    roundsmooth = int(round(smooth_factor))
+    if smoothtype == 'hanning':
+        kernel = numpy.hanning(2+roundsmooth)
+    elif smoothtype == 'gaussian':
+        xkern = numpy.linspace(-5*smooth_factor, 5*smooth_factor,
+                               int(smooth_factor*11))
+        kernel = numpy.exp(-xkern**2/(2*(smooth_factor/sqrt(8*numpy.log(2)))**2))
+    elif smoothtype == 'boxcar':
+        kernel = numpy.ones(roundsmooth)
+    else:
+        raise ValueError("Smoothing type %s not recognized" % smoothtype)
+    kernel = kernel / kernel.sum()
+    if kernel.size % 2 == 0:
+        # numpy.convolve(mode='same') centers even kernels on pixel n//2-1
+        kernel = numpy.concatenate([[0], kernel])
+    return kernel
+
 def spectral_smooth(cube, smooth_factor, downsample=True, parallel=True,
-                    numcores=None, **kwargs):
+                    numcores=None, batched=True, smoothtype='gaussian',
+                    downsample_factor=None, interpolate_nan=False, **kwargs):
     """
     Smooth the cube along the spectral direction
-    """
 
-    yy,xx = numpy.indices(cube.shape[1:])
+    Parameters
+    ----------
+    smooth_factor: float
+        FWHM of the gaussian (or width of the boxcar/hanning) kernel in
+        pixels, as in pyspeckit.smooth.smooth
+    downsample: bool
+        Keep only every downsample_factor'th (default: smooth_factor) plane
+    batched: bool
+        Smooth all of the spectra at once with one FFT along the spectral
+        axis (see AG_fft_tools.convolve_axes).  If False, call
+        pyspeckit.smooth.smooth on each spectrum (optionally in parallel)
+    interpolate_nan: bool
+        (batched only) Replace NaNs with the smoothed average of their
+        neighbors.  Otherwise NaNs are ignored and left in place.
+    kwargs are passed to convolve_axes (batched) or pyspeckit.smooth.smooth
+    """
+    if downsample_factor is None and downsample:
+        downsample_factor = int(round(smooth_factor))
+
+    if batched:
+        from AG_fft_tools import convolve_axes
+
+        kernel = _spectral_kernel(smooth_factor, smoothtype=smoothtype)
+        bad = (cube != cube)
+        newcube = convolve_axes(cube, kernel, axes=(0,),
+                                interpolate_nan=interpolate_nan, quiet=True,
+                                **kwargs)
+        if not interpolate_nan:
+            newcube[bad] = numpy.nan
+        if downsample:
+            newcube = newcube[::downsample_factor,:,:]
+        return newcube
+
+    import pyspeckit
+    from contributed import parallel_map
 
     if downsample:
-        newshape = cube[::smooth_factor,:,:].shape
+        newshape = cube[::downsample_factor,:,:].shape
     else:
         newshape = cube.shape
     
     # need to make the cube "flat" along dims 1&2 for iteration in the "map"
     flatshape = (cube.shape[0],cube.shape[1]*cube.shape[2])
 
-    Ssmooth = lambda x: pyspeckit.smooth.smooth(x, smooth_factor, downsample=downsample, **kwargs)
+    Ssmooth = lambda x: pyspeckit.smooth.smooth(x, smooth_factor,
+            downsample=downsample, downsample_factor=downsample_factor,
+            smoothtype=smoothtype, **kwargs)
     if parallel:
         newcube = numpy.array(parallel_map(Ssmooth, cube.reshape(flatshape).T, numcores=numcores)).T.reshape(newshape)
     else:
@@ -544,17 +602,34 @@ def spectral_smooth(cube, smooth_factor, downsample=True, parallel=True,
 
     return newcube
 
-def plane_smooth(cube,cubedim=0,parallel=True,numcores=None,**kwargs):
+def plane_smooth(cube,cubedim=0,parallel=True,numcores=None,batched=True,
+                 **kwargs):
     """
-    parallel-map the smooth function
+    Smooth each plane of the cube with AG_fft_tools.smooth
 
     Parameters
     ----------
+    batched: bool
+        defaults True.  Smooth all of the planes with one batched FFT
+        (AG_fft_tools.smooth_planes).  Set to False to parallel-map smooth
+        over the planes instead.  smooth's `method` keyword is ignored when
+        batched (all of the methods give the same result); if any other
+        keyword smooth_planes does not support is given (e.g. use_fft=False
+        or return_fft), the planes are smoothed one at a time.
     parallel: bool
         defaults True.  Set to false if you want serial (for debug purposes?)
+        Only used if batched=False
     numcores: int
         pass to parallel_map (None = use all available)
     """
+    if batched:
+        from AG_fft_tools.smooth_tools import smooth_planes,_plane_keywords
+        planekwargs = dict((k,v) for k,v in kwargs.items() if k != 'method')
+        if planekwargs.get('use_fft',True):
+            planekwargs.pop('use_fft',None)
+        if all(k in _plane_keywords for k in planekwargs):
+            return smooth_planes(cube, cubedim=cubedim, **planekwargs)
+
     from AG_fft_tools import smooth
     from contributed import parallel_map
 
@@ -11,6 +11,7 @@ As of January 30, 2014, gaussfitter has its own code repo on github:
 
 """
 import numpy as np
+import time
 from numpy.ma import median
 from numpy import pi
 #from scipy import optimize,stats,pi
@@ -65,6 +66,61 @@ def moments(data,circle,rotate,vheight,estimator=median,**kwargs):
         mylist = mylist + [width]
     return mylist
 
+# np.indices grids for the image shapes being fitted, so that the model is not
+# evaluated on a freshly built grid at every call
+_indices_cache = {}
+
+def _indices(shape):
+    """
+    The (cached, read-only) np.indices grid of an image of the given shape
+    """
+    shape = tuple(shape)
+    if shape not in _indices_cache:
+        if len(_indices_cache) > 16:
+            _indices_cache.clear()
+        grid = np.indices(shape, dtype='float')
+        grid.flags.writeable = False
+        _indices_cache[shape] = grid
+    return _indices_cache[shape]
+
+def _twodgaussian_pars(inpars, circle, rotate, vheight):
+    """
+    Unpack the parameter list of twodgaussian into
+    (height, amplitude, center_y, center_x, width_x, width_y, rota, rotate),
+    with rota in radians.  Circles don't rotate, so rotate is returned as 0
+    for them.
+    """
+    inpars_old = inpars
+    inpars = list(inpars)
+    if vheight == 1:
+        height = inpars.pop(0)
+        height = float(height)
+    else:
+        height = float(0)
+    amplitude, center_y, center_x = inpars.pop(0),inpars.pop(0),inpars.pop(0)
+    amplitude = float(amplitude)
+    center_x = float(center_x)
+    center_y = float(center_y)
+    if circle == 1:
+        width = inpars.pop(0)
+        width_x = float(width)
+        width_y = float(width)
+        rotate = 0
+    else:
+        width_x, width_y = inpars.pop(0),inpars.pop(0)
+        width_x = float(width_x)
+        width_y = float(width_y)
+    if rotate == 1:
+        rota = inpars.pop(0)
+        rota = pi/180. * float(rota)
+    else:
+        rota = 0.
+    if len(inpars) > 0:
+        raise ValueError("There are still input parameters:" + str(inpars) + \
+                " and you've input: " + str(inpars_old) + \
+                " circle=%d, rotate=%d, vheight=%d" % (circle,rotate,vheight) )
+    return height, amplitude, center_y, center_x, width_x, width_y, rota, rotate
+
 def twodgaussian(inpars, circle=False, rotate=True, vheight=True, shape=None):
     """Returns a 2d gaussian function of the form:
         x' = np.cos(rota) * x - np.sin(rota) * y
@@ -95,39 +151,15 @@ def twodgaussian(inpars, circle=False, rotate=True, vheight=True, shape=None):
             shape=None - if shape is set (to a 2-parameter list) then returns
                 an image with the gaussian defined by inpars
         """
-    inpars_old = inpars
-    inpars = list(inpars)
-    if vheight == 1:
-        height = inpars.pop(0)
-        height = float(height)
-    else:
-        height = float(0)
-    amplitude, center_y, center_x = inpars.pop(0),inpars.pop(0),inpars.pop(0)
-    amplitude = float(amplitude)
-    center_x = float(center_x)
-    center_y = float(center_y)
-    if circle == 1:
-        width = inpars.pop(0)
-        width_x = float(width)
-        width_y = float(width)
-        rotate = 0
-    else:
-        width_x, width_y = inpars.pop(0),inpars.pop(0)
-        width_x = float(width_x)
-        width_y = float(width_y)
+    height, amplitude, center_y, center_x, width_x, width_y, rota, rotate = \
+            _twodgaussian_pars(inpars, circle, rotate, vheight)
     if rotate == 1:
-        rota = inpars.pop(0)
-        rota = pi/180. * float(rota)
         rcen_x = center_x * np.cos(rota) - center_y * np.sin(rota)
         rcen_y = center_x * np.sin(rota) + center_y * np.cos(rota)
     else:
         rcen_x = center_x
         rcen_y = center_y
-    if len(inpars) > 0:
-        raise ValueError("There are still input parameters:" + str(inpars) + \
-                " and you've input: " + str(inpars_old) + \
-                " circle=%d, rotate=%d, vheight=%d" % (circle,rotate,vheight) )
-            
+
     def rotgauss(x,y):
         if rotate==1:
             xp = x * np.cos(rota) - y * np.sin(rota)
@@ -140,11 +172,53 @@ def twodgaussian(inpars, circle=False, rotate=True, vheight=True, shape=None):
             ((rcen_y-yp)/width_y)**2)/2.)
         return g
     if shape is not None:
-        return rotgauss(*np.indices(shape))
+        return rotgauss(*_indices(shape))
     else:
         return rotgauss
 
-def gaussfit(data,err=None,params=(),autoderiv=True,return_all=False,circle=False,
+def twodgaussian_jacobian(inpars, circle=False, rotate=True, vheight=True,
+        shape=None):
+    """
+    Returns a function giving the analytic derivatives of twodgaussian with
+    respect to each of its parameters, in the same order (and with the same
+    circle, rotate and vheight options) as inpars.  The derivative with
+    respect to the rotation is per degree.
+
+    The returned function of (x,y) gives an array of shape
+    (len(inpars),) + x.shape.  If shape is set, returns that array evaluated
+    on an image of that shape instead.
+    """
+    height, amplitude, center_y, center_x, width_x, width_y, rota, rotate = \
+            _twodgaussian_pars(inpars, circle, rotate, vheight)
+    cosr, sinr = np.cos(rota), np.sin(rota)
+
+    def rotgauss_jacobian(x,y):
+        a = center_x - x
+        b = center_y - y
+        u = (a*cosr - b*sinr) / width_x
+        v = (a*sinr + b*cosr) / width_y
+        expterm = np.exp(-(u**2+v**2)/2.)
+        aexp = amplitude*expterm
+        derivs = [expterm,
+                -aexp * (v*cosr/width_y - u*sinr/width_x), # center_y
+                -aexp * (u*cosr/width_x + v*sinr/width_y)] # center_x
+        if circle == 1:
+            derivs.append(aexp * (u**2+v**2) / width_x)
+        else:
+            derivs += [aexp * u**2 / width_x, aexp * v**2 / width_y]
+        if rotate == 1:
+            dudr = (-a*sinr - b*cosr) / width_x
+            dvdr = (a*cosr - b*sinr) / width_y
+            derivs.append(-aexp * (u*dudr + v*dvdr) * pi/180.)
+        if vheight == 1:
+            derivs.insert(0, np.ones(expterm.shape))
+        return np.array(derivs)
+    if shape is not None:
+        return rotgauss_jacobian(*_indices(shape))
+    else:
+        return rotgauss_jacobian
+
+def gaussfit(data,err=None,params=(),autoderiv=False,return_all=False,circle=False,
         fixed=np.repeat(False,7),limitedmin=[False,False,False,False,True,True,True],
         limitedmax=[False,False,False,False,False,False,True],
         usemoment=np.array([],dtype='bool'),
@@ -162,9 +236,10 @@ def gaussfit(data,err=None,params=(),autoderiv=True,return_all=False,circle=Fals
             (height, amplitude, x, y, width_x, width_y, rota)
             if not input, these will be determined from the moments of the system, 
             assuming no rotation
-        autoderiv=1 - use the autoderiv provided in the lmder.f function (the
-            alternative is to us an analytic derivative with lmdif.f: this method
-            is less robust)
+        autoderiv=0 - use the analytic derivatives of the gaussian
+            (twodgaussian_jacobian).  Set autoderiv=1 to have mpfit compute
+            the derivatives by finite differences instead, which costs one
+            extra model evaluation per free parameter per iteration
         return_all=0 - Default is to return only the Gaussian parameters.  
                    1 - fit params, fit error
         returnfitimage - returns (best fit params,best fit image)
@@ -214,19 +289,26 @@ def gaussfit(data,err=None,params=(),autoderiv=True,return_all=False,circle=Fals
         if params[i] > maxpars[i] and limitedmax[i]: params[i] = maxpars[i]
         if params[i] < minpars[i] and limitedmin[i]: params[i] = minpars[i]
 
+    grid = _indices(data.shape)
     if err is None:
         errorfunction = lambda p: np.ravel((twodgaussian(p,circle,rotate,vheight)\
-                (*np.indices(data.shape)) - data))
+                (*grid) - data))
     else:
         errorfunction = lambda p: np.ravel((twodgaussian(p,circle,rotate,vheight)\
-                (*np.indices(data.shape)) - data)/err)
+                (*grid) - data)/err)
     def mpfitfun(data,err):
         if err is None:
-            def f(p,fjac=None): return [0,np.ravel(data-twodgaussian(p,circle,rotate,vheight)\
-                    (*np.indices(data.shape)))]
+            weight = 1.0
         else:
-            def f(p,fjac=None): return [0,np.ravel((data-twodgaussian(p,circle,rotate,vheight)\
-                    (*np.indices(data.shape)))/err)]
+            weight = np.ravel(1.0/err)
+        def f(p,fjac=None):
+            resid = np.ravel(data-twodgaussian(p,circle,rotate,vheight)(*grid))*weight
+            if fjac is None:
+                return [0,resid]
+            # mpfit wants the derivatives of the model (not of the
+            # residuals) with shape (npix, npars)
+            jac = twodgaussian_jacobian(p,circle,rotate,vheight)(*grid)
+            return [0,resid,(jac.reshape(len(p),-1)*weight).T]
         return f
 
                     
@@ -242,16 +324,10 @@ def gaussfit(data,err=None,params=(),autoderiv=True,return_all=False,circle=Fals
         if rotate == 1:
             parinfo.append({'n':6,'value':params[6],'limits':[minpars[6],maxpars[6]],'limited':[limitedmin[6],limitedmax[6]],'fixed':fixed[6],'parname':"ROTATION",'error':0})
 
-    if autoderiv == 0:
-        # the analytic derivative, while not terribly difficult, is less
-        # efficient and useful.  I only bothered putting it here because I was
-        # instructed to do so for a class project - please ask if you would
-        # like this feature implemented
-        raise ValueError("I'm sorry, I haven't implemented this feature yet.")
-    else:
-#        p, cov, infodict, errmsg, success = optimize.leastsq(errorfunction,\
-#                params, full_output=1)
-        mp = mpfit(mpfitfun(data,err),parinfo=parinfo,quiet=quiet)
+#    p, cov, infodict, errmsg, success = optimize.leastsq(errorfunction,\
+#            params, full_output=1)
+    mp = mpfit(mpfitfun(data,err),parinfo=parinfo,quiet=quiet,
+            autoderivative=int(bool(autoderiv)))
 
 
     if returnmp:
@@ -261,7 +337,7 @@ def gaussfit(data,err=None,params=(),autoderiv=True,return_all=False,circle=Fals
     elif return_all == 1:
         returns = mp.params,mp.perror
     if returnfitimage:
-        fitimage = twodgaussian(mp.params,circle,rotate,vheight)(*np.indices(data.shape))
+        fitimage = twodgaussian(mp.params,circle,rotate,vheight)(*grid)
         returns = (returns,fitimage)
     return returns
 
@@ -322,6 +398,16 @@ def onedgaussian(x,H,A,dx,w):
     """
     return H+A*np.exp(-(x-dx)**2/(2*w**2))
 
+def onedgaussian_jacobian(x,H,A,dx,w):
+    """
+    Returns the derivatives of onedgaussian with respect to H, A, dx and w,
+    as an array of shape (4, len(x))
+    """
+    expterm = np.exp(-(x-dx)**2/(2*w**2))
+    aexp = A*expterm
+    return np.array([np.ones(np.shape(x)), expterm, aexp*(x-dx)/w**2,
+        aexp*(x-dx)**2/w**3])
+
 def onedgaussfit(xax, data, err=None,
         params=[0,1,0,1],fixed=[False,False,False,False],
         limitedmin=[False,False,False,True],
@@ -329,7 +415,7 @@ def onedgaussfit(xax, data, err=None,
         maxpars=[0,0,0,0], quiet=True, shh=True,
         veryverbose=False,
         vheight=True, negamp=False,
-        usemoments=False):
+        usemoments=False, autoderiv=False):
     """
     Inputs:
        xax - x axis
@@ -343,6 +429,8 @@ def onedgaussfit(xax, data, err=None,
        quiet - should MPFIT output each iteration?
        shh - output final parameters?
        usemoments - replace default parameters with moments
+       autoderiv - have mpfit compute the derivatives by finite differences
+           instead of using the analytic derivatives (onedgaussian_jacobian)
 
     Returns:
        Fit parameters
@@ -353,9 +441,14 @@ def onedgaussfit(xax, data, err=None,
 
     def mpfitfun(x,y,err):
         if err is None:
-            def f(p,fjac=None): return [0,(y-onedgaussian(x,*p))]
+            weight = 1.0
         else:
-            def f(p,fjac=None): return [0,(y-onedgaussian(x,*p))/err]
+            weight = 1.0/err
+        def f(p,fjac=None):
+            if fjac is None:
+                return [0,(y-onedgaussian(x,*p))*weight]
+            return [0,(y-onedgaussian(x,*p))*weight,
+                    (onedgaussian_jacobian(x,*p)*weight).T]
         return f
 
     if xax == None:
@@ -374,7 +467,8 @@ def onedgaussfit(xax, data, err=None,
                 {'n':2,'value':params[2],'limits':[minpars[2],maxpars[2]],'limited':[limitedmin[2],limitedmax[2]],'fixed':fixed[2],'parname':"SHIFT",'error':0},
                 {'n':3,'value':params[3],'limits':[minpars[3],maxpars[3]],'limited':[limitedmin[3],limitedmax[3]],'fixed':fixed[3],'parname':"WIDTH",'error':0}]
 
-    mp = mpfit(mpfitfun(xax,data,err),parinfo=parinfo,quiet=quiet)
+    mp = mpfit(mpfitfun(xax,data,err),parinfo=parinfo,quiet=quiet,
+            autoderivative=int(bool(autoderiv)))
     mpp = mp.params
     mpperr = mp.perror
     chi2 = mp.fnorm
@@ -419,10 +513,33 @@ def n_gaussian(pars=None,a=None,dx=None,sigma=None):
         return v
     return g
 
+def n_gaussian_jacobian(pars=None,a=None,dx=None,sigma=None):
+    """
+    Returns a function giving the derivatives of n_gaussian with respect to
+    each of its parameters, as an array of shape (3n, len(x)) in the order of
+    pars (a, dx, sigma repeated)
+    """
+    if len(pars) % 3 == 0:
+        a = [pars[ii] for ii in xrange(0,len(pars),3)]
+        dx = [pars[ii] for ii in xrange(1,len(pars),3)]
+        sigma = [pars[ii] for ii in xrange(2,len(pars),3)]
+    elif not(len(dx) == len(sigma) == len(a)):
+        raise ValueError("Wrong array lengths! dx: %i  sigma: %i  a: %i" % (len(dx),len(sigma),len(a)))
+
+    def g(x):
+        derivs = np.empty([3*len(dx),len(x)])
+        for i in range(len(dx)):
+            expterm = np.exp( - ( x - dx[i] )**2 / (2.0*sigma[i]**2) )
+            derivs[3*i] = expterm
+            derivs[3*i+1] = a[i] * expterm * (x - dx[i]) / sigma[i]**2
+            derivs[3*i+2] = a[i] * expterm * (x - dx[i])**2 / sigma[i]**3
+        return derivs
+    return g
+
 def multigaussfit(xax, data, ngauss=1, err=None, params=[1,0,1],
         fixed=[False,False,False], limitedmin=[False,False,True],
         limitedmax=[False,False,False], minpars=[0,0,0], maxpars=[0,0,0],
-        quiet=True, shh=True, veryverbose=False):
+        quiet=True, shh=True, veryverbose=False, autoderiv=False):
     """
     An improvement on onedgaussfit.  Lets you fit multiple gaussians.
 
@@ -442,6 +559,8 @@ def multigaussfit(xax, data, ngauss=1, err=None, params=[1,0,1],
 
        quiet - should MPFIT output each iteration?
        shh - output final parameters?
+       autoderiv - have mpfit compute the derivatives by finite differences
+           instead of using the analytic derivatives (n_gaussian_jacobian)
 
     Returns:
        Fit parameters
@@ -473,9 +592,14 @@ def multigaussfit(xax, data, ngauss=1, err=None, params=[1,0,1],
 
     def mpfitfun(x,y,err):
         if err is None:
-            def f(p,fjac=None): return [0,(y-n_gaussian(pars=p)(x))]
+            weight = 1.0
         else:
-            def f(p,fjac=None): return [0,(y-n_gaussian(pars=p)(x))/err]
+            weight = 1.0/err
+        def f(p,fjac=None):
+            if fjac is None:
+                return [0,(y-n_gaussian(pars=p)(x))*weight]
+            return [0,(y-n_gaussian(pars=p)(x))*weight,
+                    (n_gaussian_jacobian(pars=p)(x)*weight).T]
         return f
 
     if xax == None:
@@ -493,7 +617,8 @@ def multigaussfit(xax, data, ngauss=1, err=None, params=[1,0,1],
         print "GUESSES: "
         print "\n".join(["%s: %s" % (p['parname'],p['value']) for p in parinfo])
 
-    mp = mpfit(mpfitfun(xax,data,err),parinfo=parinfo,quiet=quiet)
+    mp = mpfit(mpfitfun(xax,data,err),parinfo=parinfo,quiet=quiet,
+            autoderivative=int(bool(autoderiv)))
     mpp = mp.params
     mpperr = mp.perror
     chi2 = mp.fnorm
@@ -510,9 +635,485 @@ def multigaussfit(xax, data, ngauss=1, err=None, params=[1,0,1],
 
     return mpp,n_gaussian(pars=mpp)(xax),mpperr,chi2
 
+def batch_gaussian(xax, params, vheight=True, return_jacobian=False):
+    """
+    Evaluate single- or multi-Gaussian models for many spectra at once.
+
+    params - (nspec, npars) array.  The parameters of each spectrum are
+        [height] + [amplitude, shift, width] * ngauss (no height unless
+        vheight), i.e. those of onedgaussian or n_gaussian
+    return_jacobian - also return the derivatives of the models with respect
+        to each parameter, an (nspec, npars, nchan) array
+
+    Returns the (nspec, nchan) array of models
+    """
+    xax = np.asarray(xax, dtype='float')
+    params = np.asarray(params, dtype='float')
+    nspec,npars = params.shape
+    first = 1 if vheight else 0
+    if (npars - first) % 3 != 0:
+        raise ValueError("Wrong number of parameters: %i" % npars)
+    amp = params[:,first::3,np.newaxis]
+    dx = xax - params[:,first+1::3,np.newaxis]
+    width = params[:,first+2::3,np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gauss = np.exp(-dx**2/(2*width**2))
+        model = (amp*gauss).sum(axis=1)
+        if vheight:
+            model += params[:,:1]
+        if not return_jacobian:
+            return model
+        jac = np.empty([nspec,npars,xax.size])
+        if vheight:
+            jac[:,0,:] = 1
+        jac[:,first::3,:] = gauss
+        jac[:,first+1::3,:] = amp*gauss*dx/width**2
+        jac[:,first+2::3,:] = amp*gauss*dx**2/width**3
+    return model,jac
+
+def _batch_onedmoments(xax, spectra, vheight=True, negamp=None):
+    """
+    onedmoments for every spectrum in an (nspec, nchan) array at once
+    """
+    xax = np.asarray(xax, dtype='float')
+    nchan = xax.size
+    dx = np.mean(xax[1:] - xax[:-1]) # assume a regular grid
+    integral = (spectra*dx).sum(axis=1)
+    height = np.median(spectra, axis=1)
+    above = spectra > height[:,np.newaxis]
+    below = spectra < height[:,np.newaxis]
+
+    Lpeakintegral = integral - height*nchan*dx - (spectra*above*dx).sum(axis=1)
+    Lamplitude = spectra.min(axis=1)-height
+    Hpeakintegral = integral - height*nchan*dx - (spectra*below*dx).sum(axis=1)
+    Hamplitude = spectra.max(axis=1)-height
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Lwidth_x = 0.5*(np.abs(Lpeakintegral / Lamplitude))
+        Hwidth_x = 0.5*(np.abs(Hpeakintegral / Hamplitude))
+
+    if negamp:
+        negative = np.ones(spectra.shape[0], dtype='bool')
+    elif negamp is None:
+        def stddev(selection):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                n = selection.sum(axis=1)
+                mean = (selection*xax).sum(axis=1) / n
+                return np.sqrt((selection*xax**2).sum(axis=1) / n - mean**2)
+        mean = spectra.mean(axis=1)[:,np.newaxis]
+        negative = stddev(spectra > mean) >= stddev(spectra < mean)
+    else:
+        negative = np.zeros(spectra.shape[0], dtype='bool')
+
+    xcen = np.where(negative, xax[np.argmin(spectra,axis=1)], xax[np.argmax(spectra,axis=1)])
+    amplitude = np.where(negative, Lamplitude, Hamplitude)
+    width_x = np.where(negative, Lwidth_x, Hwidth_x)
+
+    moments = [amplitude,xcen,width_x]
+    if vheight:
+        moments = [height] + moments
+    return np.array(moments).T
+
+def _batch_lm(xax, data, weights, params, free, lower, upper, vheight=True,
+        maxiter=200, ftol=1e-10, xtol=1e-10):
+    """
+    Levenberg-Marquardt minimization of sum((weights*(data-model))**2) for
+    many spectra at once (see batch_gaussfit).  Every spectrum has its own
+    damping parameter, and the spectra that have converged are dropped from
+    the arrays that are iterated on.
+
+    The limits are handled as in mpfit: a parameter pegged at a limit is
+    held there while the gradient pushes it outward, and a step that would
+    leave the limits is shortened to end on the limit.  The damping is
+    scaled by the largest curvature seen so far for each parameter, so a
+    component whose derivatives vanish cannot take an unbounded step.
+
+    Returns params, errors, chi2, niter, status (1 = converged, 2 = stopped
+    with a degenerate component, 5 = maxiter reached, 0 = could not be fit)
+    """
+    nspec,npars = params.shape
+    first = 1 if vheight else 0
+    # keep the widths strictly positive: the model is singular at 0
+    widths = slice(first+2, None, 3)
+    minwidth = 1e-3*np.abs(np.diff(xax)).min()
+    lower = np.array(lower, dtype='float')
+    lower[widths] = np.maximum(lower[widths], minwidth)
+    params = np.clip(params, lower, upper)
+    errors = np.zeros([nspec,npars])
+    niter = np.zeros(nspec, dtype='int')
+    status = np.zeros(nspec, dtype='int')
+    diagonal = np.arange(npars)
+
+    def residuals(idx, pars, jacobian=False):
+        result = batch_gaussian(xax, pars, vheight=vheight, return_jacobian=jacobian)
+        if jacobian:
+            model,jac = result
+            # 0/0 where a width is 0; the derivatives are 0 in that limit
+            jac[~np.isfinite(jac)] = 0
+            return (data[idx]-model)*weights[idx], jac*weights[idx,np.newaxis,:]
+        return (data[idx]-result)*weights[idx]
+
+    def normal_matrix(jac, varying):
+        # the parameters that are not varying get an identity row and
+        # column, so they never change and the matrix stays invertible
+        alpha = np.einsum('sik,sjk->sij', jac, jac)
+        alpha *= varying[:,:,np.newaxis] & varying[:,np.newaxis,:]
+        alpha[:,diagonal,diagonal] += ~varying
+        return alpha
+
+    resid,jac = residuals(np.arange(nspec), params, jacobian=True)
+    chi2 = (resid**2).sum(axis=1)
+    active = np.flatnonzero(np.isfinite(chi2))
+    resid,jac = resid[active],jac[active]
+    lam = np.zeros(active.size) + 1.
+    scale = np.zeros([active.size,npars])
+
+    for ii in xrange(maxiter):
+        if active.size == 0:
+            break
+        old_params = params[active]
+        beta = np.einsum('sik,sk->si', jac, resid) * free
+        # hold the parameters pegged at a limit that the gradient pushes
+        # outward
+        atlower = free & (old_params <= lower)
+        atupper = free & (old_params >= upper)
+        varying = free & ~(atlower & (beta < 0)) & ~(atupper & (beta > 0))
+        beta *= varying
+        alpha = normal_matrix(jac, varying)
+        scale = np.maximum(scale, alpha[:,diagonal,diagonal])
+        damped = alpha.copy()
+        damped[:,diagonal,diagonal] += lam[:,np.newaxis]*np.where(scale > 0, scale, 1)
+        step = np.linalg.solve(damped, beta)
+        step[(atlower & (step < 0)) | (atupper & (step > 0))] = 0
+
+        # shorten the steps that would leave the limits
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tolimit = np.where(old_params+step < lower, (lower-old_params)/step,
+                    np.where(old_params+step > upper, (upper-old_params)/step, 1))
+        step *= tolimit.min(axis=1)[:,np.newaxis]
+        trial = np.clip(old_params + step, lower, upper)
+        trial_resid = residuals(active, trial)
+        trial_chi2 = (trial_resid**2).sum(axis=1)
+        old_chi2 = chi2[active]
+        better = trial_chi2 < old_chi2
+        niter[active] += 1
+
+        # accept the improved steps and recompute their Jacobians
+        if better.any():
+            idx = active[better]
+            params[idx] = trial[better]
+            chi2[idx] = trial_chi2[better]
+            resid[better],jac[better] = residuals(idx, trial[better], jacobian=True)
+        # (not below 1e-10, where the damped matrix can become singular)
+        lam = np.where(better, np.maximum(lam/10., 1e-10), lam*10.)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            small_change = better & ((old_chi2-trial_chi2) <= ftol*old_chi2)
+            small_step = (np.abs(trial-old_params) <= xtol*(np.abs(old_params)+xtol)).all(axis=1)
+        done = small_change | small_step | (chi2[active] == 0) | (lam > 1e16)
+        status[active[done]] = 1
+        keep = ~done
+        active,resid,jac,lam,scale = active[keep],resid[keep],jac[keep],lam[keep],scale[keep]
+
+    status[active] = 5
+
+    # a component that has shrunk onto the smallest allowed width, or that
+    # has wandered off the data, has no derivatives: the minimization stops
+    # there, but it has not converged
+    fitted = np.flatnonzero(status > 0)
+    if fitted.size > 0:
+        resid,jac = residuals(fitted, params[fitted], jacobian=True)
+        pinned = (free[widths] & (params[fitted][:,widths] <= minwidth)).any(axis=1)
+        amplitudes = slice(first, None, 3)
+        offdata = (free[amplitudes] & (np.abs(jac[:,amplitudes,:]).max(axis=2) <
+            1e-8*np.abs(jac[:,amplitudes,:]).max(axis=(1,2))[:,np.newaxis])).any(axis=1)
+        status[fitted[pinned | offdata]] = 2
+
+        # parameter errors from the covariance matrix at the best fit, as
+        # mpfit's perror (i.e. not scaled by the reduced chi^2)
+        evals,evects = np.linalg.eigh(normal_matrix(jac, free & np.ones([fitted.size,1],dtype='bool')))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            covar = np.einsum('sik,sk,sjk->sij', evects, 1/evals, evects)
+        variance = covar[:,diagonal,diagonal]
+        errors[fitted] = np.sqrt(np.abs(variance)) * free
+    errors[status == 0] = np.nan
+    params[status == 0] = np.nan
+    chi2[status == 0] = np.nan
+
+    return params,errors,chi2,niter,status
+
+def _batch_parlists(ngauss, vheight=True, params=None, fixed=None,
+        limitedmin=None, limitedmax=None, minpars=None, maxpars=None):
+    """
+    Expand the parameter lists of batch_gaussfit to npars elements (see
+    there), and return params, free, lower, upper (lower and upper are
+    -inf/inf where there is no limit)
+    """
+    first = 1 if vheight else 0
+    npars = 3*ngauss + first
+    defaults = {'params':[0]+[1,0,1] if vheight else [1,0,1],
+            'fixed':[False]*(first+3),
+            'limitedmin':[False]*first+[False,False,True],
+            'limitedmax':[False]*(first+3),
+            'minpars':[0]*(first+3), 'maxpars':[0]*(first+3)}
+    def parlist(name, value):
+        if value is None:
+            value = defaults[name]
+        value = np.asarray(value)
+        if name == 'params' and value.ndim == 2:
+            return value
+        if value.size == first+3 and ngauss > 1:
+            value = np.concatenate([value[:first]] + [value[first:]]*ngauss)
+        if value.size != npars:
+            raise ValueError("%s must have %i elements" % (name,npars))
+        return value
+
+    free = ~parlist('fixed',fixed).astype('bool')
+    lower = np.where(parlist('limitedmin',limitedmin), parlist('minpars',minpars), -np.inf)
+    upper = np.where(parlist('limitedmax',limitedmax), parlist('maxpars',maxpars), np.inf)
+    return parlist('params',params),free,lower,upper
+
+def batch_gaussfit(xax, spectra, err=None, ngauss=1, params=None, fixed=None,
+        limitedmin=None, limitedmax=None, minpars=None, maxpars=None,
+        vheight=True, negamp=False, usemoments=False, maxiter=200,
+        ftol=1e-10, xtol=1e-10, blocksize=256, return_status=False,
+        quiet=True):
+    """
+    Fit Gaussians to many spectra at once.  The same model as onedgaussfit
+    (ngauss=1, vheight=True) or multigaussfit (vheight=False) is fitted to
+    every spectrum by a Levenberg-Marquardt minimization that works on whole
+    arrays of spectra: the Jacobians are analytic and computed for all of the
+    spectra together, each spectrum has its own damping, and the spectra that
+    have converged are dropped from the iteration.  This avoids the python
+    overhead of calling mpfit once per spectrum.
+
+    Inputs:
+       xax - x axis (nchan)
+       spectra - (nspec, nchan) array.  NaNs and masked channels get no weight.
+       err - error: scalar, (nchan) or (nspec, nchan)
+       ngauss - number of gaussians
+
+     These parameters need to have length npars = 3*ngauss (+1 if vheight),
+     or, if they have length 3 (4 if vheight), they are replicated ngauss
+     times:
+       params - Fit parameters: [height] + [amplitude, shift, width] * ngauss.
+              Can also be an (nspec, npars) array of guesses, one per spectrum.
+       fixed - Is parameter fixed?
+       limitedmin/minpars - set lower limits on each parameter (default: width>0)
+       limitedmax/maxpars - set upper limits on each parameter
+
+       usemoments - replace the guesses with the moments of each spectrum
+           (see onedmoments; ngauss=1 only)
+       negamp - passed to onedmoments
+       maxiter, ftol, xtol - convergence criteria, as in mpfit
+       blocksize - number of spectra to fit together (memory use is
+           ~ 8*blocksize*nchan*npars bytes)
+       quiet - print the progress of each block?
+
+    Returns:
+       Fit parameters (nspec, npars)
+       Fit errors (nspec, npars)
+       chi2 (nspec)
+       if return_status:
+       niter - the number of iterations for each spectrum
+       status - 1 = converged, 2 = stopped with a degenerate component (a
+           width shrunk to ~0, or a gaussian that no longer overlaps the
+           data; such a fit should not be trusted), 5 = reached maxiter,
+           0 = not fit (e.g. all NaN)
+
+    Spectra that could not be fit have NaN parameters.  The widths are kept
+    above 1e-3 of the channel spacing whatever the limits.
+    """
+    spectra = np.ma.masked_invalid(np.ma.atleast_2d(spectra))
+    nspec,nchan = spectra.shape
+    if xax is None:
+        xax = np.arange(nchan)
+    xax = np.asarray(xax, dtype='float')
+
+    if usemoments and ngauss != 1:
+        raise ValueError("Moments can only be used to guess a single gaussian.")
+    params,free,lower,upper = _batch_parlists(ngauss, vheight, params, fixed,
+            limitedmin, limitedmax, minpars, maxpars)
+    params = np.array(params, dtype='float') * np.ones([nspec,1])
+    npars = params.shape[1]
+
+    data = spectra.filled(0)
+    weights = np.ones([nspec,nchan]) if err is None else 1.0/np.ma.filled(err, np.inf)*np.ones([nspec,nchan])
+    weights[np.ma.getmaskarray(spectra)] = 0
+    weights[~np.isfinite(weights)] = 0
+
+    results = [np.zeros([nspec,npars]), np.zeros([nspec,npars]),
+            np.zeros(nspec), np.zeros(nspec,dtype='int'), np.zeros(nspec,dtype='int')]
+    for start in xrange(0, nspec, blocksize):
+        t0 = time.time()
+        block = slice(start, start+blocksize)
+        guesses = params[block]
+        if usemoments:
+            # replace the masked channels by the median of the spectrum
+            median = np.ma.median(spectra[block], axis=1)[:,np.newaxis]
+            filled = np.where(spectra[block].mask, median, spectra[block].filled(0))
+            guesses = _batch_onedmoments(xax, filled, vheight=vheight, negamp=negamp)
+        # the minimization would start stuck at a limit otherwise
+        guesses = np.clip(guesses, lower, upper)
+        blockresults = _batch_lm(xax, data[block], weights[block], guesses,
+                free, lower, upper, vheight=vheight, maxiter=maxiter,
+                ftol=ftol, xtol=xtol)
+        for result,blockresult in zip(results,blockresults):
+            result[block] = blockresult
+        if not quiet:
+            print "Fit spectra %i-%i of %i in %f seconds" % (start,
+                    min(start+blocksize,nspec), nspec, time.time()-t0)
+
+    if return_status:
+        return tuple(results)
+    return tuple(results[:3])
+
+def iteration_summary(niter, status=None):
+    """
+    A one-line summary of the iteration counts of a set of fits (e.g. from
+    batch_gaussfit(..., return_status=True)), to compare fitting strategies
+    """
+    niter = np.asarray(niter).ravel()
+    summary = "%i fits: %i iterations in total, mean %.2f, median %g, max %i" % (
+            niter.size, niter.sum(), niter.mean() if niter.size else 0,
+            np.median(niter) if niter.size else 0, niter.max() if niter.size else 0)
+    if status is not None:
+        summary += ", %i not converged" % (np.asarray(status) != 1).sum()
+    return summary
+
+def neighbour_gaussfit(xax, cube, tofit=None, order='spiral', start=None,
+        ngauss=1, usemoments=None, quiet=True, **kwargs):
+    """
+    Fit gaussians to the spectra of a cube (with batch_gaussfit) in a
+    spatially coherent order, starting each fit from the parameters of an
+    already-converged neighbouring spectrum.  Neighbouring spectra usually
+    have nearly the same parameters, so this takes fewer iterations than
+    starting from the moments, and keeps the components from jumping between
+    lines from one pixel to the next.  Neighbours that are pegged at a limit
+    or whose chi^2 is an outlier among the converged fits are not used as
+    seeds.  Spectra with no usable neighbour, and those whose warm-started
+    fit does not converge, are fit from the moments instead (or from params
+    if not usemoments).
+
+    The spectra are fit in waves, all the spectra of a wave together:
+    order='spiral' - square rings around the start pixel (by default the
+        pixel with the highest peak, or lowest if negamp)
+    order='scanline' - one row at a time
+
+    cube - (nchan, ny, nx) array
+    tofit - (ny, nx) boolean array of the spectra to fit (default: all)
+    usemoments - defaults to True if ngauss is 1
+    quiet - if False, print the iteration counts (see iteration_summary)
+    kwargs are passed to batch_gaussfit; err must be a scalar or have
+    length nchan.
+
+    Returns:
+       params, errors (npars, ny, nx)
+       chi2, niter, status (ny, nx); niter includes the iterations of
+           warm-started fits that were then redone from the moments
+    """
+    nchan,ny,nx = cube.shape
+    if tofit is None:
+        tofit = np.ones([ny,nx], dtype='bool')
+    if usemoments is None:
+        usemoments = ngauss == 1
+    coldparams = kwargs.pop('params', None)
+    npars = 3*ngauss + (1 if kwargs.get('vheight',True) else 0)
+
+    yy,xx = np.indices([ny,nx])
+    if order == 'spiral':
+        if start is None:
+            peak = cube.min(axis=0) if kwargs.get('negamp') else -cube.max(axis=0)
+            start = np.unravel_index(np.nanargmin(np.where(tofit, peak, np.nan)), peak.shape)
+        wave = np.maximum(np.abs(yy-start[0]), np.abs(xx-start[1]))
+    elif order == 'scanline':
+        wave = yy
+    else:
+        raise ValueError("order must be 'spiral' or 'scanline'")
+
+    params = np.zeros([ny,nx,npars]) + np.nan
+    errors = np.zeros([ny,nx,npars]) + np.nan
+    chi2 = np.zeros([ny,nx]) + np.nan
+    niter = np.zeros([ny,nx], dtype='int')
+    status = np.zeros([ny,nx], dtype='int')
+    nwarm,nfallback = 0,0
+    offsets = [(dy,dx) for dy in (-1,0,1) for dx in (-1,0,1) if dy or dx]
+
+    # the seeds must not sit on a limit, from which a fit may not be able to
+    # move (a converged fit can legitimately end there)
+    limitkw = dict((key,kwargs[key]) for key in
+            ('fixed','limitedmin','limitedmax','minpars','maxpars') if key in kwargs)
+    pars,free,lower,upper = _batch_parlists(ngauss, kwargs.get('vheight',True), **limitkw)
+
+    for ii in xrange(wave.max()+1):
+        iy,ix = np.nonzero((wave == ii) & tofit)
+        if iy.size == 0:
+            continue
+        # nor may a seed be a fit with an outlying chi^2, e.g. one that has
+        # converged to the wrong lines
+        # (the pixels that have not been fit yet are NaN, and are not
+        # converged, so their comparisons do not matter)
+        converged = status == 1
+        with np.errstate(invalid='ignore'):
+            goodseed = converged & ~(free & ((params <= lower) | (params >= upper))).any(axis=2)
+            if converged.sum() >= 5:
+                chi2med = np.median(chi2[converged])
+                chi2mad = np.median(np.abs(chi2[converged]-chi2med))
+                goodseed &= chi2 <= chi2med + 10*1.4826*chi2mad
+        # seed from the first good neighbour
+        seeds = np.zeros([iy.size,npars]) + np.nan
+        for dy,dx in offsets:
+            ny_,nx_ = iy+dy, ix+dx
+            inside = (ny_ >= 0) & (ny_ < ny) & (nx_ >= 0) & (nx_ < nx)
+            ny_,nx_ = ny_.clip(0,ny-1), nx_.clip(0,nx-1)
+            take = inside & goodseed[ny_,nx_] & np.isnan(seeds[:,0])
+            seeds[take] = params[ny_[take],nx_[take]]
+        warm = np.isfinite(seeds).all(axis=1)
+
+        results = [np.zeros([iy.size,npars]), np.zeros([iy.size,npars]),
+                np.zeros(iy.size), np.zeros(iy.size,dtype='int'), np.zeros(iy.size,dtype='int')]
+        cold = ~warm
+        if warm.any():
+            warmresults = batch_gaussfit(xax, cube[:,iy[warm],ix[warm]].T,
+                    ngauss=ngauss, params=seeds[warm], usemoments=False,
+                    return_status=True, **kwargs)
+            for result,warmresult in zip(results,warmresults):
+                result[warm] = warmresult
+            failed = (warmresults[4] != 1) | ~np.isfinite(warmresults[0]).all(axis=1)
+            cold[np.flatnonzero(warm)[failed]] = True
+            nwarm += warm.sum()
+            nfallback += failed.sum()
+        if cold.any():
+            coldresults = batch_gaussfit(xax, cube[:,iy[cold],ix[cold]].T,
+                    ngauss=ngauss, params=coldparams, usemoments=usemoments,
+                    return_status=True, **kwargs)
+            warmiter = results[3][cold]
+            for result,coldresult in zip(results,coldresults):
+                result[cold] = coldresult
+            results[3][cold] += warmiter
+
+        params[iy,ix],errors[iy,ix],chi2[iy,ix],niter[iy,ix],status[iy,ix] = results
+
+    if not quiet:
+        print "Neighbour-seeded (%s) %s" % (order, iteration_summary(niter[tofit], status[tofit]))
+        print "%i fits were warm-started, of which %i were redone from the moments" % (nwarm,nfallback)
+
+    return params.transpose(2,0,1),errors.transpose(2,0,1),chi2,niter,status
+
 def collapse_gaussfit(cube,xax=None,axis=2,negamp=False,usemoments=True,nsigcut=1.0,mppsigcut=1.0,
-        return_errors=False, **kwargs):
-    import time
+        return_errors=False, warmstart=None, **kwargs):
+    """
+    Fit a single gaussian (onedgaussian) to each spectrum of a cube with a
+    peak above nsigcut times the median standard deviation of the spectra.
+    The spectra are fit together with batch_gaussfit; kwargs are passed to it.
+
+    warmstart - 'spiral' or 'scanline': seed each fit from a converged
+        neighbour instead of the moments (see neighbour_gaussfit)
+
+    Fits with amplitudes less than mppsigcut times their error are rejected.
+
+    Returns maps of width,offset,amp,chi2 (NaN where there was no fit), or
+    width,offset,amp,width_err,offset_err,amp_err,chi2 if return_errors
+    """
     std_coll = cube.std(axis=axis)
     std_coll[std_coll==0] = np.nan # must eliminate all-zero spectra
     mean_std = median(std_coll[std_coll==std_coll])
@@ -531,27 +1132,47 @@ def collapse_gaussfit(cube,xax=None,axis=2,negamp=False,usemoments=True,nsigcut=
     print "Cube shape: ",cube.shape
     if negamp: extremum=np.min
     else: extremum=np.max
-    print "Fitting a total of %i spectra with peak signal above %f" % ((np.abs(extremum(cube,axis=0)) > (mean_std*nsigcut)).sum(),mean_std*nsigcut)
-    for i in xrange(cube.shape[1]):
-        t0 = time.time()
-        nspec = (np.abs(extremum(cube[:,i,:],axis=0)) > (mean_std*nsigcut)).sum()
-        print "Working on row %d with %d spectra to fit" % (i,nspec) ,
-        for j in xrange(cube.shape[2]):
-            if np.abs(extremum(cube[:,i,j])) > (mean_std*nsigcut):
-                mpp,gfit,mpperr,chi2 = onedgaussfit(xax,cube[:,i,j],err=np.ones(cube.shape[0])*mean_std,negamp=negamp,usemoments=usemoments,**kwargs)
-                if np.abs(mpp[1]) > (mpperr[1]*mppsigcut):
-                    width_arr[i,j] = mpp[3]
-                    offset_arr[i,j] = mpp[2]
-                    chi2_arr[i,j] = chi2
-                    amp_arr[i,j] = mpp[1]
-                    width_err[i,j] = mpperr[3]
-                    offset_err[i,j] = mpperr[2]
-                    amp_err[i,j] = mpperr[1]
-        dt = time.time()-t0
-        if nspec > 0:
-            print "in %f seconds (average: %f)" % (dt,dt/float(nspec))
-        else:
-            print "in %f seconds" % (dt)
+    tofit = np.abs(extremum(cube,axis=0)) > (mean_std*nsigcut)
+    print "Fitting a total of %i spectra with peak signal above %f" % (tofit.sum(),mean_std*nsigcut)
+    # fit all of the spectra together rather than one mpfit call per spectrum
+    vheight = kwargs.pop('vheight',True)
+    if not vheight:
+        # as in onedgaussfit, the height is then fixed at params[0]: fit the
+        # spectra minus that height without one
+        height = kwargs.get('params',[0])[0]
+        for key in ('params','fixed','limitedmin','limitedmax','minpars','maxpars'):
+            if key in kwargs and len(kwargs[key]) == 4:
+                kwargs[key] = list(kwargs[key])[1:]
+        if height != 0:
+            cube = cube - height
+        kwargs['vheight'] = False
+    for onedgaussfit_only in ('shh','veryverbose'):
+        kwargs.pop(onedgaussfit_only,None)
+    if warmstart:
+        kwargs.pop('quiet',None)
+        mpp,mpperr,chi2,niter,status = neighbour_gaussfit(xax, cube,
+                tofit=tofit, order=warmstart, err=mean_std, negamp=negamp,
+                usemoments=usemoments, **kwargs)
+        mpp,mpperr,chi2,niter,status = (mpp[:,tofit].T, mpperr[:,tofit].T,
+                chi2[tofit], niter[tofit], status[tofit])
+    else:
+        kwargs.setdefault('quiet',False)
+        mpp,mpperr,chi2,niter,status = batch_gaussfit(xax, cube[:,tofit].T,
+                err=mean_std, negamp=negamp, usemoments=usemoments,
+                return_status=True, **kwargs)
+    print iteration_summary(niter, status)
+    if not vheight:
+        mpp = np.concatenate([np.zeros([len(mpp),1])+height, mpp], axis=1)
+        mpperr = np.concatenate([np.zeros([len(mpperr),1]), mpperr], axis=1)
+    good = np.abs(mpp[:,1]) > (mpperr[:,1]*mppsigcut)
+    fitted = tuple(np.array(np.nonzero(tofit))[:,good])
+    width_arr[fitted] = mpp[good,3]
+    offset_arr[fitted] = mpp[good,2]
+    chi2_arr[fitted] = chi2[good]
+    amp_arr[fitted] = mpp[good,1]
+    width_err[fitted] = mpperr[good,3]
+    offset_err[fitted] = mpperr[good,2]
+    amp_err[fitted] = mpperr[good,1]
     print "Total time %f seconds" % (time.time()-starttime)
 
     if return_errors:
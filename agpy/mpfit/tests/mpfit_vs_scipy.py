@@ -27,6 +27,9 @@ def error_function_generator(xdata, ydata, error=None, model=gaussian,
         mpfit=False, lmfit=False, sumsquares=False, **kwargs):
     """
     Return a function that generates the errors given input parameters
+
+    With mpfit=True, the function also accepts a 2D array of parameter sets
+    (for mpfit's vectorized mode) if the model broadcasts over its parameters
     """
 
     if error is None:
@@ -35,6 +38,8 @@ def error_function_generator(xdata, ydata, error=None, model=gaussian,
     def error_function(params, **kwargs):
         if lmfit:
             params = [p.value for p in params.values()]
+        if np.ndim(params) == 2:
+            params = [p[:,np.newaxis] for p in np.transpose(params)]
         err = (ydata - model(xdata, *params)) / error
         if sumsquares:
             return (err**2).sum()
@@ -112,6 +117,12 @@ if __name__ == "__main__":
     err = np.ones(length)*0.25
 
     print mpfitter(xarr,yarr+noise,[1,0,1],err)
+    # the vectorized jacobian and LAPACK linear algebra should not change the fit
+    for kwargs in ({'vectorized':1},{'lapack':1},{'vectorized':1,'lapack':1}):
+        p,perr = mpfitter(xarr,yarr+noise,[1,0,1],err,**kwargs)
+        p0,perr0 = mpfitter(xarr,yarr+noise,[1,0,1],err)
+        np.testing.assert_allclose(p, p0, rtol=1e-5)
+        np.testing.assert_allclose(perr, perr0, rtol=1e-5)
     print lsfitter(xarr,yarr+noise,[1,0,1],err)
     print annealfitter(xarr,yarr+noise,[1,0,1],err)
     print fminfitter(xarr,yarr+noise,[1,0,1],err)
@@ -30,15 +30,16 @@ import re
 import os
 import subprocess
 import copy
+import weakref
 import idlsave
 import gaussfitter
 import agpy.mpfit as mpfit
 import agpy
 from agpy.PCA_tools import *
-from AG_image_tools.drizzle import drizzle
+from AG_image_tools.drizzle import drizzle,DrizzleAccumulator
 from agpy import smooth
-from guppy import hpy
-heapy = hpy()
+import resource
+import cPickle
 
 matplotlib.rcParams['image.origin']='lower'
 matplotlib.rcParams['image.interpolation']='nearest'
@@ -54,6 +55,95 @@ else: texOn = False
 # matplotlib.rcParams['text.usetex']=False
 # matplotlib.defaultParams['text.usetex']=False
 
+def _memory_used():
+    """ Peak memory (resident set size) used by this process so far, in GB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0**2
+
+class SavStruct(object):
+    """
+    Stand-in for an IDL structure read by idlsave, with the fields loaded
+    from a cache made by cache_sav.  struct['field'][0] and struct.field[0]
+    work as they do for idlsave's record arrays (field names are not case
+    sensitive).
+    """
+    def __init__(self, fields):
+        self._fields = fields
+
+    def __getitem__(self, field):
+        return (self._fields[field.lower()],)
+
+    def __getattr__(self, field):
+        if field.startswith('_'):
+            raise AttributeError(field)
+        try:
+            return (self._fields[field.lower()],)
+        except KeyError:
+            raise AttributeError(field)
+
+    def __contains__(self, field):
+        return field.lower() in self._fields
+
+    def keys(self):
+        return self._fields.keys()
+
+def cache_sav(savfile, cachedir=None, structnames=('bgps','mapstr','needed_once_struct'), clobber=False):
+    """
+    Convert the structures in an IDL .sav file into a directory of .npy
+    files, one per numerical array field (plus a pickle of the other
+    fields), so that load_sav_cache can memory-map them instead of reading
+    the whole .sav file.  Does nothing if an up-to-date cache exists.
+    Returns the cache directory (default: savfile+'_cache').
+    """
+    if cachedir is None:
+        cachedir = savfile+"_cache"
+    donefile = os.path.join(cachedir,'complete')
+    if (not clobber and os.path.exists(donefile) and
+            os.path.getmtime(donefile) >= os.path.getmtime(savfile)):
+        return cachedir
+
+    t0 = time.time()
+    print "Caching %s in %s" % (savfile,cachedir)
+    sav = idlsave.read(savfile)
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    for structname in structnames:
+        struct = sav.get(structname)
+        if struct is None:
+            continue
+        others = {}
+        for field in struct.dtype.names:
+            value = struct[field][0]
+            if isinstance(value,numpy.ndarray) and value.dtype.kind in 'biufc':
+                numpy.save(os.path.join(cachedir,"%s.%s.npy" % (structname,field)), value)
+            else:
+                others[field] = value
+        with open(os.path.join(cachedir,structname+".pkl"),'wb') as f:
+            cPickle.dump(others, f, protocol=2)
+        del struct
+    del sav
+    open(donefile,'w').close()
+    print "Cached %s in %0.1f seconds" % (savfile,time.time()-t0)
+    return cachedir
+
+def load_sav_cache(cachedir, mmap_mode='c'):
+    """
+    Load the structures cached by cache_sav as SavStruct's, with the arrays
+    memory-mapped.  The default mode, 'c' (copy-on-write), lets the arrays
+    be modified in memory without touching the cache.  Returns a dict of
+    structure name -> SavStruct.
+    """
+    structs = {}
+    for fn in os.listdir(cachedir):
+        if fn.endswith('.pkl'):
+            with open(os.path.join(cachedir,fn),'rb') as f:
+                structs.setdefault(fn[:-4],{}).update(cPickle.load(f))
+        elif fn.endswith('.npy'):
+            structname,field = fn[:-4].split('.',1)
+            structs.setdefault(structname,{})[field] = numpy.load(
+                    os.path.join(cachedir,fn), mmap_mode=mmap_mode)
+    return dict((name,SavStruct(fields)) for name,fields in structs.iteritems())
+
+
 class lazydata(object):
     def __init__(self, varname, structname='bgps', reshape=None, flag=True):
         self.varname = varname
@@ -73,19 +163,13 @@ class lazydata(object):
             return obj.__dict__[self.varname]
         else:
             print "Computing %s " % self.varname
+            data = obj._scanshape(obj.__dict__[self.structname][self.varname][0])
             if self.flag:
-                obj.__dict__[self.varname] = obj.__dict__[self.structname][self.varname][0][obj.whscan,:].astype('float')
-                obj.__dict__[self.varname][obj.whempty,:] = NaN
-                obj.__dict__[self.varname].shape = obj.datashape
-                obj.__dict__[self.varname] = nantomask(obj.__dict__[self.varname])
-                try:
-                    obj.__dict__[self.varname].mask[obj.flags > 0] = True
-                except TypeError:
-                    obj.__dict__[self.varname].mask = (obj.flags > 0)
+                obj.__dict__[self.varname] = numpy.ma.masked_array(data,
+                        mask=(data != data) | (obj.flags > 0))
             else:
                 # flagging is extra work, skip it but still do the reshaping aspects
-                obj.__dict__[self.varname] = obj.__dict__[self.structname][self.varname][0][obj.whscan,:].astype('float')
-                obj.__dict__[self.varname].shape = obj.datashape
+                obj.__dict__[self.varname] = data
 
             # not used if self.reshape is not None:
             # not used     obj.__dict__[self.varname] = reshape( obj.mapstr[self.varname][0][obj.whscan,:] , obj.datashape )
@@ -284,28 +368,44 @@ class Flagger:
         self.powerspec_plotted = False
         self.powerspectra_whole = None
         self.gaussfit=None
+        # DrizzleAccumulators that are kept up to date as flags are edited
+        # (see update_maps)
+        self.incremental_maps = {}
+        # PCA eigenvalues and eigenvectors per (scan, timestream, flag)
+        # (see scanPCA)
+        self.pca_cache = {}
 
         self.showmap(vmax=vmax)
         self.dcon()
     
-    def _loadsav(self, savfile, flag=True, **kwargs):
-        memtot = heapy.heap().size / 1024.0**3
-        print "Beginning IDLsave file read. %0.3g GB used" % memtot
+    def _loadsav(self, savfile, flag=True, cache=True, cachedir=None, **kwargs):
+        """
+        Read an IDL .sav file.  If cache is set, the structures are
+        converted to a cache of .npy files (see cache_sav) the first time,
+        and memory-mapped from it; the timestreams are then only read from
+        disk as they are used.
+        """
+        print "Beginning IDLsave file read. %0.3g GB used" % _memory_used()
         t0 = time.time()
-        sav = idlsave.read(savfile)
-        memtot = heapy.heap().size / 1024.0**3
+        def readsav(filename):
+            if cache:
+                cachename = None if cachedir is None else os.path.join(cachedir,os.path.basename(filename))
+                return load_sav_cache(cache_sav(filename,cachedir=cachename))
+            else:
+                sav = idlsave.read(filename)
+                return dict((name,sav.get(name)) for name in ('bgps','mapstr','needed_once_struct'))
+        sav = readsav(savfile)
         t1 = time.time()
-        print "Finished reading IDLsave file in %i seconds using %0.3g GB" % (t1 - t0,memtot)
+        print "Finished reading IDLsave file in %i seconds using %0.3g GB" % (t1 - t0,_memory_used())
         self.bgps = sav.get('bgps')
-        memtot = heapy.heap().size / 1024.0**3
         t2 = time.time()
-        print "Set bgps variable in %i seconds using %0.3g GB" % (t2 - t1,memtot)
+        print "Set bgps variable in %i seconds using %0.3g GB" % (t2 - t1,_memory_used())
         self.mapstr = sav.get('mapstr')
         self.needed_once_struct = sav.get('needed_once_struct')
         if self.needed_once_struct is None:
             neededoncefile = savfile.replace('preiter','neededonce').replace('postiter','neededonce')
             if os.path.exists(neededoncefile):
-                sav_once = idlsave.read(neededoncefile)
+                sav_once = readsav(neededoncefile)
                 self.needed_once_struct = sav_once.get('needed_once_struct')
         t3 = time.time()
         print "Completed IDLsave file read in %f seconds." % (t3 - t0)
@@ -340,13 +440,17 @@ class Flagger:
         self.scanstarts = arange(self.nscans)*self.scanlen
         self.whempty = concatenate([arange(i+j,i+self.scanlen) for i,j in zip(self.scanstarts,self.scanlengths) ]).ravel()
         self.whscan[self.whempty] = 0
+        # usually the scans tile the timestream end to end, in which case
+        # (scan,time,bolo) arrays are views of the (time,bolo) arrays
+        self.scans_contiguous = (len(self.whempty) == 0 and
+                numpy.all(self.ncscans[:,0] == self.ncscans[0,0]+self.scanstarts) and
+                self.ncscans[0,0]+self.nscans*self.scanlen <= self.timelen)
 
         self.tsshape = [self.nscans*self.scanlen,self.ngoodbolos]
         self.datashape = [self.nscans,self.scanlen,self.ngoodbolos]
 
         t4 = time.time()
-        memtot = heapy.heap().size / 1024.0**3
-        print "Beginning array reshaping with %f seconds elapsed, %0.3g GB used." % (t4 - t0, memtot)
+        print "Beginning array reshaping with %f seconds elapsed, %0.3g GB used." % (t4 - t0, _memory_used())
 
         #class lazy_whscan(object):
         #    class data(object):
@@ -365,7 +469,7 @@ class Flagger:
             #self.dc_bolos    = lazydata('dc_bolos', 'needed_once_struct') #self.needed_once_struct['dc_bolos'][0][self.whscan,:].astype('float')
             setattr(self.__class__, 'raw', lazydata('raw', 'needed_once_struct',flag=flag)) #self.needed_once_struct['raw'][0][self.whscan,:].astype('float')
             setattr(self.__class__, 'dc_bolos', lazydata('dc_bolos', 'needed_once_struct',flag=flag)) #self.needed_once_struct['dc_bolos'][0][self.whscan,:].astype('float')
-        elif self.bgps.dtype.fields.has_key('raw'):
+        elif hasattr(self.bgps,'raw'):
             print "Loading 'raw' and 'dc_bolos' from bgps"
             #self.raw         = lazydata('raw') # self.bgps['raw'][0][self.whscan,:].astype('float')
             #self.dc_bolos    = lazydata('dcbolos') # self.bgps['dc_bolos'][0][self.whscan,:].astype('float')
@@ -381,8 +485,7 @@ class Flagger:
         #self.weight         = self.bgps['weight'][0][self.whscan,:].astype('float')
         #self.zeromedian     = self.astrosignal * 0
         t5 = time.time()
-        memtot = heapy.heap().size / 1024.0**3
-        print "Finished array reshaping in %f seconds, %0.3g GB used." % (t5 - t4, memtot)
+        print "Finished array reshaping in %f seconds, %0.3g GB used." % (t5 - t4, _memory_used())
         print "Beginning array flagging."
 
         #try:
@@ -440,14 +543,12 @@ class Flagger:
         self.header = pyfits.Header(_hdr_string_list_to_cardlist( self.mapstr['hdr'][0] ))
 
         t6 = time.time()
-        memtot = heapy.heap().size / 1024.0**3
-        print "Finished array flagging in %f seconds, %0.3g GB used." % (t6 - t5, memtot)
+        print "Finished array flagging in %f seconds, %0.3g GB used." % (t6 - t5, _memory_used())
 
         # don't delay this
-        self.tstomap = reshape( self.mapstr['ts'][0][self.whscan,:] , self.datashape )
+        self.tstomap = self._scanshape(self.mapstr['ts'][0], pad=False)
         t7 = time.time()
-        memtot = heapy.heap().size / 1024.0**3
-        print "Computed tstomap in %f seconds, %0.3g GB used." % (t7 - t6, memtot)
+        print "Computed tstomap in %f seconds, %0.3g GB used." % (t7 - t6, _memory_used())
 
         self._initialize_vars(**kwargs)
 
@@ -515,16 +616,40 @@ class Flagger:
 
         print "Completed the rest of initialization in an additional %f seconds" % (time.time()-t1)
 
+    def _scanshape(self, arr, pad=True):
+        """
+        Reshape a (time,bolometer) array from the .sav file to
+        (scan,time,bolometer).  If pad is set, the result is a float64 copy,
+        whatever the dtype of the file (float32 or int), with the short scans
+        padded with NaNs; it can be modified without touching the structure
+        it came from.  Otherwise (e.g. for the integer tstomap), if the scans
+        tile the timestream this is a view, so a memory-mapped array is only
+        read as the scans are used, and if they do not the scans are copied
+        out with whscan.
+        """
+        if self.scans_contiguous:
+            start = self.ncscans[0,0]
+            scans = arr[start:start+self.nscans*self.scanlen].reshape(self.datashape)
+            if pad:
+                return numpy.array(scans, dtype='float')
+            return scans
+        if pad:
+            arr = arr[self.whscan,:].astype('float')
+            arr[self.whempty,:] = NaN
+        else:
+            arr = arr[self.whscan,:]
+        return reshape(arr, self.datashape)
+
     def lookup(self, tsname):
         """
         Cache and return data...
         """
         if tsname not in self.tscache:
             t0 = time.time()
-            s0 = heapy.heap().size
+            s0 = _memory_used()
             print "Loading and caching %s" % tsname
             self.tscache[tsname] = self.tsplot_dict[tsname]()
-            print "Loading and caching %s took %0.2g seconds and ate up %0.2g GB" % (tsname,time.time()-t0, (heapy.heap().size-s0)/1024.**3)
+            print "Loading and caching %s took %0.2g seconds and ate up %0.2g GB" % (tsname,time.time()-t0, _memory_used()-s0)
 
         return self.tscache.get(tsname)
     
@@ -580,19 +705,92 @@ class Flagger:
         self.residualmap = self.mapstr['RESIDMAP'][0]
         self.weightmap = self.mapstr['WT_MAP'][0]
         self.nhitsmap = self.mapstr['NHITSMAP'][0]
-        self.residsquaremap = drizzle(self.tstomap,self.noise**2,self.map.shape,self.weight*(True-self.flags))
-        self.weightsquaremap = drizzle(self.tstomap,self.weight**2,self.map.shape,1.0)
-        self.varscalemap = self.weightmap / (self.weightmap**2 - self.weightsquaremap)
-        self.varscalemap[abs(self.weightmap**2 - self.weightsquaremap) < self.weightsquaremap/1e6] = 0
-        self.rmssamplemean = (self.varscalemap * self.residsquaremap)**0.5
-        self.rootresidsquaremap = self.residsquaremap**0.5
+        self._drizzle_incremental('noise', self.noise, self.weight)
+        # the mean squared weight is over *all* samples, flagged or not, so
+        # it does not change when the flags are edited
+        self.allweightsquaremap = drizzle(self.tstomap,self.weight**2,self.map.shape,1.0)
+        self._derive_noisemaps()
         self.smoothresid = smooth(self.residualmap,10/2.35,interpolate_nan=True)
         self.smoothnoisemap = numpy.sqrt( smooth((self.residualmap-self.smoothresid)**2,10/2.35,interpolate_nan=True) )
-        for arrname in ("residualmap", "weightmap", "nhitsmap", "residsquaremap", "weightsquaremap", "varscalemap", "rmssamplemean", "rootresidsquaremap",):
+        for arrname in ("residualmap", "weightmap", "nhitsmap",):
             self.__dict__[arrname] = nantomask(self.__dict__[arrname])
+        for arrname in ("residualmap", "weightmap", "nhitsmap", "residsquaremap", "weightsquaremap", "varscalemap", "rmssamplemean", "rootresidsquaremap",):
             print "%20s mu=%8.2g std=%8.2g" % (arrname,self.__dict__[arrname].mean(),self.__dict__[arrname].std())
         print "Took %0.1f seconds to compute noisemaps" % (time.time()-t0)
 
+    def _derive_noisemaps(self):
+        """
+        Compute the noise maps from the noise accumulator (see make_noisemaps)
+        and the flag-independent mean squared weight map
+        """
+        noiseacc = self.incremental_maps['noise'][0]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            self.residsquaremap = noiseacc.meansquare()
+            self.weightsquaremap = self.allweightsquaremap.copy()
+            weightmap = numpy.ma.filled(self.weightmap, numpy.nan)
+            self.varscalemap = weightmap / (weightmap**2 - self.weightsquaremap)
+            self.varscalemap[abs(weightmap**2 - self.weightsquaremap) < self.weightsquaremap/1e6] = 0
+            self.rmssamplemean = (self.varscalemap * self.residsquaremap)**0.5
+            self.rootresidsquaremap = self.residsquaremap**0.5
+        for arrname in ("residsquaremap", "weightsquaremap", "varscalemap", "rmssamplemean", "rootresidsquaremap",):
+            self.__dict__[arrname] = nantomask(self.__dict__[arrname])
+
+    def _drizzle_incremental(self, name, ts, weights):
+        """
+        Drizzle a timestream onto a map one scan at a time, giving flagged
+        points no weight, and keep the DrizzleAccumulator (with the
+        timestream, the weights and a copy of the flags it was made with) in
+        self.incremental_maps[name] so that update_maps can apply later flag
+        edits to it.
+        """
+        accumulator = DrizzleAccumulator(self.map.shape)
+        for scan in xrange(self.nscans):
+            accumulator.add(self.tstomap[scan], ts[scan],
+                    weights[scan]*(True-self.flags[scan]))
+        self.incremental_maps[name] = (accumulator, ts, weights,
+                self.flags.copy())
+        return accumulator
+
+    def update_maps(self, region=Ellipsis):
+        """
+        Bring the map made by compute_map and the noise maps up to date with
+        the flags.  Only the points whose flags changed since they were last
+        drizzled are removed from (or added back to) the accumulators, and
+        only the map pixels they hit are recomputed, so the time spent on the
+        timestream is proportional to the size of the edit.  (The noise maps
+        are rederived from their accumulator, which only takes a pass over
+        the map.)
+
+        region - index into the flags (e.g. a scan number) that contains all
+            of the edits; by default the whole timestream is checked
+        """
+        for name,(accumulator,ts,weights,mapflags) in self.incremental_maps.items():
+            newflags = self.flags[region]
+            oldflags = mapflags[region]
+            changed = numpy.nonzero(newflags != oldflags)
+            if len(changed[0]) == 0:
+                continue
+            tstomap = self.tstomap[region][changed]
+            changed_ts = ts[region][changed]
+            changed_weights = weights[region][changed]
+            accumulator.add(tstomap, changed_ts,
+                    changed_weights*(True-oldflags[changed]), sign=-1)
+            accumulator.add(tstomap, changed_ts,
+                    changed_weights*(True-newflags[changed]))
+            mapflags[region] = newflags
+
+            if name == 'map':
+                pixels = numpy.unique(tstomap)
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    newmap = (accumulator.sum.flat[pixels] /
+                            accumulator.weight.flat[pixels])
+                newmap[accumulator.hits.flat[pixels] == 0] = numpy.nan
+                self.map.flat[pixels] = newmap
+                if self.mapfig is not None:
+                    self.mapim.set_array(self.map)
+            elif name == 'noise':
+                self._derive_noisemaps()
+
     def save_noisemaps(self,clobber=True):
         prefix = self.filename.replace("_postiter.sav","")
         F = pyfits.open(prefix+"_map00.fits")
@@ -1284,9 +1482,11 @@ class Flagger:
             self.plotscan(self.scannum)
         elif event.key == 'M': # flag highest point
             self.flags[self.scannum,:,:].flat[self.plane.argmax()] += 1
+            self.update_maps(self.scannum)
             self.plane.flat[self.plane.argmax()] = 0
         elif event.key == 'm': # flag lowest point
             self.flags[self.scannum,:,:].flat[self.plane.argmin()] += 1
+            self.update_maps(self.scannum)
             self.plane.flat[self.plane.argmin()] = 0
         elif event.key == 'd':
             self.flag_box(self.x1,self.y1,self.x2,self.y2,'d')
@@ -1303,8 +1503,10 @@ class Flagger:
                 self._y1 = numpy.floor(event.ydata)
         elif event.key == 's' or event.key == 'w': # "whole" scan
             self.flags[self.scannum,:,:] += 1
+            self.update_maps(self.scannum)
         elif event.key == 'S' or event.key == 'W':
             self.flags[self.scannum,:,:] -= (self.flags[self.scannum,:,:] > 0)
+            self.update_maps(self.scannum)
         elif event.key == 'b':
             self.flag_bolo(event.xdata,event.key)
         elif event.key == 'B':
@@ -1831,6 +2033,8 @@ class Flagger:
         self.plotscan(self.scannum)
 
     def _refresh(self):
+        # flag edits are always in the current scan
+        self.update_maps(self.scannum)
         if self.flagfig is not None:
             self.flagfig.canvas.draw()
         if self.datafig is not None:
@@ -1941,32 +2145,81 @@ class Flagger:
         self.flags[:] = False
 
         datums=['astrosignal','atmosphere','ac_bolos','atmo_one','noise','scalearr','weight','mapped_astrosignal']
+        replaced = {}
         for d in datums:
             if self.__dict__.has_key(d):
+                replaced[id(self.__dict__[d])] = d
                 del self.__dict__[d]
             setattr(self.__class__, d, lazydata(d,flag=False))
 
         self.unmask_all()
+        self._redrizzle_maps(replaced)
 
-    def planePCA(self,clear=True, timestream='data', fignum=11, plotitem='evects', scannum=None, flag=True, geometry=None, **kwargs):
-
-        if scannum is None:
-            scannum = self.scannum
-
+    def _redrizzle_maps(self, replaced={}):
+        """
+        Rebuild the accumulators of update_maps from scratch with the current
+        flags, e.g. after the timestreams they were made from have been
+        replaced or unmasked.  replaced maps id(old array) -> the name of the
+        attribute that now holds its replacement.
+        """
+        def current(arr):
+            if id(arr) in replaced:
+                return getattr(self, replaced[id(arr)])
+            return arr
+        for name,(accumulator,ts,weights,mapflags) in self.incremental_maps.items():
+            ts,weights = current(ts),current(weights)
+            accumulator = self._drizzle_incremental(name, ts, weights)
+            if name == 'map':
+                self.map = accumulator.mean()
+                if self.mapfig is not None:
+                    self.mapim.set_array(self.map)
+            elif name == 'noise':
+                self.allweightsquaremap = drizzle(self.tstomap,weights**2,self.map.shape,1.0)
+                self._derive_noisemaps()
+
+    def scanPCA(self, scannum=None, timestream='data', flag=True):
+        """
+        PCA decomposition (efuncarr, covmat, evals, evects; see efuncs) of
+        one scan of a timestream, or of the whole timestream if scannum is
+        None.  If flag, flagged samples are zeroed.
+
+        The eigenvalues and eigenvectors are cached per (scan, timestream,
+        flag) and recomputed only when the flags of that scan (or the
+        timestream itself) have changed.  Only they (and a bit-packed copy
+        of the flags) are kept, so the cache stays small next to the
+        timestream; efuncarr and covmat are rebuilt from them on each call.
+        """
         if timestream == 'data':
-            data = self.data[scannum,:,:].copy()
-            if flag:
-                data[self.flags[scannum,:,:].astype('bool')] = 0
-            self.efuncarr,self.covmat,self.evals,self.evects = efuncs(data,return_others=True)
+            source = self.data
         elif self.tsplot_dict.has_key(timestream):
-            data = self.lookup(timestream) #tsplot_dict[timestream]()
-            data = data[scannum,:,:].copy()
-            if flag:
-                data[self.flags[scannum,:,:].astype('bool')] = 0
-            self.efuncarr,self.covmat,self.evals,self.evects = efuncs(data,return_others=True)
+            source = self.lookup(timestream) #tsplot_dict[timestream]()
         else:
             raise KeyError("Timestream %s is not valid." % timestream)
 
+        if scannum is None:
+            data = reshape(source,[source.shape[0]*source.shape[1],source.shape[2]])
+            flagged = reshape(self.flags,data.shape) != 0
+        else:
+            data = source[scannum,:,:]
+            flagged = self.flags[scannum,:,:] != 0
+        if not flag:
+            flagged = numpy.zeros(data.shape, dtype='bool')
+        packedflags = numpy.packbits(flagged)
+
+        key = (scannum, timestream, flag)
+        if key in self.pca_cache:
+            sourceref, cached_flags, evals, evects = self.pca_cache[key]
+            if sourceref() is source and numpy.array_equal(cached_flags, packedflags):
+                zeroed = numpy.ma.masked_array(data, mask=flagged).filled(0)
+                return (numpy.dot(zeroed, evects), numpy.dot(evects*evals, evects.T),
+                        evals, evects)
+
+        result = efuncs(data, return_others=True, mask=flagged)
+        # a weak reference, so that a replaced timestream can be freed
+        self.pca_cache[key] = (weakref.ref(source), packedflags, result[2], result[3])
+        return result
+
+    def _plotPCA(self, clear, fignum, plotitem, geometry=None, **kwargs):
         self.PCAfig=figure(fignum)
         if clear: self.PCAfig.clear()
         if geometry is not None:
@@ -1983,28 +2236,18 @@ class Flagger:
         ylabel(ylabel_dict[plotitem])
         colorbar()
 
-    def doPCA(self,clear=True,timestream='data', fignum=9, plotitem='evects', **kwargs):
+    def planePCA(self,clear=True, timestream='data', fignum=11, plotitem='evects', scannum=None, flag=True, geometry=None, **kwargs):
 
-        if timestream == 'data':
-            self.efuncarr,self.covmat,self.evals,self.evects = efuncs(reshape(self.data,[self.data.shape[0]*self.data.shape[1],self.data.shape[2]]),return_others=True)
-        elif self.tsplot_dict.has_key(timestream):
-            data = self.lookup(timestream) #tsplot_dict[timestream]()
-            self.efuncarr,self.covmat,self.evals,self.evects = efuncs(reshape(data,[data.shape[0]*data.shape[1],data.shape[2]]),return_others=True)
-        else:
-            raise KeyError("Timestream %s is not valid." % timestream)
-        self.PCAfig=figure(fignum)
-        if clear: self.PCAfig.clear()
-      
-        plotitem_dict = {'evects':self.evects,'efuncarr':self.efuncarr,'covmat':self.covmat,'evals':self.evals}
-        plottype_dict = {'evects':imshow,'efuncarr':imshow,'covmat':imshow,'evals':plot}
-        plotkwargs_dict = {'evects':{},'efuncarr':{'aspect':float(self.efuncarr.shape[1])/self.efuncarr.shape[0]},'covmat':{},'evals':{}}
-        xlabel_dict = {'evects':'Eigenfunction','efuncarr':'Eigenfunction','covmat':'Bolometer','evals':'Eigenfunction'}
-        ylabel_dict = {'evects':'Bolometer','efuncarr':'Time','covmat':'Bolometer','evals':'Correlation Coefficient'}
+        if scannum is None:
+            scannum = self.scannum
 
-        plottype_dict[plotitem](plotitem_dict[plotitem], label=plotitem, **dict(plotkwargs_dict[plotitem].items() + kwargs.items()))
-        xlabel(xlabel_dict[plotitem])
-        ylabel(ylabel_dict[plotitem])
-        colorbar()
+        self.efuncarr,self.covmat,self.evals,self.evects = self.scanPCA(scannum, timestream=timestream, flag=flag)
+        self._plotPCA(clear, fignum, plotitem, geometry=geometry, **kwargs)
+
+    def doPCA(self,clear=True,timestream='data', fignum=9, plotitem='evects', flag=True, **kwargs):
+
+        self.efuncarr,self.covmat,self.evals,self.evects = self.scanPCA(None, timestream=timestream, flag=flag)
+        self._plotPCA(clear, fignum, plotitem, **kwargs)
 
     def compute_map(self,ts=None,tsname=None,weights=None,showmap=True,**kwargs):
         """
@@ -2019,7 +2262,9 @@ class Flagger:
         if weights is None: weights = self.weight
         elif not isinstance(weights,numpy.ndarray): weights = numpy.ones(ts.shape)*weights
 
-        self.map = drizzle(self.tstomap,ts,self.map.shape,weights*(True-self.flags))
+        # keep the accumulator so that flag edits can update the map
+        # incrementally (update_maps)
+        self.map = self._drizzle_incremental('map', ts, weights).mean()
         print "Computing map took %f seconds" % (time.time() - t0)
         if showmap: self.showmap(**kwargs)
 
@@ -2060,8 +2305,8 @@ class Flagger:
         import agpy
         badarr = np.zeros([self.datashape[0],self.datashape[2]])
         for ii in xrange(self.nscans):
-            self.planePCA(ii)
-            corrvals = self.evects[:,eigenfunction]
+            efuncarr,covmat,evals,evects = self.scanPCA(ii)
+            corrvals = evects[:,eigenfunction]
             lowercut = (median(corrvals)-nsig*agpy.mad.MAD(corrvals))
             uppercut = (median(corrvals)+nsig*agpy.mad.MAD(corrvals))
             highvals = (corrvals > uppercut)
@@ -2071,6 +2316,9 @@ class Flagger:
             if flag:
                 self.flags[ii, :, highvals+lowvals] = True
             badarr[ii, highvals+lowvals] = True
+        if flag:
+            # the flags of every scan may have changed
+            self.update_maps()
         return badarr
         
 
@@ -115,3 +115,74 @@ title("Center 49.43,49.53, binsize 0.5")
 savefig("azimuthalaverage_test_steps.png")
 
 #import pdb; pdb.set_trace()
+
+# radialAverageBins must match the per-annulus masked radialAverage it
+# replaced, including when some azimuth bins are empty (binsize=25 leaves
+# pixels outside the last bin)
+from agpy import radialprofile
+yy,xx = indices([100,100])
+theta = arctan2(yy-50.2,xx-49.3)
+img = exp1 + 0.1*sin(3*theta)
+rr = hypot(xx-49.3,yy-50.2)
+for radbins in (25, linspace(0,60,7)):
+    for binsize in (25.0, 10.0):
+        rb,az,radav = radialprofile.radialAverageBins(img, radbins,
+                center=[49.3,50.2], binsize=binsize)
+        for (blow,bhigh),zz in zip(zip(rb[:-1],rb[1:]),radav):
+            mask = (rr<bhigh)*(rr>blow)
+            az1,zz1 = radialprofile.radialAverage(img, center=[49.3,50.2],
+                    mask=mask, returnAz=True, binsize=binsize)
+            assert allclose(az,az1)
+            assert allclose(zz,zz1,equal_nan=True)
+
+# a RadialProfile gives each bin's mean, std, median and count, for an
+# image or for every plane of a cube at once
+from agpy import RadialProfile
+noise = randn(3,60,50)
+prof = RadialProfile(noise.shape, center=[24.2,31.7], binsize=2.0)
+rr = hypot(xx[:60,:50]-24.2, yy[:60,:50]-31.7)
+means = prof.mean(noise)
+assert means.shape == (3,prof.nbins)
+for ii in range(prof.nbins):
+    inbin = (rr >= prof.bins[ii]) & (rr < prof.bins[ii+1])
+    assert prof.counts()[ii] == inbin.sum()
+    if inbin.any():
+        assert allclose(means[:,ii], noise[:,inbin].mean(axis=1))
+        assert allclose(prof.std(noise)[:,ii], noise[:,inbin].std(axis=1))
+        assert allclose(prof.median(noise[1])[ii], median(noise[1][inbin]))
+weights = rand(60,50)
+wmean = prof.mean(noise[0], weights=weights)
+inbin = (rr >= prof.bins[3]) & (rr < prof.bins[4])
+assert allclose(wmean[3], (noise[0]*weights)[inbin].sum()/weights[inbin].sum())
+# azimuthalAverage uses the same bins
+azr,azav = azimuthalAverage(noise[0],center=[24.2,31.7],binsize=2.0,returnradii=True)
+assert allclose(azr, prof.bin_centers)
+assert allclose(azav, means[0], equal_nan=True)
+
+# azimuthalAverageBins computes all of the sectors in one pass, with the
+# same result as masking each sector in turn
+from agpy import azimuthalAverageBins
+for azbins,symmetric in ((5,None), (4,1), (3,2), (array([0.,45,200,360]),None)):
+    edges,azr,azavs = azimuthalAverageBins(img, azbins, symmetric=symmetric,
+            center=[49.3,50.2], binsize=2.0)
+    theta_deg = arctan2(xx-49.3, yy-50.2)*180/pi % 360
+    if symmetric == 1: theta_deg = theta_deg % 180
+    elif symmetric == 2: theta_deg = theta_deg % 90
+    for (blow,bhigh),azav in zip(zip(edges[:-1],edges[1:]),azavs):
+        mask = (theta_deg > (blow % 360)) * (theta_deg < bhigh)
+        azr1,azav1 = azimuthalAverage(img, center=[49.3,50.2], mask=mask,
+                binsize=2.0, returnradii=True)
+        assert allclose(azr,azr1)
+        assert allclose(azav,azav1,equal_nan=True)
+
+# an AzimuthalProfile puts each pixel in one angle bin of one annulus
+azprof = radialprofile.AzimuthalProfile(img.shape, center=[49.3,50.2],
+        binsize=30.0, radbins=array([0.,10,20,40]))
+counts = azprof.counts()
+rr = hypot(xx-49.3,yy-50.2)
+assert counts.shape == (3,12)
+for ii,(rlow,rhigh) in enumerate([(0,10),(10,20),(20,40)]):
+    assert counts[ii].sum() == ((rr > rlow) & (rr < rhigh)).sum()
+theta_deg = arctan2(xx-49.3, yy-50.2)*180/pi % 360
+inbin = (rr > 20) & (rr < 40) & (theta_deg >= 60) & (theta_deg < 90)
+assert allclose(azprof.mean(img)[2,2], img[inbin].mean())
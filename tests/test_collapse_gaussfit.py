@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from agpy.collapse_gaussfit import tiled_gaussfit
+from agpy.gaussfitter import batch_gaussfit, onedgaussian
+
+# a cube of single lines whose parameters vary smoothly across the map
+rs = np.random.RandomState(0)
+xax = np.arange(80.)
+yy,xx = np.indices([7,9])
+cube = np.array([onedgaussian(xax, 0.2, 2+0.1*x, 35+y+0.5*x, 4+0.2*y)
+    for y,x in zip(yy.ravel(),xx.ravel())]).T.reshape(80,7,9)
+cube += rs.randn(*cube.shape)*0.1
+mean_std = np.median(cube.std(axis=0))
+
+tmpdir = tempfile.mkdtemp()
+prefix = os.path.join(tmpdir, 'cube')
+
+# fitting tile by tile gives the batch_gaussfit result for every spectrum
+pars,errs,chi2,niter = tiled_gaussfit(cube, prefix, tilesize=4, numcores=1,
+        nsigcut=0, verbose=False)
+assert pars.shape == (4,7,9) and chi2.shape == (7,9)
+bpars,berrs,bchi2,bniter,bstatus = batch_gaussfit(xax, cube.reshape(80,63).T,
+        err=mean_std, usemoments=True, return_status=True)
+assert np.allclose(pars.reshape(4,63).T, bpars)
+assert np.allclose(errs.reshape(4,63).T, berrs)
+assert np.allclose(chi2.ravel(), bchi2)
+assert np.all(niter.ravel() == bniter)
+assert np.all(np.load(prefix+'_gausspars_done.npy'))
+
+# in parallel, and with the spectral axis last
+ppars = tiled_gaussfit(cube.transpose(1,2,0), prefix+'_parallel', axis=2,
+        tilesize=4, numcores=2, nsigcut=0, verbose=False)[0]
+assert np.allclose(ppars, pars)
+
+# a rerun only fits the unfinished tiles
+output = np.load(prefix+'_gausspars.npy', mmap_mode='r+')
+output[:,4:,:4] = np.nan
+output[:,:4,4:8] = -1
+output.flush()
+del output
+done = np.load(prefix+'_gausspars_done.npy', mmap_mode='r+')
+done[1,0] = False
+done.flush()
+del done
+rpars = tiled_gaussfit(cube, prefix, tilesize=4, numcores=1, nsigcut=0,
+        verbose=False)[0]
+assert np.allclose(rpars[:,4:,:4], pars[:,4:,:4])
+assert np.all(rpars[:,:4,4:8] == -1)
+
+# unless the output does not match, or clobber is set
+try:
+    tiled_gaussfit(cube, prefix, ngauss=2, tilesize=4, numcores=1, verbose=False,
+            params=[0,1,30,3,1,45,3])
+except ValueError:
+    pass
+else:
+    raise AssertionError("tiled_gaussfit resumed into a mismatched output cube")
+cpars = tiled_gaussfit(cube, prefix, tilesize=4, numcores=1, nsigcut=0,
+        verbose=False, clobber=True)[0]
+assert np.allclose(cpars, pars)
+
+# spectra below the cut are not fit
+faint = cube.copy()
+faint[:,0,0] = rs.randn(80)*0.01
+fpars = tiled_gaussfit(faint, prefix+'_faint', tilesize=4, numcores=1,
+        verbose=False)[0]
+assert np.all(np.isnan(fpars[:,0,0])) and np.all(np.isfinite(fpars[:,1:,1:]))
+
+shutil.rmtree(tmpdir)
@@ -0,0 +1,133 @@
+import numpy as np
+import scipy.signal
+from agpy import convolve
+
+image = np.random.randn(60,50)
+kernel = np.random.rand(7,9)
+reference = scipy.signal.convolve(image, kernel, mode='same')
+
+# real inputs use real-to-complex FFTs by default; all of the variants give
+# the same convolution
+for use_rfft in (None, True, False):
+    assert np.allclose(convolve(image, kernel, use_rfft=use_rfft), reference)
+single = convolve(image, kernel, dtype=np.float32)
+assert np.allclose(single, reference, rtol=1e-4, atol=1e-4)
+# complex inputs still work (and use the complex FFTs)
+assert np.allclose(convolve(image+0j, kernel), reference)
+try:
+    convolve(image, kernel+1j, use_rfft=True)
+except ValueError:
+    pass
+else:
+    raise AssertionError("use_rfft accepted a complex kernel")
+
+# fft_pad='fast' pads each axis to a 5-smooth length, with the same result
+from AG_fft_tools.convolve_nd import padded_shape
+assert padded_shape((4100,300), (5,5), fft_pad='fast') == (4320,300)
+assert padded_shape((4100,300), (5,5), fft_pad='fast', psf_pad=True) == (4320,320)
+# (any false fft_pad or psf_pad, e.g. None, means no padding)
+assert padded_shape((30,40), (5,5), fft_pad=None, psf_pad=None) == (30,40)
+assert padded_shape((30,40), (5,5), fft_pad=0, psf_pad=True) == (35,45)
+assert np.allclose(convolve(image, kernel, fft_pad=None, psf_pad=True), reference)
+assert np.allclose(convolve(image, kernel, fft_pad='fast'), reference)
+assert np.allclose(convolve(image, kernel, fft_pad='fast', psf_pad=True), reference)
+assert np.allclose(convolve(image, kernel, fft_pad='fast', boundary='wrap'),
+        convolve(image, kernel, fft_pad=False, boundary='wrap'))
+
+# a PreparedConvolver gives convolvend's result for every array it is used
+# on, with the call-time options
+from agpy import PreparedConvolver
+nanimage = image.copy()
+nanimage[10:13,20:22] = np.nan
+normkernel = kernel/kernel.sum()
+prepared = PreparedConvolver(normkernel, image.shape)
+for arr in (image, image**2, nanimage):
+    assert np.allclose(prepared(arr), convolve(arr, normkernel, quiet=True))
+    assert np.allclose(prepared(arr, interpolate_nan=True, ignore_edge_zeros=True),
+            convolve(arr, normkernel, interpolate_nan=True, ignore_edge_zeros=True))
+try:
+    prepared(image[:50])
+except ValueError:
+    pass
+else:
+    raise AssertionError("PreparedConvolver accepted the wrong shape")
+
+# direct (real-space) convolution gives the same result as the FFTs,
+# including the NaN and edge handling; separable kernels are done one axis
+# at a time
+from agpy import convolve_direct
+from AG_fft_tools.convolve_direct import separable_factors, convolution_method
+gausskernel = np.outer(np.exp(-np.linspace(-3,3,9)**2), np.exp(-np.linspace(-2,2,7)**2))
+gausskernel /= gausskernel.sum()
+assert separable_factors(gausskernel) is not None
+assert separable_factors(kernel) is None
+for kern in (normkernel, gausskernel):
+    for separable in (None, False):
+        for kwargs in (dict(), dict(interpolate_nan=True),
+                dict(interpolate_nan=True, ignore_edge_zeros=True),
+                dict(interpolate_nan=True, min_wt=0.5)):
+            fftresult = convolve(nanimage, kern, quiet=True, **kwargs)
+            directresult = convolve_direct(nanimage, kern, separable=separable,
+                    quiet=True, **kwargs)
+            assert np.allclose(directresult, fftresult, equal_nan=True)
+assert np.allclose(convolve_direct(image, kernel, fill_value=2.0),
+        convolve(image, kernel, fill_value=2.0))
+gauss1d = np.exp(-np.linspace(-3,3,15)**2)
+assert convolution_method(image.shape, np.outer(gauss1d,gauss1d)) == 'separable'
+assert convolution_method(image.shape, kernel) == 'direct'
+assert convolution_method((1024,1024), np.random.rand(101,101)) == 'fft'
+# image-sized kernels are refused rather than running out of memory
+try:
+    convolve_direct(np.ones((200,180)), np.random.rand(200,180))
+except ValueError:
+    pass
+else:
+    raise AssertionError("convolve_direct accepted an image-sized kernel")
+assert convolution_method((200,180), np.random.rand(200,180)) == 'fft'
+
+# a tiled convolution gives the same result as convolving the whole array,
+# from a memory-mapped .npy file into another one
+import os
+import tempfile
+from agpy import convolve_chunked
+tmpdir = tempfile.mkdtemp()
+infile = os.path.join(tmpdir, 'image.npy')
+outfile = os.path.join(tmpdir, 'smoothed.npy')
+bigimage = np.random.randn(130,110)
+bigimage[50:53,60] = np.nan
+np.save(infile, bigimage)
+wholeresult = convolve(bigimage, normkernel, interpolate_nan=True,
+        ignore_edge_zeros=True)
+for method in ('fft','direct','auto'):
+    tiled = convolve_chunked(bigimage, normkernel, tile_shape=(32,40),
+            method=method, interpolate_nan=True, ignore_edge_zeros=True)
+    assert np.allclose(tiled, wholeresult)
+tiled = convolve_chunked(infile, normkernel, output=outfile, tile_shape=48,
+        interpolate_nan=True, ignore_edge_zeros=True)
+del tiled
+assert np.allclose(np.load(outfile), wholeresult)
+os.remove(infile)
+os.remove(outfile)
+os.rmdir(tmpdir)
+
+# convolve_axes convolves every slice of a cube at once, the same as
+# convolving them one at a time
+from agpy import convolve_axes
+cube = np.random.randn(5,40,30)
+cube[2,10:12,5] = np.nan
+planes = np.array([convolve(plane, normkernel, interpolate_nan=True, quiet=True)
+    for plane in cube])
+for block_size in (None, 2):
+    assert np.allclose(convolve_axes(cube, normkernel, axes=(1,2),
+        interpolate_nan=True, block_size=block_size), planes)
+spectra = np.array([[convolve(cube[:,y,x], [0.25,0.5,0.25], quiet=True)
+    for x in range(cube.shape[2])] for y in range(cube.shape[1])]).transpose(2,0,1)
+assert np.allclose(convolve_axes(cube, [0.25,0.5,0.25], axes=(0,), quiet=True),
+        spectra)
+assert convolve_axes(cube, normkernel, axes=(1,2), downsample=2).shape == (5,20,15)
+
+# with several threads, the independent transforms run concurrently with
+# the same results
+for kwargs in (dict(), dict(interpolate_nan=True, ignore_edge_zeros=True)):
+    assert np.allclose(convolve(nanimage, normkernel, nthreads=4, quiet=True, **kwargs),
+            convolve(nanimage, normkernel, nthreads=1, quiet=True, **kwargs))
@@ -0,0 +1,56 @@
+import numpy as np
+from agpy import cross_correlation
+from agpy import shift_stack
+
+# a cube of shifted, scaled copies of a gaussian template
+xvals = np.arange(128)
+template = np.exp(-(xvals-64.)**2/(2*5.**2))
+np.random.seed(0)
+truelags = np.random.uniform(-20, 20, (6,7))
+amplitudes = np.random.uniform(0.5, 2, (6,7))
+spectra = (amplitudes[:,:,None] *
+        shift_stack(np.tile(template, (42,1)), truelags.ravel()).reshape(6,7,128))
+noisy = spectra + np.random.randn(*spectra.shape)*0.01
+
+# the lags of every spectrum are measured at once, along any axis
+lags,errors = cross_correlation.fit_lags(noisy, template)
+assert lags.shape == (6,7) and errors.shape == (6,7)
+assert np.abs(lags-truelags).max() < 0.1
+lags0,errors0 = cross_correlation.fit_lags(noisy.transpose(2,0,1), template, axis=0)
+assert np.allclose(lags0, lags) and np.allclose(errors0, errors)
+# the uncertainties are consistent with the errors
+assert np.abs((lags-truelags)/errors).max() < 6
+# without noise, the upsampled DFT finds the lags to half a grid step
+lagsup,errorsup = cross_correlation.fit_lags(spectra, template, refine='dftups', usfac=20)
+assert np.abs(lagsup-truelags).max() <= 0.5/20 + 1e-6
+intlags,interrors = cross_correlation.fit_lags(spectra, template, refine=None)
+assert np.allclose(intlags, np.round(truelags))
+# the results do not depend on the block size, and a template per spectrum
+# works too
+assert np.allclose(cross_correlation.fit_lags(noisy, template, block_size=5)[0], lags)
+pairlags = cross_correlation.fit_lags(noisy, np.roll(noisy, 1, axis=1))[0]
+assert np.abs(pairlags - (truelags-np.roll(truelags, 1, axis=1))).max() < 0.2
+
+# maxlag restricts the search
+lagsmax = cross_correlation.fit_lags(spectra, template, maxlag=10, refine=None)[0]
+assert np.abs(lagsmax).max() <= 10
+inrange = np.abs(truelags) < 9.5
+assert np.allclose(lagsmax[inrange], np.round(truelags[inrange]))
+
+# the cross-correlations use the chosen FFT backend's real transforms
+from agpy import fast_ffts
+calls = []
+def counting_backend(nthreads=1, planner_effort=None):
+    def rfftn(array, s=None, axes=None):
+        calls.append('rfftn')
+        return np.fft.rfftn(array, s=s, axes=axes)
+    def irfftn(array, s=None, axes=None):
+        calls.append('irfftn')
+        return np.fft.irfftn(array, s=s, axes=axes)
+    return dict(fftn=np.fft.fftn, ifftn=np.fft.ifftn, rfftn=rfftn,
+            irfftn=irfftn)
+fast_ffts.register_backend('counting', counting_backend,
+        preference=len(fast_ffts.backend_preference))
+assert np.allclose(cross_correlation.fit_lags(noisy, template,
+    fft_backend='counting'), (lags, errors))
+assert 'irfftn' in calls and calls.count('rfftn') > 2
@@ -0,0 +1,54 @@
+import numpy as np
+from agpy import drizzle, DrizzleAccumulator
+
+# a timestream of 3 "scans" hitting a 10x12 map
+np.random.seed(1)
+mapshape = (10,12)
+tstomap = np.random.randint(0, 120, (3,500))
+ts = np.random.randn(3,500) + tstomap/50.
+weights = np.random.uniform(0.5, 2, (3,500))
+ts[1,10:20] = np.nan
+
+# adding the scans one at a time gives the same map as drizzling them all
+acc = DrizzleAccumulator(mapshape)
+for scan in range(3):
+    acc.add(tstomap[scan], ts[scan], weights[scan])
+good = ts == ts
+assert np.allclose(acc.mean(), drizzle(tstomap[good], ts[good], mapshape,
+    weights[good]), equal_nan=True)
+assert acc.hits.sum() == good.sum()
+
+# the variance maps match a direct computation for each pixel
+flatmap = tstomap[good]
+for pix in (0, 17, 64, 119):
+    values, wts = ts[good][flatmap==pix], weights[good][flatmap==pix]
+    mean = (values*wts).sum()/wts.sum()
+    variance = (wts*(values-mean)**2).sum()/wts.sum()
+    assert np.allclose(acc.mean().flat[pix], mean)
+    assert np.allclose(acc.variance().flat[pix], variance)
+    neff = wts.sum()**2/(wts**2).sum()
+    assert np.allclose(acc.variance(unbiased=True).flat[pix], variance*neff/(neff-1))
+    assert np.allclose(acc.mean_variance().flat[pix], variance*neff/(neff-1)/neff)
+
+# removing a scan (sign=-1) undoes adding it
+acc.add(tstomap[2], ts[2], weights[2], sign=-1)
+acc2 = DrizzleAccumulator(mapshape)
+acc2.add(tstomap[:2], ts[:2], weights[:2])
+for name in ('sum','weight','weight2','sumsq','hits'):
+    assert np.allclose(getattr(acc, name), getattr(acc2, name))
+acc.clear()
+assert acc.hits.sum() == 0 and np.isnan(acc.mean()).all()
+
+# a pixel whose samples are all removed, a few at a time, is empty again
+# (not left with roundoff) and has no mean
+acc.add(tstomap, ts, weights)
+pix = tstomap[0,0]
+for scan in range(3):
+    onpix = tstomap[scan] == pix
+    acc.add(tstomap[scan][onpix], ts[scan][onpix], weights[scan][onpix], sign=-1)
+assert acc.hits.flat[pix] == 0
+for name in ('sum','weight','weight2','sumsq'):
+    assert getattr(acc, name).flat[pix] == 0
+for result in (acc.mean(), acc.meansquare(), acc.variance()):
+    assert np.isnan(result.flat[pix])
+    assert np.isfinite(result.flat[tstomap[0,1]]) or tstomap[0,1] == pix
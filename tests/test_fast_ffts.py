@@ -0,0 +1,133 @@
+import os
+import tempfile
+import numpy as np
+from agpy import fast_ffts
+
+arr = np.random.randn(32,48)
+
+# FFTW plans are made once per shape and reused; wisdom can be saved and
+# loaded again
+if fast_ffts.has_fftw:
+    fast_ffts.clear_plan_cache()
+    fftn,ifftn = fast_ffts.get_ffts(backend='fftw3')
+    assert np.allclose(fftn(arr), np.fft.fftn(arr))
+    assert np.allclose(ifftn(fftn(arr)).real, arr)
+    nplans = len(fast_ffts._plan_cache)
+    assert np.allclose(fftn(arr*2), np.fft.fftn(arr*2))
+    assert len(fast_ffts._plan_cache) == nplans
+    # (plans are kept per input dtype)
+    assert np.allclose(fftn(arr.astype('float32')), np.fft.fftn(arr), rtol=1e-5)
+    assert len(fast_ffts._plan_cache) == nplans + 1
+    fast_ffts.clear_plan_cache()
+    assert len(fast_ffts._plan_cache) == 0
+
+    wisdom = tempfile.mktemp(suffix='.wisdom')
+    fast_ffts.save_wisdom(wisdom)
+    assert fast_ffts.load_wisdom(wisdom)
+    os.remove(wisdom)
+else:
+    print "fftw3 is not installed; not testing the plan cache"
+    assert not fast_ffts.load_wisdom()
+
+# only the plan_cache_size most recently used plans are kept
+cache = fast_ffts.OrderedDict()
+oldsize = fast_ffts.plan_cache_size
+fast_ffts.plan_cache_size = 3
+made = []
+def lookup(key):
+    with fast_ffts._plan_cache_lock:
+        return fast_ffts._cached(cache, key, lambda: made.append(key) or key)
+for key in ('a','b','c','a','d','a','b'):
+    assert lookup(key) == key
+assert made == ['a','b','c','d','b']
+assert list(cache) == ['d','a','b']
+fast_ffts.plan_cache_size = oldsize
+
+# every available backend gives numpy's transforms, with the same s and
+# axes keywords
+cube = np.random.randn(6,20,24)
+for backend in fast_ffts.available_backends():
+    fftn,ifftn = fast_ffts.get_ffts(backend=backend, nthreads=2)
+    rfftn,irfftn = fast_ffts.get_ffts(backend=backend, real=True)
+    assert np.allclose(fftn(arr), np.fft.fftn(arr))
+    assert np.allclose(ifftn(np.fft.fftn(arr)), arr)
+    assert np.allclose(fftn(cube, axes=(1,2)), np.fft.fftn(cube, axes=(1,2)))
+    assert np.allclose(fftn(arr, s=(40,50)), np.fft.fftn(arr, s=(40,50)))
+    assert np.allclose(rfftn(arr), np.fft.rfftn(arr))
+    assert np.allclose(irfftn(np.fft.rfftn(arr), s=arr.shape), arr)
+assert fast_ffts.available_backends()[-1] == 'numpy'
+assert np.allclose(fast_ffts.get_ffts(use_numpy_fft=True)[0](arr), np.fft.fftn(arr))
+
+# backends can be added and selected process-wide
+calls = []
+def counting_backend(nthreads=1, planner_effort=None):
+    def fftn(array, s=None, axes=None):
+        calls.append('fftn')
+        return np.fft.fftn(array, s=s, axes=axes)
+    return dict(fftn=fftn, ifftn=np.fft.ifftn, rfftn=np.fft.rfftn,
+            irfftn=np.fft.irfftn)
+fast_ffts.register_backend('counting', counting_backend)
+assert 'counting' in fast_ffts.available_backends()
+fast_ffts.set_backend('counting')
+assert fast_ffts.get_backend() == 'counting'
+assert np.allclose(fast_ffts.get_ffts()[0](arr), np.fft.fftn(arr))
+assert calls == ['fftn']
+fast_ffts.set_backend('auto')
+assert fast_ffts.get_backend() == fast_ffts.available_backends()[0]
+fast_ffts.register_backend('unavailable', counting_backend, available=False)
+assert 'unavailable' not in fast_ffts.available_backends()
+try:
+    fast_ffts.set_backend('nonexistent')
+except ValueError:
+    pass
+else:
+    raise AssertionError("set_backend accepted an unknown backend")
+
+# next_fast_len is the smallest 5-smooth length >= the target
+def is_5smooth(n):
+    for p in (2,3,5):
+        while n % p == 0:
+            n //= p
+    return n == 1
+for target in range(1,2000):
+    fast = fast_ffts.next_fast_len(target)
+    assert fast >= target and is_5smooth(fast)
+    assert not any(is_5smooth(n) for n in range(target, fast))
+assert fast_ffts.next_fast_len(4100) == 4320
+
+# independent transforms can run at the same time; errors are passed on
+results = fast_ffts.run_in_threads([lambda: np.fft.fftn(arr),
+    lambda: np.fft.fftn(arr*2), lambda: 3])
+assert np.allclose(results[1], 2*results[0]) and results[2] == 3
+def fail():
+    raise ZeroDivisionError("in a thread")
+try:
+    fast_ffts.run_in_threads([lambda: 1, fail])
+except ZeroDivisionError:
+    pass
+else:
+    raise AssertionError("run_in_threads lost an exception")
+# no more than `concurrent` tasks run at a time
+import time
+import threading
+running = []
+peak = []
+lock = threading.Lock()
+def task(ii):
+    def run():
+        with lock:
+            running.append(ii)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(ii)
+        return ii
+    return run
+for concurrent in (1, 2):
+    peak = []
+    assert fast_ffts.run_in_threads([task(ii) for ii in range(6)],
+            concurrent) == range(6)
+    assert max(peak) == concurrent
+assert fast_ffts.split_threads(1, 3) == (1, 1)
+assert fast_ffts.split_threads(8, 2) == (2, 4)
+assert fast_ffts.split_threads(2, 4) == (2, 1)
@@ -3,6 +3,7 @@ Test of agpy.gaussfitter.gaussfit
 """
 from pylab import *
 import numpy
+import warnings
 import agpy
 
 # test 1 on figure 1
@@ -127,5 +128,143 @@ width_y : %.1f""" %(x, y, width_x, width_y),
         fontsize=16, horizontalalignment='right',
         verticalalignment='bottom', transform=ax.transAxes)
 
+# batch_gaussfit: two-gaussian fits must agree with multigaussfit, and a
+# width that is pinned at its lower limit must not be reported as converged
+rs = numpy.random.RandomState(42)
+xax = linspace(-10,10,200)
+truepars = [[rs.uniform(1,3), rs.uniform(-6,-2), rs.uniform(0.7,2),
+    rs.uniform(1,3), rs.uniform(2,6), rs.uniform(0.7,2)] for ii in range(40)]
+spectra = array([agpy.gaussfitter.n_gaussian(pars=tp)(xax) for tp in truepars]) + rs.randn(40,200)*0.1
+guess = [1.5,-5,1,1.5,5,1]
+bpars,berrs,bchi2,bniter,bstatus = agpy.gaussfitter.batch_gaussfit(xax, spectra,
+        err=0.1, ngauss=2, vheight=False, params=guess, return_status=True)
+for ii in range(40):
+    mpp,mpmodel,mpperr,mpchi2 = agpy.gaussfitter.multigaussfit(xax, spectra[ii],
+            ngauss=2, err=ones(200)*0.1, params=list(guess))
+    assert bstatus[ii] == 1
+    assert bchi2[ii] < 1.5*len(xax)
+    # (mpfit itself sometimes ends with a width of 0 and a NaN chi^2)
+    if numpy.isfinite(mpchi2):
+        assert abs(bchi2[ii]-mpchi2) < 1e-6*mpchi2
+        assert numpy.allclose(bpars[ii], mpp, rtol=1e-4, atol=1e-6)
+assert bpars[:,2::3].min() > 0
+
+# a start at zero width cannot move: it must not be called converged
+bpars,berrs,bchi2,bniter,bstatus = agpy.gaussfitter.batch_gaussfit(xax, spectra[:1],
+        err=0.1, ngauss=2, vheight=False, params=[1.5,-5,0,1.2,5,1.5], return_status=True)
+assert bstatus[0] != 1
+assert bpars[0,2] > 0
+
+# batch_gaussian evaluates onedgaussian/n_gaussian for many spectra at once
+bp = array([[0.5,2,-1,1.5],[0,1,3,0.5]])
+models,jac = agpy.gaussfitter.batch_gaussian(xax, bp, return_jacobian=True)
+for ii in range(2):
+    assert numpy.allclose(models[ii], agpy.gaussfitter.onedgaussian(xax,*bp[ii]))
+    assert numpy.allclose(jac[ii], agpy.gaussfitter.onedgaussian_jacobian(xax,*bp[ii]))
+assert numpy.allclose(agpy.gaussfitter.batch_gaussian(xax, [truepars[0]], vheight=False)[0],
+        agpy.gaussfitter.n_gaussian(pars=truepars[0])(xax))
+
+# collapse_gaussfit gives the maps onedgaussfit would; with vheight=False the
+# height is fixed at params[0], even though these spectra have a baseline
+xax = arange(80.)
+cubepars = [[rs.uniform(2,4), rs.uniform(30,50), rs.uniform(3,6)] for ii in range(12)]
+cube = array([agpy.gaussfitter.onedgaussian(xax,0.3,*cp) for cp in cubepars]).T.reshape(80,3,4)
+cube += rs.randn(*cube.shape)*0.1
+mean_std = median(cube.std(axis=0))
+for vheight,params in ((True,[0,1,0,1]),(False,[0,1,0,1]),(False,[0.3,1,0,1])):
+    maps = agpy.gaussfitter.collapse_gaussfit(cube, xax=xax, axis=0, nsigcut=0,
+            mppsigcut=0, vheight=vheight, params=params)
+    for ii in range(12):
+        onedpars = agpy.gaussfitter.onedgaussfit(xax, cube[:,ii//4,ii%4],
+                err=mean_std*ones(80), usemoments=True, vheight=vheight,
+                params=params, fixed=[not vheight,False,False,False])[0]
+        assert numpy.allclose([maps[2][ii//4,ii%4], maps[1][ii//4,ii%4],
+            maps[0][ii//4,ii%4]], onedpars[1:], rtol=1e-4)
+    if not vheight and params[0] == 0:
+        # the baseline is then absorbed by a wider line
+        assert (maps[0] > array(cubepars)[:,2].reshape(3,4)).all()
+
+# neighbour_gaussfit: warm-started fits of a smoothly varying cube agree with
+# fits from the moments, in fewer iterations
+yy,xx = indices([9,9])
+linepars = [(0.2, 2+0.1*x, 35+y+0.5*x, 4+0.2*y) for y,x in zip(yy.ravel(),xx.ravel())]
+cube = array([agpy.gaussfitter.onedgaussian(xax,*lp) for lp in linepars]).T.reshape(80,9,9)
+cube += rs.randn(*cube.shape)*0.1
+cpars,cerrs,cchi2,cniter,cstatus = agpy.gaussfitter.batch_gaussfit(xax,
+        cube.reshape(80,81).T, err=0.1, usemoments=True, return_status=True)
+for order in ('spiral','scanline'):
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        npars,nerrs,nchi2,nniter,nstatus = agpy.gaussfitter.neighbour_gaussfit(xax,
+                cube, order=order, err=0.1)
+    # (the pixels not yet fit are NaN, which must not raise warnings)
+    assert not [w for w in caught if 'invalid value' in str(w.message)]
+    assert npars.shape == (4,9,9) and nstatus.shape == (9,9)
+    assert (nstatus == 1).all()
+    assert numpy.allclose(npars.reshape(4,81).T, cpars, rtol=1e-5)
+    assert numpy.allclose(nchi2.ravel(), cchi2, rtol=1e-6)
+    assert nniter.sum() <= cniter.sum()
+assert agpy.gaussfitter.iteration_summary([3,5,4], [1,1,5]).startswith(
+        "3 fits: 12 iterations in total, mean 4.00, median 4, max 5, 1 not converged")
+
+# a fit pegged at a limit, or with an outlying chi^2 (here a second line
+# fit by one gaussian), is not used to seed its neighbours
+cube[:,4,4] += agpy.gaussfitter.onedgaussian(xax,0,3,65,3)
+cube[:,7,7] = agpy.gaussfitter.onedgaussian(xax,0.2,8,45,4) + rs.randn(80)*0.1
+seeds = []
+batch_gaussfit = agpy.gaussfitter.batch_gaussfit
+def seed_recorder(xax, spectra, **kwargs):
+    if not kwargs['usemoments']:
+        seeds.extend(kwargs['params'])
+    return batch_gaussfit(xax, spectra, **kwargs)
+agpy.gaussfitter.batch_gaussfit = seed_recorder
+try:
+    npars,nerrs,nchi2,nniter,nstatus = agpy.gaussfitter.neighbour_gaussfit(xax,
+            cube, start=(0,0), err=0.1, limitedmax=[False,True,False,False],
+            maxpars=[0,5,0,0])
+finally:
+    agpy.gaussfitter.batch_gaussfit = batch_gaussfit
+assert len(seeds) > 0
+assert npars[1,7,7] == 5 and nstatus[7,7] == 1
+assert nchi2[4,4] > 10*median(nchi2)
+for seed in seeds:
+    assert not numpy.allclose(seed, npars[:,7,7])
+    assert not numpy.allclose(seed, npars[:,4,4])
+
+# the analytic Jacobians agree with central differences
+def numerical_jacobian(model, pars, step=1e-6):
+    derivs = []
+    for ii in range(len(pars)):
+        up,down = list(pars),list(pars)
+        up[ii] += step
+        down[ii] -= step
+        derivs.append((model(up)-model(down))/(2*step))
+    return array(derivs)
+onedpars = [0.5,2.,0.3,1.7]
+assert numpy.allclose(agpy.gaussfitter.onedgaussian_jacobian(xax,*onedpars),
+        numerical_jacobian(lambda p: agpy.gaussfitter.onedgaussian(xax,*p), onedpars),
+        atol=1e-7)
+ngpars = [2.,-3.,1.5,1.,4.,0.8]
+assert numpy.allclose(agpy.gaussfitter.n_gaussian_jacobian(pars=ngpars)(xax),
+        numerical_jacobian(lambda p: agpy.gaussfitter.n_gaussian(pars=p)(xax), ngpars),
+        atol=1e-7)
+for circle,rotate,vheight,twodpars in ((0,1,1,[0.5,3.,14.,22.,6.,3.5,30.]),
+        (0,0,1,[0.5,3.,14.,22.,6.,3.5]), (1,0,1,[0.5,3.,14.,22.,6.]),
+        (0,1,0,[3.,14.,22.,6.,3.5,-70.]), (1,0,0,[3.,14.,22.,6.])):
+    opts = dict(circle=circle, rotate=rotate, vheight=vheight, shape=(30,40))
+    jac = agpy.gaussfitter.twodgaussian_jacobian(twodpars, **opts)
+    assert jac.shape == (len(twodpars),30,40)
+    assert numpy.allclose(jac, numerical_jacobian(lambda p:
+        agpy.gaussfitter.twodgaussian(p, **opts), twodpars), atol=1e-6)
+
+# and the fits made with them are those made with finite differences
+image = agpy.gaussfitter.twodgaussian([0.5,3.,14.,22.,6.,3.5,30.], shape=(30,40))
+image += rs.randn(30,40)*0.1
+assert numpy.allclose(agpy.gaussfitter.gaussfit(image),
+        agpy.gaussfitter.gaussfit(image, autoderiv=True), rtol=1e-5)
+spectrum = agpy.gaussfitter.onedgaussian(xax,*onedpars) + rs.randn(80)*0.1
+assert numpy.allclose(agpy.gaussfitter.onedgaussfit(xax, spectrum, usemoments=True)[0],
+        agpy.gaussfitter.onedgaussfit(xax, spectrum, usemoments=True, autoderiv=True)[0],
+        rtol=1e-5)
+
 show()
-    
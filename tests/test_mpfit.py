@@ -0,0 +1,49 @@
+import numpy as np
+from agpy.mpfit import mpfit
+
+# two gaussians, with a fixed, a limited, a tied and a two-sided parameter
+rs = np.random.RandomState(1)
+xax = np.linspace(-10,10,500)
+def model(p):
+    p = [pi[:,np.newaxis] for pi in np.transpose(p)] if np.ndim(p) == 2 else p
+    return (p[0]*np.exp(-(xax-p[1])**2/(2*p[2]**2)) +
+            p[3]*np.exp(-(xax-p[4])**2/(2*p[5]**2)))
+data = model([2.,-3.,1.2,1.5,2.5,1.2]) + rs.randn(xax.size)*0.1
+calls = []
+def fcn(p, fjac=None):
+    calls.append(np.ndim(p))
+    return [0, (data-model(p))/0.1]
+parinfo = [{'value':v} for v in (1.,-2.,1.,1.,2.,1.)]
+parinfo[1]['fixed'] = 1
+parinfo[1]['value'] = -3.
+parinfo[2]['limited'] = [1,0]
+parinfo[2]['limits'] = [0.1,0]
+parinfo[5]['tied'] = 'p[2]'
+parinfo[3]['mpside'] = 2
+
+default = mpfit(fcn, parinfo=parinfo, quiet=1)
+ndefault = len(calls)
+assert default.status > 0
+assert np.allclose(default.params, [2.,-3.,1.2,1.5,2.5,1.2], atol=0.1)
+assert default.params[5] == default.params[2]
+
+# the vectorized Jacobian and the LAPACK factorizations give the same fit
+for options in (dict(vectorized=1), dict(lapack=1), dict(vectorized=1, lapack=1)):
+    calls = []
+    mp = mpfit(fcn, parinfo=parinfo, quiet=1, **options)
+    assert mp.status > 0
+    assert np.allclose(mp.params, default.params, rtol=1e-7, atol=1e-9)
+    assert np.allclose(mp.perror, default.perror, rtol=1e-6)
+    assert mp.niter == default.niter and mp.nfev == default.nfev
+    assert mp.params[5] == mp.params[2]
+    if options.get('vectorized'):
+        # one call per Jacobian rather than one per free parameter
+        assert 2 in calls and len(calls) < ndefault
+    else:
+        assert len(calls) == ndefault
+
+# a vectorized fcn must return one row per parameter set
+def badfcn(p, fjac=None):
+    return [0, ((data-model(p))/0.1).ravel()[:xax.size]]
+mp = mpfit(badfcn, parinfo=parinfo, quiet=1, vectorized=1)
+assert 'FDJAC2' in mp.errmsg
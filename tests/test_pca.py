@@ -0,0 +1,80 @@
+import numpy as np
+from agpy import PCA_tools
+
+# ntime x nbolos data with a few strong, well separated correlated components
+def correlated_data(ntime, nbolos, ncomps=3):
+    modes = np.random.randn(ntime, ncomps) * np.array([50.,20.,8.][:ncomps])
+    return np.dot(modes, np.random.randn(ncomps, nbolos)) + np.random.randn(ntime, nbolos)
+
+def same_vectors(a, b, tol=1e-6):
+    """ columns of a and b agree up to sign """
+    signs = np.sign((a*b).sum(axis=0))
+    return np.allclose(a*signs, b, atol=tol)
+
+# efuncs (an SVD of the data) gives the eigendecomposition of the covariance
+for ntime,nbolos in ((400,20),(15,20)):
+    arr = correlated_data(ntime, nbolos)
+    efuncarr,covmat,evals,evects = PCA_tools.efuncs(arr, return_others=True)
+    assert efuncarr.shape == arr.shape and evects.shape == (nbolos,nbolos)
+    assert np.allclose(covmat, np.dot(arr.T,arr))
+    dense_evals,dense_evects = np.linalg.eigh(np.dot(arr.T,arr))
+    assert np.allclose(evals, dense_evals[::-1], atol=1e-6*evals[0])
+    assert np.all(np.diff(evals) <= 0)
+    assert same_vectors(evects[:,:3], dense_evects[:,::-1][:,:3])
+    assert np.allclose(np.dot(evects.T,evects), np.eye(nbolos))
+    assert np.allclose(efuncarr, np.dot(arr,evects))
+    assert np.allclose(np.dot(efuncarr,evects.T), arr)
+    assert np.allclose(PCA_tools.efuncs(arr), efuncarr)
+
+# masked samples, and those under `mask`, count as zeros
+arr = correlated_data(200, 10)
+mask = np.random.rand(*arr.shape) > 0.9
+zeroed = np.where(mask, 0, arr)
+expected = PCA_tools.efuncs(zeroed, return_others=True)[2]
+assert np.allclose(PCA_tools.efuncs(arr, return_others=True, mask=mask)[2], expected)
+assert np.allclose(PCA_tools.efuncs(np.ma.masked_array(arr, mask=mask),
+    return_others=True)[2], expected)
+assert not np.all(arr[mask] == 0)
+
+# the truncated decompositions find the same leading components as efuncs
+arr = correlated_data(3000, 60)
+evals,evects = PCA_tools.efuncs(arr, return_others=True)[2:]
+r_evals,r_evects = PCA_tools.randomized_pca(arr, 3, chunksize=500, random_state=0)
+assert r_evects.shape == (60,3)
+assert np.allclose(r_evals, evals[:3], rtol=1e-8)
+assert same_vectors(r_evects, evects[:,:3], tol=1e-7)
+i_evals,i_evects = PCA_tools.incremental_pca(arr, 3, chunksize=100)
+assert np.allclose(i_evals, evals[:3], rtol=1e-2)
+assert same_vectors(i_evects, evects[:,:3], tol=1e-2)
+badsamples = np.zeros(arr.shape, dtype='bool')
+badsamples[::7] = True
+r_mask = PCA_tools.randomized_pca(arr, 3, mask=badsamples, random_state=0)[0]
+assert np.allclose(r_mask, PCA_tools.efuncs(arr, return_others=True,
+    mask=badsamples)[2][:3], rtol=1e-8)
+
+# and pca_subtract/unpca_subtract give the dense result with them
+dense_sub = PCA_tools.pca_subtract(arr, 3)
+dense_keep = PCA_tools.unpca_subtract(arr, 3)
+assert np.allclose(dense_sub + dense_keep, arr)
+assert np.allclose(PCA_tools.pca_subtract(arr, 3, method='randomized',
+    chunksize=700, random_state=0), dense_sub)
+assert np.allclose(PCA_tools.unpca_subtract(arr, 3, method='randomized',
+    random_state=0), dense_keep)
+assert np.allclose(PCA_tools.pca_subtract(arr, 3, method='incremental'),
+    dense_sub, atol=0.2)
+try:
+    PCA_tools.pca_subtract(arr, 3, method='sparse')
+except ValueError:
+    pass
+else:
+    raise AssertionError("pca_subtract accepted an unknown method")
+
+# project_components removes (or keeps) the components, in place if asked
+removed = PCA_tools.project_components(arr, evects[:,:3], chunksize=256)
+assert np.allclose(removed, dense_sub)
+assert np.allclose(np.dot(removed, evects[:,:3]), 0, atol=1e-6)
+kept = PCA_tools.project_components(arr, evects[:,:3], keep=True)
+assert np.allclose(kept, dense_keep)
+copy = arr.copy()
+assert PCA_tools.project_components(copy, evects[:,:3], out=copy) is copy
+assert np.allclose(copy, dense_sub)
@@ -0,0 +1,11 @@
+import numpy as np
+from agpy import cubes, smooth
+
+# the batched plane_smooth gives the same result as smoothing each plane,
+# and smooth's own keywords fall back to the plane-by-plane smooth
+testcube = np.random.randn(4,30,40)
+for kwargs in (dict(), dict(use_fft=True), dict(method='fft'),
+        dict(method='direct',nwidths=6), dict(crop=True)):
+    planes = np.array([smooth(plane,**kwargs) for plane in testcube])
+    assert np.allclose(cubes.plane_smooth(testcube,parallel=False,**kwargs), planes)
+    assert np.allclose(cubes.plane_smooth(testcube,batched=False,parallel=False,**kwargs), planes)
@@ -0,0 +1,37 @@
+import numpy as np
+from agpy import PSD2
+
+image = np.random.randn(64,48)
+image[10,20] = np.nan
+cube = np.random.randn(5,64,48)
+
+# the PSD of an image is |FFT|^2 (with NaNs treated as zero)
+zeroed = np.where(image==image, image, 0)
+expected = np.fft.fftshift(np.abs(np.fft.fft2(zeroed))**2)
+assert np.allclose(PSD2(image), expected)
+
+# a cube gives one PSD (or power spectrum) per plane, or their average
+psds = PSD2(cube)
+assert psds.shape == cube.shape
+for plane,psd in zip(cube,psds):
+    assert np.allclose(psd, PSD2(plane))
+assert np.allclose(PSD2(cube, average=True), psds.mean(axis=0))
+assert np.allclose(PSD2(cube, image2=cube[::-1]), [PSD2(a, image2=b)
+    for a,b in zip(cube,cube[::-1])])
+freq,spectra = PSD2(cube, oned=True)
+for plane,spectrum in zip(cube,spectra):
+    freq1,spectrum1 = PSD2(plane, oned=True)
+    assert np.allclose(freq, freq1)
+    assert np.allclose(spectrum, spectrum1)
+
+# Welch's method: a single segment covering the image is the hanning-
+# windowed PSD; smaller segments give PSDs of the segment size
+assert np.allclose(PSD2(cube[0], segment_size=48, segment_overlap=0),
+        PSD2(cube[0][:48], hanning=True))
+welch = PSD2(cube[0], segment_size=16)
+assert welch.shape == (16,16)
+segments = [PSD2(cube[0][y0:y0+16,x0:x0+16], hanning=True)
+    for y0 in range(0,49,8) for x0 in range(0,33,8)]
+assert np.allclose(welch, np.mean(segments, axis=0))
+assert np.allclose(PSD2(cube, segment_size=16, block_size=2),
+        [PSD2(plane, segment_size=16) for plane in cube])
@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+import cPickle
+import numpy as np
+from agpy import pyflagger
+from agpy.PCA_tools import efuncs
+from AG_image_tools.drizzle import drizzle
+
+# a cache made by cache_sav (one .npy per array field, the rest pickled) is
+# loaded back as SavStruct's with copy-on-write memory maps
+cachedir = tempfile.mkdtemp()
+raw = np.random.randn(50,12)
+np.save(os.path.join(cachedir,'bgps.raw.npy'), raw)
+np.save(os.path.join(cachedir,'bgps.scans_info.npy'), np.arange(10).reshape(5,2))
+with open(os.path.join(cachedir,'bgps.pkl'),'wb') as f:
+    cPickle.dump({'filename':'test_postiter.sav'}, f, protocol=2)
+structs = pyflagger.load_sav_cache(cachedir)
+assert structs.keys() == ['bgps']
+bgps = structs['bgps']
+assert np.all(bgps['RAW'][0] == raw) and np.all(bgps.raw[0] == raw)
+assert bgps['filename'][0] == 'test_postiter.sav'
+assert 'scans_info' in bgps and 'astrosignal' not in bgps
+assert isinstance(bgps['raw'][0], np.memmap)
+bgps['raw'][0][:] = 0
+assert np.all(np.load(os.path.join(cachedir,'bgps.raw.npy')) == raw)
+try:
+    bgps.astrosignal
+except AttributeError:
+    pass
+else:
+    raise AssertionError("SavStruct made up a missing field")
+shutil.rmtree(cachedir)
+
+# a Flagger with just the timestream, the pointing and the flags
+class MiniFlagger(pyflagger.Flagger):
+    def __init__(self, ts, weights, tstomap, mapshape):
+        self.data = ts
+        self.weight = weights
+        self.tstomap = tstomap
+        self.flags = np.zeros(ts.shape, dtype='int')
+        self.nscans = ts.shape[0]
+        self.map = np.zeros(mapshape)
+        self.mapfig = None
+        self.incremental_maps = {}
+        self.pca_cache = {}
+        self.tsplot_dict = {}
+
+nscans,ntime,nbolos = 4,30,8
+ts = np.random.randn(nscans,ntime,nbolos)
+weights = np.random.uniform(0.5,2,ts.shape)
+tstomap = np.random.randint(0,100,ts.shape)
+f = MiniFlagger(ts, weights, tstomap, (10,10))
+
+# update_maps applies flag edits to the map without redrizzling
+acc = f._drizzle_incremental('map', ts, weights)
+f.map = drizzle(tstomap, ts, f.map.shape, weights)
+f.flags[1,5:20,2] = 1
+f.flags[1,3,:] = 1
+f.update_maps(region=1)
+expected = drizzle(tstomap, ts, f.map.shape, weights*(1-f.flags))
+assert np.allclose(f.map, expected, equal_nan=True)
+f.flags[1,5:10,2] = 0
+f.flags[3,0,0] = 1
+f.update_maps()
+expected = drizzle(tstomap, ts, f.map.shape, weights*(1-f.flags))
+assert np.allclose(f.map, expected, equal_nan=True)
+assert np.all(f.incremental_maps['map'][3] == f.flags)
+
+# scanPCA caches the decomposition until the scan's flags change
+result = f.scanPCA(2)
+cached = f.scanPCA(2)
+assert cached[3] is result[3]
+for fresh,fromcache in zip(result, cached):
+    assert np.allclose(fresh, fromcache)
+assert np.allclose(result[2], efuncs(ts[2], return_others=True)[2])
+# (only the eigenvalues and eigenvectors are kept, not the timestream-sized
+# efuncarr or flags)
+assert sum(np.asarray(item).nbytes for item in f.pca_cache[(2,'data',True)][1:]) < ts[2].nbytes
+f.flags[2,4,:] = 1
+newresult = f.scanPCA(2)
+assert newresult[3] is not result[3]
+assert np.allclose(newresult[2],
+        efuncs(ts[2], return_others=True, mask=f.flags[2]!=0)[2])
+assert np.allclose(f.scanPCA(2, flag=False)[2], result[2])
+whole = f.scanPCA()
+assert np.allclose(whole[2], efuncs(ts.reshape(nscans*ntime,nbolos),
+    return_others=True, mask=f.flags.reshape(nscans*ntime,nbolos)!=0)[2])
+
+# flagging every sample of a pixel, one scan at a time, empties it: the map
+# and the noise maps are NaN there, as they are for a full drizzle
+f.weightmap = np.ones(f.map.shape)
+f.allweightsquaremap = drizzle(tstomap, weights**2, f.map.shape, 1.0)
+f._drizzle_incremental('noise', ts, weights)
+f._derive_noisemaps()
+pix = tstomap[0,0,0]
+for scan in range(nscans):
+    f.flags[scan][tstomap[scan] == pix] = 1
+    f.update_maps(scan)
+expected = drizzle(tstomap, ts, f.map.shape, weights*(1-f.flags))
+assert np.isnan(f.map.flat[pix]) and np.isnan(expected.flat[pix])
+assert np.allclose(f.map, expected, equal_nan=True)
+assert f.incremental_maps['map'][0].weight.flat[pix] == 0
+assert np.ma.getmaskarray(f.residsquaremap).flat[pix]
+assert np.allclose(np.ma.filled(f.residsquaremap, np.nan),
+        drizzle(tstomap, ts**2, f.map.shape, weights*(1-f.flags)), equal_nan=True)
+
+# find_poorly_correlated flags bolometers in every scan, and the maps follow
+f.datashape = ts.shape
+f.flags[:] = 0
+f.update_maps()
+badarr = f.find_poorly_correlated(verbose=False, nsig=1)
+assert badarr.sum() > 0
+expected = drizzle(tstomap, ts, f.map.shape, weights*(1-f.flags))
+assert np.allclose(f.map, expected, equal_nan=True)
+
+# clearflags drizzles the maps again from the unflagged timestreams
+# (clearflags puts lazy attributes on the class, so give it its own)
+class LazyFlagger(MiniFlagger):
+    pass
+g = LazyFlagger(ts, weights, tstomap, (10,10))
+g.bgps = {'noise':[ts.reshape(nscans*ntime,nbolos)],
+        'weight':[weights.reshape(nscans*ntime,nbolos)]}
+g.scans_contiguous = True
+g.ncscans = np.array([[ii*ntime,(ii+1)*ntime-1] for ii in range(nscans)])
+g.scanlen = ntime
+g.datashape = ts.shape
+g.tscache = {}
+g.flags[2,:,3] = 1
+g.noise = np.ma.masked_array(ts, mask=g.flags>0)
+g.weightmap = np.ones(g.map.shape)
+g.allweightsquaremap = drizzle(tstomap, weights**2, g.map.shape, 1.0)
+g._drizzle_incremental('map', g.noise, weights)
+g._drizzle_incremental('noise', g.noise, weights)
+g.clearflags()
+assert not np.ma.isMaskedArray(g.noise) or not g.noise.mask.any()
+assert np.allclose(g.map, drizzle(tstomap, ts, g.map.shape, weights), equal_nan=True)
+assert np.allclose(np.ma.filled(g.residsquaremap, np.nan),
+        drizzle(tstomap, ts**2, g.map.shape, weights), equal_nan=True)
+
+# the timestreams are float64 copies of the scans, whatever the dtype in the
+# .sav file, so editing them does not touch the structure
+class ScanFlagger(MiniFlagger):
+    astrosignal = pyflagger.lazydata('astrosignal')
+    scalearr = pyflagger.lazydata('scalearr', flag=False)
+h = ScanFlagger(ts, weights, tstomap, (10,10))
+h.bgps = {'astrosignal':[ts.reshape(nscans*ntime,nbolos).astype('float32')],
+        'scalearr':[np.arange(nscans*ntime*nbolos).reshape(nscans*ntime,nbolos)]}
+h.scans_contiguous = True
+h.ncscans = g.ncscans
+h.nscans,h.scanlen,h.datashape = nscans,ntime,ts.shape
+h.flags[0,0,:] = 1
+assert h.astrosignal.dtype == np.float64 and h.scalearr.dtype == np.float64
+assert h.astrosignal.shape == ts.shape and h.astrosignal.mask[0,0].all()
+assert np.allclose(h.astrosignal[1], ts[1], atol=1e-6)
+h.scalearr[:] = -1
+h.astrosignal[:] = 0
+assert h.bgps['scalearr'][0].min() == 0
+assert np.allclose(h.bgps['astrosignal'][0], ts.reshape(nscans*ntime,nbolos), atol=1e-6)
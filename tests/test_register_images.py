@@ -0,0 +1,54 @@
+import numpy as np
+from agpy import register_images, register_stack, shift
+
+# a smooth image with some structure, shifted by known sub-pixel amounts
+yy,xx = np.indices([64,80])
+image = (np.exp(-((xx-30.)**2+(yy-25.)**2)/(2*4.**2)) +
+        0.5*np.exp(-((xx-50.)**2+(yy-40.)**2)/(2*6.**2)))
+shifts = [(0,0), (2.3,-1.7), (-5.25,3.5), (0.45,0.85)]
+shifted = np.array([shift(image, dx, dy) for dx,dy in shifts])
+
+# register_images measures each shift to 1/usfac pixels
+for (dx,dy),im in zip(shifts,shifted):
+    xoff,yoff = register_images(image, im, usfac=20)
+    assert abs(xoff-dx) <= 1/20. and abs(yoff-dy) <= 1/20.
+    realigned = shift(im, -xoff, -yoff)
+    assert np.abs(realigned-image).max() < 0.05
+xoff,yoff,error = register_images(image, shifted[1], usfac=20, return_error=True)
+assert error < 0.05
+
+# register_stack gives the same shifts for the whole stack, relative to any
+# reference
+xoffs,yoffs = register_stack(shifted, reference=image, usfac=20)
+assert np.allclose(xoffs, [register_images(image, im, usfac=20)[0] for im in shifted])
+assert np.allclose(yoffs, [register_images(image, im, usfac=20)[1] for im in shifted])
+xoffs,yoffs,errors = register_stack(shifted, reference=1, usfac=20, return_error=True)
+assert abs(xoffs[1]) < 1e-10 and abs(yoffs[1]) < 1e-10 and errors[1] < 1e-6
+assert np.allclose(xoffs, np.array(shifts)[:,0]-shifts[1][0], atol=0.1)
+
+# maxoff limits the (integer-pixel) search to small shifts
+xoff,yoff = register_images(image, shifted[2], maxoff=3, usfac=1)
+assert (xoff,yoff) == (-3,3)
+xoff,yoff = register_images(image, shifted[2], maxoff=3)
+assert abs(xoff) <= 3.75 and abs(yoff) <= 3.75
+
+# both transforms come from the chosen FFT backend
+from agpy import fast_ffts
+calls = []
+def counting_backend(nthreads=1, planner_effort=None):
+    def fftn(array, s=None, axes=None):
+        calls.append('fftn')
+        return np.fft.fftn(array, s=s, axes=axes)
+    def ifftn(array, s=None, axes=None):
+        calls.append('ifftn')
+        return np.fft.ifftn(array, s=s, axes=axes)
+    return dict(fftn=fftn, ifftn=ifftn, rfftn=np.fft.rfftn,
+            irfftn=np.fft.irfftn)
+fast_ffts.register_backend('counting', counting_backend,
+        preference=len(fast_ffts.backend_preference))
+assert np.allclose(register_images(image, shifted[1], usfac=20,
+    fft_backend='counting'), register_images(image, shifted[1], usfac=20))
+assert calls == ['fftn', 'fftn', 'ifftn']
+calls = []
+register_stack(shifted, reference=image, usfac=20, fft_backend='counting')
+assert calls.count('ifftn') == len(shifted)
@@ -0,0 +1,38 @@
+import numpy as np
+from agpy import shift, shift1d, shift_stack
+
+def reference_shift(data, deltax, deltay):
+    """ the FFT shift written out for one image (integer frequencies) """
+    ny,nx = data.shape
+    Nx = np.fft.ifftshift(np.linspace(-np.fix(nx/2.),np.ceil(nx/2.)-1,nx))
+    Ny = np.fft.ifftshift(np.linspace(-np.fix(ny/2.),np.ceil(ny/2.)-1,ny))
+    Nx,Ny = np.meshgrid(Nx,Ny)
+    return np.fft.ifftn(np.fft.fftn(data) *
+            np.exp(1j*2*np.pi*(-deltax*Nx/nx-deltay*Ny/ny)))
+
+# integer shifts are rolls
+image = np.random.randn(20,31)
+assert np.allclose(shift(image, 3, -2), np.roll(np.roll(image, 3, 1), -2, 0))
+spectrum = np.random.randn(64)
+assert np.allclose(shift1d(spectrum, 5), np.roll(spectrum, 5))
+
+# each image of a stack gets its own sub-pixel shift, on even and odd axes
+for shape in ((6,20,31), (6,32,24)):
+    stack = np.random.randn(*shape)
+    dx = np.random.uniform(-3, 3, shape[0])
+    dy = np.random.uniform(-3, 3, shape[0])
+    expected = [reference_shift(im, x, y) for im,x,y in zip(stack,dx,dy)]
+    assert np.allclose(shift_stack(stack, dx, dy), np.real(expected))
+    assert np.allclose(shift_stack(stack, dx, dy, return_real=False), expected)
+    assert np.allclose(shift_stack(stack, dx, dy, return_real=False,
+        return_abs=True), np.abs(expected))
+    assert np.allclose(shift(stack[2], dx[2], dy[2]), np.real(expected[2]))
+    # the same shift for every image
+    assert np.allclose(shift_stack(stack, 1.5, -0.5),
+            np.real([reference_shift(im, 1.5, -0.5) for im in stack]))
+
+spectra = np.random.randn(5,33)
+lags = np.random.uniform(-4, 4, 5)
+expected = [reference_shift(sp[None,:], lag, 0)[0] for sp,lag in zip(spectra,lags)]
+assert np.allclose(shift_stack(spectra, lags), np.real(expected))
+assert np.allclose(shift1d(spectra[0], lags[0]), np.real(expected[0]))
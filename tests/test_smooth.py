@@ -138,3 +138,62 @@ for ii,smoothsize in enumerate([10,100]): #20,50,100,128]):
     draw()
 
 """
+
+# smooth reuses its PreparedConvolvers for images of the same shape, with
+# the same results
+from AG_fft_tools import smooth_tools
+smooth_tools.clear_convolver_cache()
+noise_image = randn(100,120)
+first = smooth(noise_image,3.0)
+assert len(smooth_tools._convolver_cache) == 1
+assert smooth_tools.get_convolver(noise_image.shape,kernelwidth=3.0) is smooth_tools.get_convolver(noise_image.shape,kernelwidth=3.0)
+assert allclose(smooth(noise_image,3.0), first)
+assert allclose(smooth(noise_image*2,3.0), first*2)
+assert len(smooth_tools._convolver_cache) == 1
+smooth(noise_image,4.0)
+assert len(smooth_tools._convolver_cache) == 2
+smooth_tools.clear_convolver_cache()
+assert allclose(smooth(noise_image,3.0), first)
+
+# the cache is bounded by the memory the convolvers hold, including the
+# kernel FFTs they make when they are first used
+smooth_tools.clear_convolver_cache()
+smooth(noise_image,3.0,method='fft')
+conv = smooth_tools._convolver_cache.values()[0]
+assert conv.nbytes > conv.kernel.nbytes + prod(conv.newshape)*8
+default_bytes = smooth_tools.convolver_cache_bytes
+smooth_tools.convolver_cache_bytes = int(conv.nbytes*1.5)
+smooth(noise_image,4.0,method='fft')
+assert smooth_tools._convolver_cache.values() != [conv]
+assert len(smooth_tools._convolver_cache) == 1
+smooth_tools.convolver_cache_bytes = conv.kernel.nbytes
+assert allclose(smooth(noise_image,3.0,method='fft'), first)
+assert len(smooth_tools._convolver_cache) == 0
+smooth_tools.convolver_cache_bytes = default_bytes
+for width in (1.,2.,3.,4.,5.,6.):
+    smooth(noise_image,width,method='fft')
+assert len(smooth_tools._convolver_cache) == smooth_tools.convolver_cache_size
+smooth_tools.clear_convolver_cache()
+
+# all of the convolution methods give the same smoothed image
+nan_image = noise_image.copy()
+nan_image[40,50] = nan_image[70,20] = nan
+for kerneltype in ('gaussian','boxcar','tophat'):
+    fftsmooth = smooth(nan_image,2.0,kerneltype,nwidths=6,method='fft',interpolate_nan=True)
+    methods = ['direct','auto'] + (['separable'] if kerneltype != 'tophat' else [])
+    for method in methods:
+        assert allclose(smooth(nan_image,2.0,kerneltype,nwidths=6,method=method,
+            interpolate_nan=True), fftsmooth)
+# with an image-sized kernel, method='direct' falls back to the FFT
+assert allclose(smooth(noise_image,3.0,'airy',method='direct'),
+        smooth(noise_image,3.0,'airy',method='fft'))
+
+# smooth_planes gives the same result as smoothing each plane
+from agpy import smooth_planes
+noise_cube = randn(4,50,60)
+noise_cube[1,20,30] = nan
+for kwargs in (dict(), dict(interpolate_nan=True), dict(kerneltype='boxcar',nwidths=6)):
+    planes = array([smooth(plane,2.0,**kwargs) for plane in noise_cube])
+    assert allclose(smooth_planes(noise_cube,kernelwidth=2.0,**kwargs), planes, equal_nan=True)
+    assert allclose(smooth_planes(noise_cube.transpose(1,0,2),cubedim=1,kernelwidth=2.0,**kwargs),
+            planes.transpose(1,0,2), equal_nan=True)